@@ -37,11 +37,114 @@ from google.colab import drive
 import glob
 from IPython.display import clear_output, display
 import time
+import sys
+import json
+import hashlib
 
 # Reduce TensorFlow verbosity
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Suppress TensorFlow logging
 tf.get_logger().setLevel('ERROR')  # Only show errors
 
+"""## Feature Store
+
+A copy of the feature store from MLOPS_Pipeline/feature_store.py (and file_sha256 from
+preprocessing_cache.py), kept here so the notebook runs on its own.
+"""
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_weights_digest(model):
+    """Digest of a Keras model's weights, so retrained or swapped backbones never share entries."""
+    digest = hashlib.sha256()
+    for weights in model.get_weights():
+        digest.update(np.ascontiguousarray(weights).data)
+    return digest.hexdigest()[:16]
+
+
+class FeatureStore:
+    """Feature entries for one extractor namespace, with hit/miss stats and LRU eviction."""
+
+    def __init__(self, root, namespace, max_size_gb=20.0):
+        self.root = root
+        self.namespace = dict(namespace)
+        namespace_digest = hashlib.sha256(json.dumps(self.namespace, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.root, namespace_digest)
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "namespace.json"), "w") as f:
+            json.dump(self.namespace, f, indent=2, sort_keys=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def get(self, key):
+        """Return the stored features for key (refreshing its LRU timestamp), or None."""
+        entry_path = self._entry_path(key)
+        try:
+            features = np.load(entry_path)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return features
+
+    def put(self, key, features):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(tmp_path, entry_path)
+
+    def _entries(self):
+        """(mtime, size, path) of every entry in the whole store, across namespaces."""
+        entries = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".npy"):
+                    entry_path = os.path.join(root, name)
+                    stat = os.stat(entry_path)
+                    entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def enforce_budget(self):
+        """Evict least-recently-used entries until the whole store fits in max_size_gb."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+            self.evicted += 1
+        return total
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "entries": len(entries),
+            "size_gb": sum(size for _, size, _ in entries) / 1024 ** 3,
+            "max_size_gb": self.max_bytes / 1024 ** 3,
+        }
+
 """## Mount Google Drive and Define Constants"""
 
 # Mount Google Drive
@@ -62,6 +165,9 @@ LOGS_DIR = os.path.join(BASE_DIR, 'logs')
 # Google Drive paths - Update this to your specific path
 DRIVE_DATA_DIR = "/content/drive/MyDrive/Colab Notebooks/AI Studio/Project/train"
 DRIVE_OUTPUT_DIR = "/content/drive/MyDrive/driver_drowsiness_models"
+# Persistent MobileNetV2 feature store, reused across Colab sessions
+FEATURE_STORE_DIR = "/content/drive/MyDrive/driver_drowsiness_feature_store"
+FEATURE_STORE_MAX_GB = 10
 
 # Create directories
 os.makedirs(BASE_DIR, exist_ok=True)
@@ -275,111 +381,160 @@ if not dataset_loaded:
 
 """## Step 2: Preprocess Dataset and Extract Features"""
 
+# Categories of each binary task. Each split is stored as one consolidated file per task
+# with the task's categories in consecutive row ranges, so a task loads as a single
+# zero-copy memory-mapped slice.
+TASK_CATEGORIES = {'eye': ['Closed', 'Open'], 'yawn': ['no_yawn', 'yawn']}
+SPLITS = ['train', 'val', 'test']
+CONSOLIDATED_INDEX = 'index.json'
+FEATURE_DIM = 7 * 7 * 1280
+
+def write_consolidated_index(root, entries, sample_shape):
+    with open(os.path.join(root, CONSOLIDATED_INDEX), 'w') as f:
+        json.dump({'sample_shape': list(sample_shape), 'entries': entries}, f, indent=2)
+
+def open_consolidated(root, split, task):
+    """Memory-map the consolidated file of (split, task) and return (X, class indices)."""
+    with open(os.path.join(root, CONSOLIDATED_INDEX)) as f:
+        entry = json.load(f)['entries'][f"{split}_{task}"]
+    X = np.load(os.path.join(root, entry['file']), mmap_mode='r')[:entry['count']]
+    y = np.zeros(entry['count'], dtype=np.int64)
+    for i, category in enumerate(TASK_CATEGORIES[task]):
+        start, stop = entry['categories'][category]
+        y[start:stop] = i
+    return X, y
+
 def preprocess_and_extract_features():
     print("Preprocessing dataset and extracting features...")
 
-    # Define categories
-    categories = ['Closed', 'Open', 'no_yawn', 'yawn']
-
-    # Create directories for processed data and features
-    for split in ['train', 'val', 'test']:
-        split_dir = os.path.join(PROCESSED_DIR, split)
-        os.makedirs(split_dir, exist_ok=True)
-
-        features_split_dir = os.path.join(FEATURES_DIR, split)
-        os.makedirs(features_split_dir, exist_ok=True)
-
+    # Split every category's files into train (70%), validation (15%), and test (15%)
+    from sklearn.model_selection import train_test_split
+    split_files = {split: {} for split in SPLITS}
+    for categories in TASK_CATEGORIES.values():
         for category in categories:
-            os.makedirs(os.path.join(split_dir, category), exist_ok=True)
-            os.makedirs(os.path.join(features_split_dir, category), exist_ok=True)
-
-    # Process each category
-    for category in categories:
-        print(f"Processing {category} images...")
-        category_path = os.path.join(TRAIN_DIR, category)
-
-        if not os.path.exists(category_path):
-            print(f"Warning: Category path {category_path} does not exist")
-            continue
-
-        # Get all image files
-        image_files = [f for f in os.listdir(category_path) if f.endswith(('.jpg', '.jpeg', '.png'))]
-
-        if len(image_files) == 0:
-            print(f"Warning: No images found in {category_path}")
-            continue
-
-        # Split into train (70%), validation (15%), and test (15%)
-        from sklearn.model_selection import train_test_split
-        train_files, temp_files = train_test_split(image_files, test_size=0.3, random_state=42)
-        val_files, test_files = train_test_split(temp_files, test_size=0.5, random_state=42)
-
-        print(f"  Train: {len(train_files)}, Validation: {len(val_files)}, Test: {len(test_files)}")
-
-        # Load feature extractor model (MobileNetV2)
-        feature_extractor = tf.keras.applications.MobileNetV2(
-            input_shape=(224, 224, 3),
-            include_top=False,
-            weights='imagenet'
-        )
-
-        # Process and save images for each split
-        for split_name, files in [('train', train_files), ('val', val_files), ('test', test_files)]:
-            split_dir = os.path.join(PROCESSED_DIR, split_name, category)
-            features_dir = os.path.join(FEATURES_DIR, split_name, category)
-
-            # Show progress less frequently to reduce output
-            total_files = len(files)
-            print(f"  Processing {total_files} {category} images for {split_name} split...")
-
-            for i, file in enumerate(files):
-                # Show progress sparingly
-                if i % max(1, total_files // 5) == 0:
-                    print(f"    Progress: {i}/{total_files} ({i/total_files*100:.1f}%)")
-
-                # Read image
-                image_path = os.path.join(category_path, file)
-                img = cv2.imread(image_path)
-
-                if img is None:
-                    continue
-
-                # Save processed image for CNN model
-                # Convert to grayscale
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-                # Resize to standard size
-                resized = cv2.resize(gray, (IMG_SIZE, IMG_SIZE))
-
-                # Apply histogram equalization for better contrast
-                equalized = cv2.equalizeHist(resized)
-
-                # Normalize pixel values to [0, 1]
-                normalized = equalized / 255.0
-
-                # Expand dimensions to match model input shape (add channel dimension)
-                processed_img = np.expand_dims(normalized, axis=-1)
-
-                # Save processed image
-                output_path = os.path.join(split_dir, file.replace('.jpg', '.npy').replace('.jpeg', '.npy').replace('.png', '.npy'))
-                np.save(output_path, processed_img)
-
-                # Extract and save features
-                # Preprocess for feature extraction (different from CNN preprocessing)
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                img_resized = cv2.resize(img_rgb, (224, 224))
-                img_normalized = img_resized / 255.0
-                img_expanded = np.expand_dims(img_normalized, axis=0)
-
-                # Extract features with reduced verbosity
-                with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
-                    features = feature_extractor.predict(img_expanded, verbose=0)
-
-                # Save features
-                features_path = os.path.join(features_dir, file.replace('.jpg', '.npy').replace('.jpeg', '.npy').replace('.png', '.npy'))
-                np.save(features_path, features.flatten())
+            category_path = os.path.join(TRAIN_DIR, category)
+            for split_name in SPLITS:
+                split_files[split_name][category] = []
+
+            if not os.path.exists(category_path):
+                print(f"Warning: Category path {category_path} does not exist")
+                continue
+
+            # Get all image files
+            image_files = [f for f in os.listdir(category_path) if f.endswith(('.jpg', '.jpeg', '.png'))]
+
+            if len(image_files) == 0:
+                print(f"Warning: No images found in {category_path}")
+                continue
+
+            train_files, temp_files = train_test_split(image_files, test_size=0.3, random_state=42)
+            val_files, test_files = train_test_split(temp_files, test_size=0.5, random_state=42)
+            split_files['train'][category] = train_files
+            split_files['val'][category] = val_files
+            split_files['test'][category] = test_files
+            print(f"  {category}: Train: {len(train_files)}, Validation: {len(val_files)}, Test: {len(test_files)}")
+
+    # Load feature extractor model (MobileNetV2) once for every category and split
+    feature_extractor = tf.keras.applications.MobileNetV2(
+        input_shape=(224, 224, 3),
+        include_top=False,
+        weights='imagenet'
+    )
 
-            print(f"    Completed {split_name} split for {category}")
+    # Features already extracted for an identical image file are read back from the store
+    feature_store = FeatureStore(FEATURE_STORE_DIR, {
+        "backbone": "mobilenet_v2",
+        "weights": model_weights_digest(feature_extractor),
+        "input_shape": [224, 224, 3],
+        "preprocessing": "bgr2rgb+resize+unit_range",
+        "feature_head": "raw_flat",
+    }, max_size_gb=FEATURE_STORE_MAX_GB)
+
+    processed_entries = {}
+    feature_entries = {}
+    for split_name in SPLITS:
+        for task, categories in TASK_CATEGORIES.items():
+            capacity = sum(len(split_files[split_name][category]) for category in categories)
+            if capacity == 0:
+                continue
+            file_name = f"{split_name}_{task}.npy"
+            # Rows are written straight into memory-mapped files; images that fail to load
+            # are skipped, so only the first `count` rows are valid
+            processed = np.lib.format.open_memmap(os.path.join(PROCESSED_DIR, file_name), mode='w+',
+                                                  dtype=np.float32, shape=(capacity, IMG_SIZE, IMG_SIZE, 1))
+            features_out = np.lib.format.open_memmap(os.path.join(FEATURES_DIR, file_name), mode='w+',
+                                                     dtype=np.float32, shape=(capacity, FEATURE_DIM))
+            count = 0
+            category_ranges = {}
+
+            for category in categories:
+                files = split_files[split_name][category]
+                category_path = os.path.join(TRAIN_DIR, category)
+                category_start = count
+
+                # Show progress less frequently to reduce output
+                total_files = len(files)
+                print(f"  Processing {total_files} {category} images for {split_name} split...")
+
+                for i, file in enumerate(files):
+                    # Show progress sparingly
+                    if i % max(1, total_files // 5) == 0:
+                        print(f"    Progress: {i}/{total_files} ({i/total_files*100:.1f}%)")
+
+                    # Read image
+                    image_path = os.path.join(category_path, file)
+                    img = cv2.imread(image_path)
+
+                    if img is None:
+                        continue
+
+                    # Save processed image for CNN model
+                    # Convert to grayscale
+                    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+                    # Resize to standard size
+                    resized = cv2.resize(gray, (IMG_SIZE, IMG_SIZE))
+
+                    # Apply histogram equalization for better contrast
+                    equalized = cv2.equalizeHist(resized)
+
+                    # Normalize pixel values to [0, 1] and add the channel dimension
+                    processed[count] = np.expand_dims(equalized / 255.0, axis=-1)
+
+                    # Extract features (only images missing from the feature store hit the network)
+                    feature_key = file_sha256(image_path)
+                    features = feature_store.get(feature_key)
+                    if features is None:
+                        # Preprocess for feature extraction (different from CNN preprocessing)
+                        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                        img_resized = cv2.resize(img_rgb, (224, 224))
+                        img_normalized = img_resized / 255.0
+                        img_expanded = np.expand_dims(img_normalized, axis=0)
+
+                        # Extract features with reduced verbosity
+                        with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues
+                            features = feature_extractor.predict(img_expanded, verbose=0)
+                        feature_store.put(feature_key, features)
+
+                    features_out[count] = features.flatten()
+                    count += 1
+
+                category_ranges[category] = [category_start, count]
+                print(f"    Completed {split_name} split for {category}")
+
+            processed.flush()
+            features_out.flush()
+            del processed, features_out
+            processed_entries[f"{split_name}_{task}"] = {'file': file_name, 'count': count, 'categories': category_ranges}
+            feature_entries[f"{split_name}_{task}"] = {'file': file_name, 'count': count, 'categories': category_ranges}
+
+    write_consolidated_index(PROCESSED_DIR, processed_entries, (IMG_SIZE, IMG_SIZE, 1))
+    write_consolidated_index(FEATURES_DIR, feature_entries, (FEATURE_DIM,))
+
+    feature_store.enforce_budget()
+    store_stats = feature_store.stats()
+    print(f"  Feature store: {store_stats['hits']} hits, {store_stats['misses']} misses "
+          f"({store_stats['hit_ratio']:.1%}), {store_stats['size_gb']:.2f} GB")
 
     print("Data preprocessing and feature extraction complete!")
     # Clear output to reduce browser load
@@ -524,48 +679,21 @@ def plot_training_history(history, model_name):
 """## Step 4: Load and Prepare Data"""
 
 def load_processed_data(split='train', task='eye'):
-    """Load processed data for CNN model"""
+    """Load processed data for CNN model (memory-mapped from the consolidated split file)"""
     print(f"Loading {split} processed data for {task} detection...")
+    categories = TASK_CATEGORIES[task]
 
-    if task == 'eye':
-        categories = ['Closed', 'Open']
-    else:  # task == 'yawn'
-        categories = ['no_yawn', 'yawn']
-
-    X_list = []
-    y_list = []
-
-    for i, category in enumerate(categories):
-        category_path = os.path.join(PROCESSED_DIR, split, category)
-
-        if not os.path.exists(category_path):
-            print(f"Warning: Category path {category_path} does not exist")
-            continue
-
-        files = [f for f in os.listdir(category_path) if f.endswith('.npy')]
-
-        if len(files) == 0:
-            print(f"Warning: No processed files found in {category_path}")
-            continue
-
-        for file in files:
-            # Load processed image
-            file_path = os.path.join(category_path, file)
-            img = np.load(file_path)
-
-            # Add to lists
-            X_list.append(img)
-            y_list.append(i)
+    if not os.path.exists(os.path.join(PROCESSED_DIR, CONSOLIDATED_INDEX)):
+        print(f"Warning: No processed data index in {PROCESSED_DIR}")
+        return np.array([]).reshape(0, IMG_SIZE, IMG_SIZE, 1), np.array([]).reshape(0, 2)
 
-    # Convert to numpy arrays
-    if len(X_list) == 0:
+    try:
+        X, y = open_consolidated(PROCESSED_DIR, split, task)
+    except KeyError:
         print(f"Warning: No data loaded for {task} detection")
         # Return empty arrays with correct shapes
         return np.array([]).reshape(0, IMG_SIZE, IMG_SIZE, 1), np.array([]).reshape(0, 2)
 
-    X = np.array(X_list)
-    y = np.array(y_list)
-
     # Convert labels to categorical
     y_categorical = to_categorical(y, num_classes=len(categories))
 
@@ -574,47 +702,20 @@ def load_processed_data(split='train', task='eye'):
     return X, y_categorical
 
 def load_feature_data(split='train', task='eye'):
-    """Load extracted features"""
+    """Load extracted features (memory-mapped from the consolidated split file)"""
     print(f"Loading {split} feature data for {task} detection...")
+    categories = TASK_CATEGORIES[task]
 
-    if task == 'eye':
-        categories = ['Closed', 'Open']
-    else:  # task == 'yawn'
-        categories = ['no_yawn', 'yawn']
-
-    X_list = []
-    y_list = []
-
-    for i, category in enumerate(categories):
-        category_path = os.path.join(FEATURES_DIR, split, category)
-
-        if not os.path.exists(category_path):
-            print(f"Warning: Category path {category_path} does not exist")
-            continue
-
-        files = [f for f in os.listdir(category_path) if f.endswith('.npy')]
+    if not os.path.exists(os.path.join(FEATURES_DIR, CONSOLIDATED_INDEX)):
+        print(f"Warning: No feature data index in {FEATURES_DIR}")
+        return np.array([]).reshape(0, FEATURE_DIM), np.array([]).reshape(0, 2)
 
-        if len(files) == 0:
-            print(f"Warning: No feature files found in {category_path}")
-            continue
-
-        for file in files:
-            # Load features
-            file_path = os.path.join(category_path, file)
-            features = np.load(file_path)
-
-            # Add to lists
-            X_list.append(features)
-            y_list.append(i)
-
-    # Convert to numpy arrays
-    if len(X_list) == 0:
+    try:
+        X, y = open_consolidated(FEATURES_DIR, split, task)
+    except KeyError:
         print(f"Warning: No feature data loaded for {task} detection")
         # Return empty arrays with correct shapes
-        return np.array([]).reshape(0, 7*7*1280), np.array([]).reshape(0, 2)
-
-    X = np.array(X_list)
-    y = np.array(y_list)
+        return np.array([]).reshape(0, FEATURE_DIM), np.array([]).reshape(0, 2)
 
     # Convert labels to categorical
     y_categorical = to_categorical(y, num_classes=len(categories))
@@ -1128,53 +1229,20 @@ def save_to_drive():
             os.path.join(DRIVE_OUTPUT_DIR, log_file)
         )
 
-    # Copy sample processed data to Drive
-    processed_dir = os.path.join(DRIVE_OUTPUT_DIR, 'processed_samples')
-    os.makedirs(processed_dir, exist_ok=True)
-
-    for split in ['train', 'val', 'test']:
-        split_dir = os.path.join(PROCESSED_DIR, split)
-        if os.path.exists(split_dir):
-            for category in os.listdir(split_dir):
-                category_dir = os.path.join(split_dir, category)
-                if os.path.isdir(category_dir):
-                    # Create directory in Drive
-                    drive_category_dir = os.path.join(processed_dir, split, category)
-                    os.makedirs(drive_category_dir, exist_ok=True)
-
-                    # Copy a few sample files
-                    files = [f for f in os.listdir(category_dir) if f.endswith('.npy')]
-                    sample_files = files[:5] if len(files) > 5 else files
-
-                    for file in sample_files:
-                        shutil.copy(
-                            os.path.join(category_dir, file),
-                            os.path.join(drive_category_dir, file)
-                        )
-
-    # Copy sample feature data to Drive
-    features_dir = os.path.join(DRIVE_OUTPUT_DIR, 'feature_samples')
-    os.makedirs(features_dir, exist_ok=True)
-
-    for split in ['train', 'val', 'test']:
-        split_dir = os.path.join(FEATURES_DIR, split)
-        if os.path.exists(split_dir):
-            for category in os.listdir(split_dir):
-                category_dir = os.path.join(split_dir, category)
-                if os.path.isdir(category_dir):
-                    # Create directory in Drive
-                    drive_category_dir = os.path.join(features_dir, split, category)
-                    os.makedirs(drive_category_dir, exist_ok=True)
-
-                    # Copy a few sample files
-                    files = [f for f in os.listdir(category_dir) if f.endswith('.npy')]
-                    sample_files = files[:5] if len(files) > 5 else files
-
-                    for file in sample_files:
-                        shutil.copy(
-                            os.path.join(category_dir, file),
-                            os.path.join(drive_category_dir, file)
-                        )
+    # Copy sample processed data and features to Drive (first rows of every category)
+    for source_dir, samples_name in ((PROCESSED_DIR, 'processed_samples'), (FEATURES_DIR, 'feature_samples')):
+        if not os.path.exists(os.path.join(source_dir, CONSOLIDATED_INDEX)):
+            continue
+        with open(os.path.join(source_dir, CONSOLIDATED_INDEX)) as f:
+            entries = json.load(f)['entries']
+        for key, entry in entries.items():
+            split = key.split('_')[0]
+            X = np.load(os.path.join(source_dir, entry['file']), mmap_mode='r')
+            for category, (start, stop) in entry['categories'].items():
+                # Create directory in Drive
+                drive_category_dir = os.path.join(DRIVE_OUTPUT_DIR, samples_name, split, category)
+                os.makedirs(drive_category_dir, exist_ok=True)
+                np.save(os.path.join(drive_category_dir, 'samples.npy'), X[start:min(stop, start + 5)])
 
     print(f"Models, results, and samples saved to Google Drive: {DRIVE_OUTPUT_DIR}")
 
@@ -40,14 +40,17 @@ base_model = MobileNetV2(weights="imagenet", include_top=False, input_shape=(224
 base_model.trainable = False  # Freeze the model
 
 # Step 5: Function for Batch Processing
-def preprocess_and_extract(image_batch, model):
-    features = []
-    for img in image_batch:
-        resized_img = cv2.resize(img, IMG_SIZE)  # Resize on-the-fly (no full dataset in RAM)
-        processed_img = preprocess_input(resized_img)  # Normalize
-        extracted_feature = model.predict(np.expand_dims(processed_img, axis=0), verbose=0)  # Suppress logs
-        features.append(extracted_feature)
-    return np.array(features)
+# Compiled forward pass: one call per batch instead of one predict() per image
+@tf.function(input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.float32)])
+def forward(batch):
+    return base_model(batch, training=False)
+
+def preprocess_and_extract(image_batch):
+    resized_batch = np.stack([cv2.resize(img, IMG_SIZE) for img in image_batch])  # Resize on-the-fly (no full dataset in RAM)
+    processed_batch = preprocess_input(resized_batch.astype(np.float32))  # Normalize
+    batch_features = forward(processed_batch).numpy()
+    # Keep the (N, 1, 7, 7, 1280) layout of the per-image version expected by the baseline model
+    return np.expand_dims(batch_features, axis=1)
 
 # Step 6: Extract Features in Batches (Memory Efficient)
 batch_size = 64  # Small batches prevent RAM crash
@@ -58,7 +61,7 @@ for i in range(0, len(X), batch_size):
         print(f"Processing batch {i} to {i+batch_size}")
 
     batch = X[i:i+batch_size]  # Take small batch
-    batch_features = preprocess_and_extract(batch, base_model)  # Extract features for batch
+    batch_features = preprocess_and_extract(batch)  # Extract features for batch
     X_features_list.append(batch_features)
 
 X_features = np.concatenate(X_features_list, axis=0)  # Convert list to numpy array after all batches are processed
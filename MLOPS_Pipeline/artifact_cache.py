@@ -0,0 +1,155 @@
+"""
+Agent-local, content-addressed cache of ClearML artifacts for the steps that read the
+same artifact over and over (the Step 2 features in Step 3, every HPO trial and Step 5).
+Entries are keyed by the artifact's content hash, or by its URL when it has none. An
+artifact is downloaded once and hard-linked out of the ClearML download cache into the
+entry (copied only across file systems), and an npz artifact is decompressed once into
+an "<archive>.mmap" folder of .npy members next to it, which feature_io memory-maps
+read-only instead of inflating the archive again. Consumers read the entry in place.
+The cache is bounded by a size budget with least-recently-used eviction, like the
+feature store. Entries are built in a temporary folder and renamed into place, so trials
+on the same agent can fetch the same artifact concurrently.
+"""
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+
+from feature_io import extract_npz_members
+from local_clearml import link_tree
+
+# Disk budget of the cache; least recently used entries are evicted beyond it
+DEFAULT_MAX_SIZE_GB = 50.0
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "artifacts")
+
+
+def artifact_key(artifact):
+    """Cache key of a ClearML artifact: its content hash, or a digest of its URL when it has none."""
+    if getattr(artifact, "hash", None):
+        return artifact.hash
+    return "url-" + hashlib.sha256(str(artifact.url).encode()).hexdigest()
+
+
+def _tree_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+class ArtifactCache:
+    """Cached artifacts of this agent, with hit/miss stats and LRU eviction."""
+
+    def __init__(self, root=None, max_size_gb=DEFAULT_MAX_SIZE_GB):
+        self.root = root or default_cache_dir()
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _entry_path(self, entry_dir):
+        """The artifact file or folder in an entry (the one name besides its .mmap folder)."""
+        names = [name for name in os.listdir(entry_dir) if not name.endswith(".mmap")]
+        return os.path.join(entry_dir, names[0])
+
+    def _build(self, entry_dir, artifact):
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        local_copy = artifact.get_local_copy()
+        entry_path = os.path.join(tmp_dir, os.path.basename(os.path.normpath(local_copy)))
+        link_tree(local_copy, entry_path)
+        if os.path.isfile(entry_path) and zipfile.is_zipfile(entry_path) and entry_path.endswith(".npz"):
+            with zipfile.ZipFile(entry_path) as archive:
+                members = [name[:-len(".npy")] for name in archive.namelist() if name.endswith(".npy")]
+            extract_npz_members(entry_path, members)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process built the entry first; use that one
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_local_copy(self, artifact):
+        """
+        Path of artifact in the cache, downloading and unpacking it only on a miss. Treat it
+        as read-only: it is shared with every other consumer on this agent.
+        """
+        started = time.time()
+        key = artifact_key(artifact)
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            self.hits += 1
+            os.utime(entry_dir)
+            outcome = "hit"
+        else:
+            self.misses += 1
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            self._build(entry_dir, artifact)
+            self.enforce_budget(keep=entry_dir)
+            outcome = "miss"
+        print(f"Artifact cache {outcome} for {artifact.name} ({key[:12]}) in {time.time() - started:.1f}s")
+        return self._entry_path(entry_dir)
+
+    def _entries(self):
+        """(last use, size, entry folder) of every complete entry."""
+        entries = []
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, name)
+                if not name.endswith(".tmp"):
+                    entries.append((os.stat(entry_dir).st_mtime, _tree_size(entry_dir), entry_dir))
+        return entries
+
+    def enforce_budget(self, keep=None):
+        """Evict least-recently-used entries (never keep) until the cache fits in max_size_gb."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            # Readers that already opened or memory-mapped the files keep them until they close
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+        return total
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "entries": len(entries),
+            "size_gb": sum(size for _, size, _ in entries) / 1024 ** 3,
+            "max_size_gb": self.max_bytes / 1024 ** 3,
+        }
+
+    def report(self, logger):
+        """Print the cache stats and report them to logger, as the feature store's are."""
+        stats = self.stats()
+        print(f"Artifact cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries, "
+              f"{stats['size_gb']:.2f}/{stats['max_size_gb']:.1f} GB, {stats['evicted']} evicted")
+        for series in ("hits", "misses", "size_gb", "evicted"):
+            logger.report_scalar(title="artifact_cache", series=series, value=stats[series], iteration=0)
+
+
+def cached_local_copy(artifact, cache=None, logger=None):
+    """artifact.get_local_copy() through the agent's artifact cache, reporting its stats to logger."""
+    cache = cache or ArtifactCache()
+    path = cache.get_local_copy(artifact)
+    if logger is not None:
+        cache.report(logger)
+    return path
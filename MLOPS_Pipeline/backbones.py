@@ -0,0 +1,165 @@
+"""
+Registry of feature-extraction backbones for Step 2.
+  mobilenet_v2         alpha 0.35-1.4, ImageNet weights for 96/128/160/192/224 px, with
+                       the original Step 2 input scaling (see below)
+  mobilenet_v2_scaled  the same, with inputs scaled to the [-1, 1] the weights expect
+  mobilenet_v3_small   alpha 0.75 or 1.0
+  efficientnet_lite0-4 TF Hub feature vectors (pooled 1280-d output); needs the optional
+                       tensorflow_hub package
+build_backbone() returns a model that takes the unit-range images produced by
+batched_inference at the stored (Step 1) resolution, resizes them to the backbone input
+size and applies the backbone's own input scaling, so every backend and feature head
+works unchanged whichever backbone is selected. mobilenet_v2 keeps the original Step 2
+scaling, preprocess_input applied to unit-range pixels, so its features match existing
+artifacts and stores; that squeezes its inputs into about [-1, -0.99], so compare it with
+the other backbones through mobilenet_v2_scaled. sweep_backbones() measures CPU latency,
+feature size and downstream head accuracy for a list of configurations.
+"""
+import time
+
+import tensorflow as tf
+from tensorflow.keras.layers import Rescaling, Resizing
+
+from batched_inference import compile_forward, extract_features
+from feature_heads import attach_feature_head
+from head_evaluation import head_accuracy
+
+BACKBONES = {
+    "mobilenet_v2": {"alphas": (0.35, 0.5, 0.75, 1.0, 1.3, 1.4), "input_sizes": (96, 128, 160, 192, 224),
+                     # Same scaling as the original Step 2 (preprocess_input on unit-range
+                     # pixels), so default features match existing artifacts and stores
+                     "preprocessing": "unit_range+mobilenet_v2.preprocess_input", "legacy_scaling": True},
+    "mobilenet_v2_scaled": {"alphas": (0.35, 0.5, 0.75, 1.0, 1.3, 1.4), "input_sizes": (96, 128, 160, 192, 224),
+                            "preprocessing": "unit_range*2-1"},
+    "mobilenet_v3_small": {"alphas": (0.75, 1.0), "input_sizes": None,
+                           "preprocessing": "unit_range*255+mobilenet_v3.include_preprocessing"},
+}
+_EFFICIENTNET_LITE_SIZES = (224, 240, 260, 280, 300)
+for _variant, _size in enumerate(_EFFICIENTNET_LITE_SIZES):
+    BACKBONES[f"efficientnet_lite{_variant}"] = {
+        "alphas": (1.0,), "input_sizes": (_size,), "preprocessing": "unit_range",
+        "hub_handle": f"https://tfhub.dev/tensorflow/efficientnet/lite{_variant}/feature-vector/2"}
+
+DEFAULT_BACKBONE = "mobilenet_v2"
+DEFAULT_ALPHA = 1.0
+DEFAULT_INPUT_SIZE = 224
+
+
+def backbone_id(name, alpha, input_size):
+    return f"{name}_{float(alpha)}_{int(input_size)}"
+
+
+def backbone_namespace(name, alpha, input_size):
+    """Feature-store namespace fields; the default backbone keeps its original namespace."""
+    if (name, float(alpha), int(input_size)) == (DEFAULT_BACKBONE, DEFAULT_ALPHA, DEFAULT_INPUT_SIZE):
+        return {"backbone": name, "preprocessing": BACKBONES[name]["preprocessing"]}
+    return {"backbone": backbone_id(name, alpha, input_size), "preprocessing": BACKBONES[name]["preprocessing"]}
+
+
+def parse_backbone_list(text):
+    """Parse "name:alpha:input_size,..." (alpha and size optional) into (name, alpha, input_size) tuples."""
+    configs = []
+    for item in str(text).split(","):
+        parts = item.strip().split(":")
+        if not parts[0]:
+            continue
+        alpha = float(parts[1]) if len(parts) > 1 else DEFAULT_ALPHA
+        input_size = int(parts[2]) if len(parts) > 2 else None
+        configs.append((parts[0], alpha, input_size))
+    return configs
+
+
+class _HubFeatureVector(tf.keras.layers.Layer):
+    """A TF Hub feature-vector SavedModel called as a Keras layer."""
+
+    def __init__(self, handle, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import tensorflow_hub as hub
+        except ImportError as e:
+            raise ImportError("EfficientNet-Lite backbones need the tensorflow_hub package") from e
+        self.module = hub.load(handle)
+
+    def call(self, inputs):
+        return self.module(inputs)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], 1280)
+
+
+def resolve_input_size(name, input_size=None):
+    """Validate input_size for backbone name, defaulting to its largest supported size."""
+    if name not in BACKBONES:
+        raise ValueError(f"Unknown backbone '{name}', expected one of {tuple(BACKBONES)}")
+    spec = BACKBONES[name]
+    if input_size is None or int(input_size) <= 0:
+        return spec["input_sizes"][-1] if spec["input_sizes"] else DEFAULT_INPUT_SIZE
+    if spec["input_sizes"] and int(input_size) not in spec["input_sizes"]:
+        raise ValueError(f"Backbone {name} supports input sizes {spec['input_sizes']}, got {input_size}")
+    return int(input_size)
+
+
+def build_backbone(name=DEFAULT_BACKBONE, alpha=DEFAULT_ALPHA, input_size=None, source_shape=(224, 224, 3),
+                   weights="imagenet"):
+    """Feature extractor for unit-range images of source_shape (see module docstring)."""
+    input_size = resolve_input_size(name, input_size)
+    spec = BACKBONES[name]
+    alpha = float(alpha)
+    if alpha not in spec["alphas"]:
+        raise ValueError(f"Backbone {name} supports alpha {spec['alphas']}, got {alpha}")
+    input_shape = (input_size, input_size, 3)
+
+    inputs = tf.keras.Input(shape=tuple(source_shape))
+    x = inputs
+    if tuple(source_shape[:2]) != input_shape[:2]:
+        x = Resizing(input_size, input_size)(x)
+    if name in ("mobilenet_v2", "mobilenet_v2_scaled"):
+        x = Rescaling(1 / 127.5, offset=-1.0)(x) if spec.get("legacy_scaling") else Rescaling(2.0, offset=-1.0)(x)
+        backbone = tf.keras.applications.MobileNetV2(input_shape=input_shape, alpha=alpha, include_top=False,
+                                                     weights=weights)
+    elif name == "mobilenet_v3_small":
+        x = Rescaling(255.0)(x)
+        backbone = tf.keras.applications.MobileNetV3Small(input_shape=input_shape, alpha=alpha, include_top=False,
+                                                          weights=weights, include_preprocessing=True)
+    else:
+        backbone = _HubFeatureVector(spec["hub_handle"], name=name)
+    return tf.keras.Model(inputs=inputs, outputs=backbone(x), name=backbone_id(name, alpha, input_size))
+
+
+def sweep_backbones(configs, X_train, y_train, X_test, y_test, feature_head, batch_size=64, epochs=5,
+                    weights="imagenet"):
+    """
+    Extract features with each (name, alpha, input_size) config and return
+    {backbone_id: {"latency_ms", "feature_dim", "params", "accuracy"}} (or {"error"} when
+    the backbone cannot be built). Latency is the mean per-image time of batched CPU
+    inference on X_test; accuracy is that of the same small dense head trained on each
+    backbone's features. Results of backbones that keep a legacy input scaling carry a
+    "note" saying so, as their accuracy is not comparable with the others.
+    """
+    report = {}
+    for name, alpha, input_size in configs:
+        key = f"{name}_{alpha}_{input_size}"
+        try:
+            input_size = resolve_input_size(name, input_size)
+            key = backbone_id(name, alpha, input_size)
+            model = build_backbone(name, alpha, input_size, source_shape=X_train.shape[1:], weights=weights)
+            model = attach_feature_head(model, feature_head)
+        except (ValueError, ImportError) as e:
+            report[key] = {"error": str(e)}
+            continue
+        forward = compile_forward(model)
+        forward(tf.zeros((1,) + tuple(model.input_shape[1:])))  # trace before timing
+        train_features, _ = extract_features(X_train, model, batch_size=batch_size, forward=forward, log_every=10 ** 9)
+        start_time = time.time()
+        test_features, _ = extract_features(X_test, model, batch_size=batch_size, forward=forward, log_every=10 ** 9)
+        elapsed = time.time() - start_time
+        report[key] = {
+            "latency_ms": 1000.0 * elapsed / max(len(X_test), 1),
+            "feature_dim": int(train_features[0].size),
+            "params": int(model.count_params()),
+            "accuracy": head_accuracy(train_features, y_train, test_features, y_test, epochs=epochs),
+        }
+        if BACKBONES[name].get("legacy_scaling"):
+            report[key]["note"] = ("legacy Step 2 input scaling (inputs in about [-1, -0.99]); "
+                                   "sweep mobilenet_v2_scaled for an accuracy comparable with the others")
+    return report
@@ -0,0 +1,114 @@
+"""
+Batched feature extraction for Step 2 (Feature Extraction).
+Images are streamed through a tf.data pipeline that slices batches out of the (possibly
+memory-mapped) dataset, normalizes them in parallel and prefetches, so preprocessing of
+batch N+1 overlaps the forward pass of batch N. The forward pass itself is a compiled
+tf.function with a fixed input signature, so the last partial batch does not retrace.
+With a FeatureStore, cached images are served from the store and only misses are batched
+through the network. extract_into writes into a caller-provided (possibly memory-mapped)
+array, which is how feature_writer streams features to disk.
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from feature_store import array_digest
+
+
+def make_image_dataset(X, batch_size, indices=None, start=0, stop=None):
+    """
+    tf.data pipeline yielding unit-range float32 batches from X (ndarray or ShardedSplit);
+    backbones built by backbones.build_backbone apply their own input scaling.
+    With indices, only those images are batched (in the given order); otherwise the
+    contiguous range X[start:stop].
+    """
+    stop = len(X) if stop is None else min(stop, len(X))
+    image_shape = tuple(X.shape[1:])
+    source_dtype = np.dtype(X.dtype)
+
+    def batches():
+        if indices is None:
+            for offset in range(start, stop, batch_size):
+                yield np.asarray(X[offset:min(offset + batch_size, stop)])
+        else:
+            for offset in range(0, len(indices), batch_size):
+                yield np.stack([np.asarray(X[i]) for i in indices[offset:offset + batch_size]])
+
+    def to_model_input(batch):
+        batch = tf.cast(batch, tf.float32)
+        if source_dtype == np.uint8:
+            # uint8 artifacts are scaled to [0, 1] here, so they match legacy float artifacts
+            batch = batch / 255.0
+        return batch
+
+    dataset = tf.data.Dataset.from_generator(
+        batches, output_signature=tf.TensorSpec(shape=(None,) + image_shape, dtype=tf.as_dtype(source_dtype)))
+    return dataset.map(to_model_input, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+def compile_forward(model):
+    """Wrap model in a tf.function with a batch-size-agnostic input signature."""
+    input_spec = tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)
+    return tf.function(lambda batch: model(batch, training=False), input_signature=[input_spec])
+
+
+def extract_into(out, X, model, start=0, stop=None, batch_size=64, forward=None, log_every=10, store=None):
+    """
+    Run model over X[start:stop] in batches, writing the features of X[i] to out[i - start].
+    forward defaults to the compiled Keras model; any callable mapping a model-ready batch
+    to features (see inference_backends) can be used instead.
+    out may be a memory-mapped array, so nothing larger than one batch is held in memory.
+    With a FeatureStore, images whose content hash is already stored are not run through
+    the model, and fresh features are added to the store. Returns the number of images run.
+    """
+    stop = len(X) if stop is None else min(stop, len(X))
+    total = stop - start
+
+    pending = None
+    keys = None
+    if store is not None:
+        keys = {}
+        misses = []
+        for i in range(start, stop):
+            key = array_digest(X[i])
+            entry = store.get(key)
+            if entry is not None:
+                out[i - start] = entry
+            else:
+                keys[i] = key
+                misses.append(i)
+        pending = np.array(misses, dtype=np.int64)
+        print(f"Feature store: {total - len(pending)}/{total} images cached, extracting {len(pending)}")
+
+    num_pending = total if pending is None else len(pending)
+    if num_pending > 0:
+        forward = forward or compile_forward(model)
+        offset = 0
+        for batch_idx, batch in enumerate(make_image_dataset(X, batch_size, indices=pending, start=start, stop=stop)):
+            if batch_idx % log_every == 0:
+                print(f"Processing image {offset}/{num_pending}")
+            batch_features = np.asarray(forward(batch))
+            if pending is None:
+                out[offset:offset + len(batch_features)] = batch_features
+            else:
+                for i, image_features in zip(pending[offset:offset + len(batch_features)], batch_features):
+                    out[i - start] = image_features
+                    if keys is not None:
+                        store.put(keys[i], image_features)
+            offset += len(batch_features)
+    return num_pending
+
+
+def extract_features(X, model, batch_size=64, forward=None, log_every=10, store=None):
+    """
+    Run model over X in batches and return (features, images_per_sec). features is a
+    float32 array of shape (len(X),) + model output shape, held in memory; use
+    extract_into (or feature_writer) to stream large splits to disk instead.
+    """
+    features = np.empty((len(X),) + tuple(model.output_shape[1:]), dtype=np.float32)
+    start_time = time.time()
+    extract_into(features, X, model, batch_size=batch_size, forward=forward, log_every=log_every, store=store)
+    elapsed = time.time() - start_time
+    images_per_sec = len(X) / elapsed if elapsed > 0 else 0.0
+    return features, images_per_sec
@@ -0,0 +1,192 @@
+"""
+Helpers for reading and writing the preprocessed image dataset produced by Step 1.
+Images are stored as raw uint8 pixels and normalized lazily by the consumer, which keeps
+the artifact 8x smaller than the legacy float64 layout. Legacy float artifacts (already
+scaled to [0, 1]) are still accepted everywhere.
+The default artifact is a directory of fixed-size .npy shards plus a JSON index, written
+incrementally by Step 1 and memory-mapped by its consumers; legacy .npz files still load.
+"""
+import json
+import os
+
+import numpy as np
+
+STORAGE_DTYPES = ("uint8", "float64")
+
+
+def to_storage_dtype(images, storage_dtype):
+    """Convert decoded uint8 images to the requested on-disk storage dtype."""
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage_dtype '{storage_dtype}', expected one of {STORAGE_DTYPES}")
+    if storage_dtype == "uint8":
+        return images.astype(np.uint8, copy=False)
+    return images / 255.0
+
+
+def normalize_images(images):
+    """Return images as float32 in [0, 1], whichever storage dtype they were saved with."""
+    if images.dtype == np.uint8:
+        return images.astype(np.float32) / 255.0
+    return images.astype(np.float32, copy=False)
+
+
+# --- Sharded, memory-mappable dataset format ---
+# <root>/index.json            image shape, dtype, shard size, labels and shard list per split
+# <root>/<split>_00000.npy     fixed-size image shards (the last shard of a split may be short)
+# <root>/<split>_<name>.npy     optional small per-sample arrays listed under the split's "arrays"
+
+SHARD_INDEX = "index.json"
+SHARD_FORMAT_VERSION = 1
+
+
+class ShardWriter:
+    """Buffers images for one split and writes them out as fixed-size .npy shards."""
+
+    def __init__(self, root, split, shard_size, image_shape, dtype):
+        self.root = root
+        self.split = split
+        self.shard_size = int(shard_size)
+        self.buffer = np.empty((self.shard_size,) + tuple(image_shape), dtype=dtype)
+        self.filled = 0
+        self.shards = []
+        self.labels = []
+        os.makedirs(root, exist_ok=True)
+
+    def add(self, images, labels):
+        self.labels.extend(int(label) for label in labels)
+        offset = 0
+        while offset < len(images):
+            take = min(self.shard_size - self.filled, len(images) - offset)
+            self.buffer[self.filled:self.filled + take] = images[offset:offset + take]
+            self.filled += take
+            offset += take
+            if self.filled == self.shard_size:
+                self._flush()
+
+    def _flush(self):
+        if self.filled == 0:
+            return
+        name = f"{self.split}_{len(self.shards):05d}.npy"
+        np.save(os.path.join(self.root, name), self.buffer[:self.filled])
+        self.shards.append({"file": name, "count": self.filled})
+        self.filled = 0
+
+    def close(self, arrays=None):
+        """
+        Write the trailing partial shard and return this split's index entry. `arrays`
+        maps names to small per-sample arrays saved next to the shards.
+        """
+        self._flush()
+        entry = {"count": len(self.labels), "shards": self.shards, "labels": self.labels, "arrays": {}}
+        for name, values in (arrays or {}).items():
+            file_name = f"{self.split}_{name}.npy"
+            np.save(os.path.join(self.root, file_name), values)
+            entry["arrays"][name] = file_name
+        return entry
+
+
+def write_shard_index(root, splits, image_shape, dtype, shard_size, metadata=None):
+    index = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "image_shape": list(image_shape),
+        "dtype": np.dtype(dtype).name,
+        "shard_size": int(shard_size),
+        "splits": splits,
+        "metadata": metadata or {},
+    }
+    with open(os.path.join(root, SHARD_INDEX), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+class ShardedSplit:
+    """
+    Read-only view over one split of a sharded dataset. Shards are opened with
+    np.load(mmap_mode='r'), so only the pages actually touched are read into memory.
+    Supports len(), iteration over single images, slicing and iter_batches().
+    """
+
+    def __init__(self, root, entry, image_shape, dtype):
+        self.shards = [np.load(os.path.join(root, shard["file"]), mmap_mode="r") for shard in entry["shards"]]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.labels = np.array(entry["labels"], dtype=np.int64)
+        self.arrays = {name: np.load(os.path.join(root, file_name))
+                       for name, file_name in entry.get("arrays", {}).items()}
+        self.shape = (int(self.offsets[-1]),) + tuple(image_shape)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for shard in self.shards:
+            for img in shard:
+                yield img
+
+    def read(self, start, stop):
+        """Return images[start:stop] as one array (a zero-copy view when it fits in one shard)."""
+        start, stop = max(0, start), min(stop, len(self))
+        if start >= stop:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        parts = []
+        first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        for shard_idx in range(first, len(self.shards)):
+            shard_start = self.offsets[shard_idx]
+            if shard_start >= stop:
+                break
+            parts.append(self.shards[shard_idx][max(start - shard_start, 0):stop - shard_start])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("ShardedSplit only supports contiguous slices")
+            return self.read(start, stop)
+        if key < 0:
+            key += len(self)
+        return self.read(key, key + 1)[0]
+
+    def iter_batches(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield self.read(start, start + batch_size)
+
+
+def is_sharded_dataset(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SHARD_INDEX))
+
+
+def find_sharded_dataset(path):
+    """Return the sharded dataset directory at or below path (ClearML may wrap folder artifacts)."""
+    if os.path.isdir(path) and not is_sharded_dataset(path):
+        for root, _, files in os.walk(path):
+            if SHARD_INDEX in files:
+                return root
+    return path
+
+
+def open_sharded_dataset(path):
+    """Return (index, {split: ShardedSplit}) for a sharded dataset directory."""
+    path = find_sharded_dataset(path)
+    with open(os.path.join(path, SHARD_INDEX)) as f:
+        index = json.load(f)
+    splits = {split: ShardedSplit(path, entry, index["image_shape"], index["dtype"])
+              for split, entry in index["splits"].items()}
+    return index, splits
+
+
+def open_processed_data(path):
+    """
+    Open a Step 1 processed_data artifact, either a sharded directory or a legacy .npz.
+    Returns a mapping with X_train, X_test, y_train and y_test. For sharded datasets the X
+    entries are memory-mapped ShardedSplit views; .npz members are loaded on first access.
+    """
+    path = find_sharded_dataset(path)
+    if is_sharded_dataset(path):
+        _, splits = open_sharded_dataset(path)
+        data = {}
+        for split in ("train", "test"):
+            data[f"X_{split}"] = splits[split]
+            data[f"y_{split}"] = splits[split].labels
+        return data
+    return np.load(path)
@@ -0,0 +1,63 @@
+"""
+Streaming tf.data input for training heads on Step 2 features.
+Only sample indices go through the shuffle buffer; the feature rows of each batch are
+read from the memory-mapped FeatureView (and dequantized) when the batch is produced,
+and batches are prefetched so the next read overlaps training on the current one.
+Peak memory is therefore a few batches, whatever the dataset size. With cache, the
+decoded rows are read once and kept in memory, for datasets that fit.
+Labels may be a dict of per-output arrays, with matching per-sample weights, for the
+multi-task model.
+"""
+import numpy as np
+import tensorflow as tf
+
+from feature_io import FeatureView
+
+# Rows read per call when filling the in-memory cache
+_CACHE_CHUNK = 256
+
+
+def make_feature_dataset(X, y, batch_size, shuffle=False, shuffle_buffer=10000, cache=False, seed=None,
+                         sample_weight=None):
+    """
+    tf.data.Dataset of (features, labels) batches over a FeatureView (or array) X and
+    labels y. Labels are cast to float32 for the sigmoid heads. y may be a dict of label
+    arrays keyed by output name; sample_weight (a dict with the same keys) adds a third
+    element to every batch.
+    """
+    total = len(X)
+    feature_dim = int(X.shape[1])
+    label_keys = sorted(y) if isinstance(y, dict) else None
+    columns = [np.asarray(y[key], dtype=np.float32) for key in label_keys] if label_keys \
+        else [np.asarray(y, dtype=np.float32)]
+    if sample_weight is not None:
+        columns += [np.asarray(sample_weight[key], dtype=np.float32) for key in label_keys]
+
+    def read_rows(indices):
+        indices = np.asarray(indices)
+        rows = X.take(indices) if isinstance(X, FeatureView) else np.asarray(X[indices])
+        return [rows.astype(np.float32, copy=False)] + [column[indices] for column in columns]
+
+    def load(indices):
+        rows, *batch_columns = tf.numpy_function(read_rows, [indices], [tf.float32] * (1 + len(columns)))
+        rows.set_shape((None, feature_dim))
+        for batch_column, column in zip(batch_columns, columns):
+            batch_column.set_shape((None,) + column.shape[1:])
+        if label_keys is None:
+            return rows, batch_columns[0]
+        batch_labels = dict(zip(label_keys, batch_columns[:len(label_keys)]))
+        if sample_weight is None:
+            return rows, batch_labels
+        return rows, batch_labels, dict(zip(label_keys, batch_columns[len(label_keys):]))
+
+    dataset = tf.data.Dataset.range(total)
+    if cache:
+        dataset = dataset.batch(_CACHE_CHUNK).map(load).unbatch().cache()
+        if shuffle:
+            dataset = dataset.shuffle(min(shuffle_buffer, total) or 1, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(min(shuffle_buffer, total) or 1, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size).map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
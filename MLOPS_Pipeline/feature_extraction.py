@@ -2,70 +2,316 @@ from clearml import Task
 import numpy as np
 import os
 import cv2
-from tensorflow.keras.applications import MobileNetV2
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
 from sklearn.model_selection import train_test_split
 
-# Create the task
-task = Task.init(project_name="BNM Pipeline", task_name="Step 2 - Feature Extraction")
-
-# Fix numpy version issue by adding requirements directly to the task
-task.add_requirements("numpy", ">=1.19.5,<2.0.0")
-
-# Get the preprocessed data from the previous step
-preprocessed_data_path = Task.get_task(task_name="Step 1 - Smart Data Preprocessing (Deep Scan)", 
-                                      project_name="BNM Pipeline").artifacts['processed_data'].get_local_copy()
-
-print(f"Loading preprocessed data from: {preprocessed_data_path}")
-
-# Load the preprocessed data
-data = np.load(preprocessed_data_path)
-X_train = data['X_train']
-X_test = data['X_test']
-y_train = data['y_train']
-y_test = data['y_test']
-
-print(f"Loaded data shapes: X_train: {X_train.shape}, X_test: {X_test.shape}")
-print(f"Label shapes: y_train: {y_train.shape}, y_test: {y_test.shape}")
-
-# Create feature extractor model
-base_model = MobileNetV2(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-
-# Extract features
-def extract_features(X):
-    features = []
-    total = len(X)
-    for i, img in enumerate(X):
-        if i % 100 == 0:
-            print(f"Processing image {i}/{total}")
-        img = preprocess_input(img)
-        features.append(base_model.predict(np.expand_dims(img, axis=0), verbose=0))
-    return np.array(features)
-
-print("Extracting features from training data...")
-X_train_feat = extract_features(X_train)
-print("Extracting features from test data...")
-X_test_feat = extract_features(X_test)
-
-print(f"Feature shapes: X_train_feat: {X_train_feat.shape}, X_test_feat: {X_test_feat.shape}")
-'''
-# Save features
-np.savez_compressed('features.npz', X_train_feat=X_train_feat, X_test_feat=X_test_feat)
-
-# Save labels for the next step
-np.savez_compressed('processed_data.npz', y_train=y_train, y_test=y_test, X_train=X_train, X_test=X_test)
-'''
-
-np.savez_compressed('features.npz',
-                    X_train_feat=X_train_feat,
-                    X_test_feat=X_test_feat,
-                    y_train=y_train,
-                    y_test=y_test)
-# Upload artifacts
-task.upload_artifact('features', artifact_object='features.npz')
-#task.upload_artifact('processed_data', artifact_object='processed_data.npz')
-
-print("Feature extraction completed successfully!")
-
-# Execute remotely (comment this out when creating the task template)
-# task.execute_remotely()
\ No newline at end of file
+from backbones import (DEFAULT_ALPHA, DEFAULT_BACKBONE, DEFAULT_INPUT_SIZE, backbone_id, backbone_namespace,
+                       build_backbone, parse_backbone_list, resolve_input_size, sweep_backbones)
+from batched_inference import extract_features, extract_into
+from dataset_io import open_processed_data
+from feature_heads import DEFAULT_FEATURE_HEAD, attach_feature_head
+from feature_io import save_features
+from feature_parts import merge_parts, open_feature_parts, part_metadata, part_range
+from feature_quantization import parity_report
+from feature_store import FeatureStore, array_digest, model_weights_digest
+from feature_writer import ResumableFeatureWriter, default_work_dir, run_signature
+from inference_backends import (DEFAULT_INFERENCE_BACKEND, INFERENCE_BACKENDS, benchmark_backends, check_parity,
+                                create_backend)
+from step_cache import upstream_task
+
+TASK_NAME = "Step 2 - Feature Extraction"
+
+
+def is_enabled(value):
+    return str(value).lower() in ("true", "1", "yes")
+
+
+def main():
+    # Create the task
+    task = Task.init(project_name="BNM Pipeline", task_name=TASK_NAME)
+
+    # Fix numpy version issue by adding requirements directly to the task
+    task.add_requirements("numpy", ">=1.19.5,<2.0.0")
+
+    # Extraction settings. feature_head: raw (7x7x1280 map), global_avg, global_max or spatial_NxN.
+    # The feature store reuses features of images already seen with the same extractor.
+    # feature_precision: float32, float16 or int8 (per-channel scale/zero-point) storage; with a
+    # reduced precision the parity report compares head accuracy against float32 features.
+    # Features are streamed to shard_size-image shards in work_dir (default: per task under
+    # ~/.clearml/bnm_cache/feature_runs), so a restarted task resumes from the last completed
+    # shard. output_format "shards" uploads that directory; "npz" assembles features.npz in memory.
+    # inference_backend: keras, tflite (XNNPACK), tflite_int8 (post-training quantized) or onnx,
+    # on num_threads CPU threads (0 = all cores). A non-Keras backend is checked against Keras
+    # on backend_parity_samples images first; benchmark_backends times every backend.
+    # backbone/alpha/input_size pick the extractor from the backbone registry; backbone_sweep
+    # reports latency, feature size and head accuracy for every sweep_backbones entry
+    # ("name:alpha:input_size") on sweep_samples images before extracting with the chosen one.
+    # Fan-out: with num_parts > 1 this task extracts only part part_index of every split and
+    # uploads it as a float32 part; a task with mode "merge" combines the tasks listed in
+    # part_task_ids (comma separated) into the final features artifact.
+    args = {
+        "mode": "extract",
+        "num_parts": 1,
+        "part_index": 0,
+        "part_task_ids": "",
+        "batch_size": 64,
+        "backbone": DEFAULT_BACKBONE,
+        "alpha": DEFAULT_ALPHA,
+        "input_size": DEFAULT_INPUT_SIZE,
+        "backbone_sweep": False,
+        "sweep_backbones": "mobilenet_v2_scaled:1.0:224,mobilenet_v2_scaled:0.75:160,mobilenet_v2_scaled:0.5:128,"
+                           "mobilenet_v2_scaled:0.35:128,mobilenet_v3_small:1.0:224,mobilenet_v3_small:0.75:160,efficientnet_lite0",
+        "sweep_samples": 1024,
+        "feature_head": DEFAULT_FEATURE_HEAD,
+        "use_feature_store": True,
+        "feature_store_dir": "",
+        "feature_store_max_gb": 20.0,
+        "feature_precision": "float32",
+        "compress_features": True,
+        "precision_parity_report": True,
+        "parity_epochs": 5,
+        "parity_max_samples": 4096,
+        "output_format": "shards",
+        "shard_size": 256,
+        "work_dir": "",
+        "inference_backend": DEFAULT_INFERENCE_BACKEND,
+        "num_threads": 0,
+        "backend_parity_samples": 64,
+        "backend_min_cosine": 0.99,
+        "benchmark_backends": False,
+        "benchmark_samples": 256,
+    }
+    args = task.connect(args)
+    logger = task.get_logger()
+
+    if args["mode"] == "merge":
+        merge(task, args, logger)
+    elif args["mode"] == "extract":
+        extract(task, args, logger)
+    else:
+        raise ValueError(f"Unknown mode '{args['mode']}', expected 'extract' or 'merge'")
+
+    print("Feature extraction completed successfully!")
+
+    # Execute remotely (comment this out when creating the task template)
+    # task.execute_remotely()
+
+
+def extract(task, args, logger):
+    batch_size = int(args["batch_size"])
+    feature_head = args["feature_head"]
+    num_parts = int(args["num_parts"])
+    part_index = int(args["part_index"])
+
+    if num_parts > 1:
+        # Parts get their own name, so by-name lookups of Step 2 find the merged artifact
+        task.set_name(f"{TASK_NAME} [part {part_index + 1}/{num_parts}]")
+
+    # Get the preprocessed data from the previous step
+    preprocessing_task = upstream_task("preprocessing", "Step 1 - Smart Data Preprocessing (Deep Scan)",
+                                       project_name="BNM Pipeline")
+    preprocessed_data_path = preprocessing_task.artifacts['processed_data'].get_local_copy()
+
+    print(f"Loading preprocessed data from: {preprocessed_data_path}")
+
+    # Load the preprocessed data (sharded directories are memory-mapped, legacy .npz is read into memory)
+    data = open_processed_data(preprocessed_data_path)
+    X_train = data['X_train']
+    X_test = data['X_test']
+    y_train = data['y_train']
+    y_test = data['y_test']
+
+    print(f"Loaded data shapes: X_train: {X_train.shape}, X_test: {X_test.shape} ({X_train.dtype})")
+    print(f"Label shapes: y_train: {y_train.shape}, y_test: {y_test.shape}")
+
+    if is_enabled(args["backbone_sweep"]):
+        sweep_samples = int(args["sweep_samples"])
+        print(f"Sweeping backbones on {sweep_samples} train / {sweep_samples // 4} test images...")
+        sweep = sweep_backbones(parse_backbone_list(args["sweep_backbones"]),
+                                np.asarray(X_train[:sweep_samples]), y_train[:sweep_samples],
+                                np.asarray(X_test[:sweep_samples // 4]), y_test[:sweep_samples // 4],
+                                feature_head, batch_size=batch_size, epochs=int(args["parity_epochs"]))
+        lines = ["backbone                        latency_ms  feature_dim  params     accuracy"]
+        for name, result in sweep.items():
+            if "error" in result:
+                lines.append(f"{name:<30}  skipped: {result['error']}")
+                continue
+            lines.append(f"{name:<30}  {result['latency_ms']:>10.2f}  {result['feature_dim']:>11}  "
+                         f"{result['params']:>9}  {result['accuracy']:.4f}")
+            if "note" in result:
+                lines.append(f"{'':<30}  note: {result['note']}")
+            for series in ("latency_ms", "feature_dim", "accuracy"):
+                logger.report_scalar(title=f"backbone_sweep_{series}", series=name, value=result[series], iteration=0)
+        logger.report_text("\n".join(lines))
+        print("\n".join(lines))
+
+    # Create feature extractor model
+    backbone = args["backbone"]
+    input_size = resolve_input_size(backbone, args["input_size"])
+    base_model = build_backbone(backbone, args["alpha"], input_size, source_shape=X_train.shape[1:])
+    base_model = attach_feature_head(base_model, feature_head)
+    print(f"Backbone: {base_model.name}, feature head: {feature_head} -> per-image feature shape {base_model.output_shape[1:]}")
+
+    if is_enabled(args["benchmark_backends"]):
+        print("Benchmarking inference backends...")
+        benchmark = benchmark_backends(base_model, np.asarray(X_train[:int(args["benchmark_samples"])]),
+                                       batch_size=batch_size, num_threads=args["num_threads"])
+        lines = ["backend      images/sec  max_abs_error  min_cosine"]
+        for name, result in benchmark.items():
+            if "error" in result:
+                lines.append(f"{name:<11}  skipped: {result['error']}")
+                continue
+            lines.append(f"{name:<11}  {result['images_per_sec']:>10.1f}  {result['max_abs_error']:.6f}       {result['min_cosine']:.6f}")
+            logger.report_scalar(title="backend_benchmark", series=f"{name}_images_per_sec", value=result["images_per_sec"], iteration=0)
+            logger.report_scalar(title="backend_benchmark", series=f"{name}_max_abs_error", value=result["max_abs_error"], iteration=0)
+        logger.report_text("\n".join(lines))
+        print("\n".join(lines))
+
+    inference_backend = args["inference_backend"]
+    if inference_backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference_backend '{inference_backend}', expected one of {INFERENCE_BACKENDS}")
+    forward = create_backend(inference_backend, base_model, args["num_threads"], calibration_data=X_train)
+    print(f"Inference backend: {inference_backend}")
+    if inference_backend != "keras":
+        # Refuse to extract with a backend whose features drift from the Keras reference
+        parity_sample = np.asarray(X_train[:int(args["backend_parity_samples"])])
+        reference, _ = extract_features(parity_sample, base_model, batch_size=batch_size)
+        backend_features, _ = extract_features(parity_sample, base_model, batch_size=batch_size, forward=forward)
+        parity = check_parity(reference, backend_features)
+        print(f"Backend parity vs keras: {parity}")
+        for series, value in parity.items():
+            logger.report_scalar(title="backend_parity", series=series, value=value, iteration=0)
+        if parity["min_cosine"] < float(args["backend_min_cosine"]):
+            raise RuntimeError(f"{inference_backend} features diverge from Keras (min cosine {parity['min_cosine']:.4f} "
+                               f"< {args['backend_min_cosine']})")
+
+    extractor_namespace = {
+        **backbone_namespace(backbone, args["alpha"], input_size),
+        "weights": model_weights_digest(base_model),
+        "input_shape": list(X_train.shape[1:]),
+        "feature_head": feature_head,
+    }
+    if inference_backend != "keras":
+        # Quantized or converted backends produce slightly different features; keep them apart
+        extractor_namespace["inference_backend"] = inference_backend
+
+    store = None
+    if is_enabled(args["use_feature_store"]):
+        store = FeatureStore(args["feature_store_dir"], extractor_namespace, max_size_gb=args["feature_store_max_gb"])
+        print(f"Using feature store at {store.path}")
+
+    # Each part extracts one contiguous range per split; a single task covers everything
+    ranges = {split: part_range(len(X), num_parts, part_index)
+              for split, X in (("train", X_train), ("test", X_test))}
+
+    # Stream features shard by shard into the work directory; completed shards survive a crash
+    work_dir = args["work_dir"] or default_work_dir(task.id)
+    signature = run_signature(extractor=extractor_namespace, source_task=preprocessing_task.id,
+                              labels={"train": array_digest(np.asarray(y_train)), "test": array_digest(np.asarray(y_test))},
+                              shard_size=int(args["shard_size"]), ranges=ranges)
+    writer = ResumableFeatureWriter(work_dir, signature, base_model.output_shape[1:], args["shard_size"])
+    print(f"Writing feature shards to {work_dir}")
+
+    for split, X in (("train", X_train), ("test", X_test)):
+        start, stop = ranges[split]
+        print(f"Extracting features from {split} data [{start}:{stop}] (batch size {batch_size})...")
+        extracted, resumed, images_per_sec = writer.extract_split(
+            split, X, lambda out, start, stop: extract_into(out, X, base_model, start=start, stop=stop,
+                                                            batch_size=batch_size, forward=forward, store=store),
+            start=start, stop=stop)
+        print(f"{split} data: {extracted} images extracted, {resumed} resumed, {images_per_sec:.1f} images/sec")
+        logger.report_scalar(title="feature_extraction", series=f"{split}_images_per_sec", value=images_per_sec, iteration=0)
+        logger.report_scalar(title="feature_extraction", series=f"{split}_resumed_images", value=resumed, iteration=0)
+
+    if store is not None:
+        store.enforce_budget()
+        store_stats = store.stats()
+        print(f"Feature store: {store_stats['hits']} hits, {store_stats['misses']} misses "
+              f"(hit ratio {store_stats['hit_ratio']:.1%}), {store_stats['entries']} entries, "
+              f"{store_stats['size_gb']:.2f}/{store_stats['max_size_gb']:.1f} GB, {store_stats['evicted']} evicted")
+        for series in ("hit_ratio", "misses", "size_gb", "evicted"):
+            logger.report_scalar(title="feature_store", series=series, value=store_stats[series], iteration=0)
+    '''
+    # Save features
+    np.savez_compressed('features.npz', X_train_feat=X_train_feat, X_test_feat=X_test_feat)
+
+    # Save labels for the next step
+    np.savez_compressed('processed_data.npz', y_train=y_train, y_test=y_test, X_train=X_train, X_test=X_test)
+    '''
+
+    labels = {split: y[ranges[split][0]:ranges[split][1]] for split, y in (("train", y_train), ("test", y_test))}
+    backbone_name = backbone_id(backbone, args["alpha"], input_size)
+    if num_parts > 1:
+        # Parts stay float32; precision, the parity report and the final layout are applied at merge
+        metadata = writer.finalize('features', labels, feature_head,
+                                   extra_metadata={"backbone": backbone_name,
+                                                   **part_metadata(part_index, num_parts, ranges)})
+        task.upload_artifact('features', artifact_object='features', metadata=metadata)
+        writer.cleanup()
+        return
+    publish_features(task, args, logger, writer, labels, feature_head, backbone_name)
+
+
+def merge(task, args, logger):
+    part_task_ids = [task_id.strip() for task_id in str(args["part_task_ids"]).split(",") if task_id.strip()]
+    if not part_task_ids:
+        raise ValueError("mode 'merge' needs the extraction task ids in part_task_ids")
+    part_paths = []
+    for task_id in part_task_ids:
+        part_paths.append(Task.get_task(task_id=task_id).artifacts['features'].get_local_copy())
+        print(f"Downloaded features part of task {task_id}: {part_paths[-1]}")
+    parts = open_feature_parts(part_paths)
+    first_metadata = parts[0][1]["metadata"]
+
+    work_dir = args["work_dir"] or default_work_dir(task.id)
+    writer = ResumableFeatureWriter(work_dir, run_signature(parts=part_task_ids), parts[0][1]["image_shape"],
+                                    parts[0][1]["shard_size"])
+    labels = merge_parts(writer, parts)
+    print(f"Merged {len(parts)} parts: " + ", ".join(f"{split} {len(y)}" for split, y in labels.items()))
+    publish_features(task, args, logger, writer, labels, first_metadata["feature_head"], first_metadata["backbone"])
+
+
+def publish_features(task, args, logger, writer, labels, feature_head, backbone_name):
+    """Run the precision parity report, write the features artifact and upload it."""
+    X_train_feat = writer.open_split("train")
+    X_test_feat = writer.open_split("test")
+    y_train, y_test = labels["train"], labels["test"]
+    print(f"Feature shapes: X_train_feat: {X_train_feat.shape}, X_test_feat: {X_test_feat.shape}")
+
+    feature_precision = args["feature_precision"]
+    if feature_precision != "float32" and is_enabled(args["precision_parity_report"]):
+        print(f"Running precision parity report (float32 vs {feature_precision})...")
+        # int8 is calibrated on the whole training split, as in the artifact; the heads train on
+        # in-memory copies of parity_max_samples rows per split, sampled across each split
+        parity = parity_report(X_train_feat, y_train, X_test_feat, y_test,
+                               precisions=("float32", feature_precision), epochs=int(args["parity_epochs"]),
+                               max_samples=int(args["parity_max_samples"]))
+        lines = ["precision  accuracy  max_abs_error  bytes/sample"]
+        for precision, result in parity.items():
+            lines.append(f"{precision:<9}  {result['accuracy']:.4f}    {result['max_abs_error']:.6f}       {result['bytes_per_sample']}")
+            logger.report_scalar(title="precision_parity", series=f"{precision}_accuracy", value=result["accuracy"], iteration=0)
+        accuracy_delta = parity[feature_precision]["accuracy"] - parity["float32"]["accuracy"]
+        lines.append(f"accuracy delta ({feature_precision} - float32): {accuracy_delta:+.4f}")
+        logger.report_scalar(title="precision_parity", series="accuracy_delta", value=accuracy_delta, iteration=0)
+        logger.report_text("\n".join(lines))
+        print("\n".join(lines))
+
+    if args["output_format"] == "npz":
+        features_path = 'features.npz'
+        features_metadata = save_features(features_path, X_train_feat[:], X_test_feat[:], y_train, y_test, feature_head,
+                                          precision=feature_precision, compress=is_enabled(args["compress_features"]))
+    else:
+        features_path = 'features'
+        features_metadata = writer.finalize(features_path, {"train": y_train, "test": y_test}, feature_head,
+                                            precision=feature_precision, extra_metadata={"backbone": backbone_name})
+    features_metadata["backbone"] = backbone_name
+    # Upload artifacts (the metadata tells downstream steps which backbone and head produced the features)
+    task.upload_artifact('features', artifact_object=features_path, metadata=features_metadata)
+    #task.upload_artifact('processed_data', artifact_object='processed_data.npz')
+
+    # The artifact is uploaded, so the work directory is no longer needed for resuming
+    del X_train_feat, X_test_feat
+    writer.cleanup()
+
+
+if __name__ == "__main__":
+    main()
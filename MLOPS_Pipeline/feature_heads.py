@@ -0,0 +1,52 @@
+"""
+Selectable pooling heads applied on top of the backbone feature map in Step 2.
+  raw          the full HxWxC map (7x7x1280 = 62,720 floats for MobileNetV2 at 224px)
+  global_avg   global average pooling -> C
+  global_max   global max pooling -> C
+  spatial_NxN  average pooling to an NxN grid -> NxNxC (e.g. spatial_2x2 -> 5,120 floats)
+The head runs inside the compiled forward pass, so only the pooled features leave the model.
+Backbones that already output a pooled vector (EfficientNet-Lite) only take the raw head.
+"""
+import re
+
+import tensorflow as tf
+from tensorflow.keras.layers import AveragePooling2D, GlobalAveragePooling2D, GlobalMaxPooling2D
+
+FEATURE_HEADS = ("raw", "global_avg", "global_max", "spatial_NxN")
+DEFAULT_FEATURE_HEAD = "raw"
+
+
+def spatial_pool_layer(feature_map_size, grid):
+    """AveragePooling2D that maps a feature_map_size square map onto a grid x grid output."""
+    if grid < 1 or grid > feature_map_size:
+        raise ValueError(f"Cannot pool a {feature_map_size}x{feature_map_size} map to {grid}x{grid}")
+    stride = feature_map_size // grid
+    pool_size = feature_map_size - (grid - 1) * stride
+    return AveragePooling2D(pool_size=pool_size, strides=stride)
+
+
+def head_layer(head, feature_map_size):
+    """Return the Keras layer implementing head, or None for the raw map."""
+    if head == "raw":
+        return None
+    if head == "global_avg":
+        return GlobalAveragePooling2D()
+    if head == "global_max":
+        return GlobalMaxPooling2D()
+    match = re.fullmatch(r"spatial_(\d+)x\1", head)
+    if match:
+        return spatial_pool_layer(feature_map_size, int(match.group(1)))
+    raise ValueError(f"Unknown feature_head '{head}', expected one of {FEATURE_HEADS}")
+
+
+def attach_feature_head(base_model, head):
+    """Return a model computing base_model followed by the selected pooling head."""
+    if len(base_model.output_shape) == 2:
+        if head != "raw":
+            raise ValueError(f"{base_model.name} already outputs pooled features; only the raw head applies")
+        return base_model
+    layer = head_layer(head, int(base_model.output_shape[1]))
+    if layer is None:
+        return base_model
+    return tf.keras.Model(inputs=base_model.input, outputs=layer(base_model.output),
+                          name=f"{base_model.name}_{head}")
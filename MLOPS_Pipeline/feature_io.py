@@ -0,0 +1,237 @@
+"""
+Reading and writing the Step 2 features artifact, either a sharded directory in the
+dataset_io layout (streamed to disk by feature_writer) or a single features.npz.
+Besides the train/test features and labels, the artifact records which pooling head
+produced the features, so Step 3 and the evaluation scripts adapt to its shape.
+Artifacts written before heads existed carry no metadata and are treated as "raw".
+Features may be stored as float32, float16 or per-channel int8 (see feature_quantization);
+load_features always hands back dequantized float32; open_features returns lazy
+memory-mapped FeatureViews instead, for training inputs that stream from disk. An npz
+whose members were already decompressed next to it (see artifact_cache) is read from
+those memory-mapped members instead of being inflated again.
+"""
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+from dataset_io import find_sharded_dataset, is_sharded_dataset, open_sharded_dataset
+from feature_heads import DEFAULT_FEATURE_HEAD
+from feature_quantization import decode_features, encode_features
+
+
+def feature_metadata(feature_head, feature_shape, feature_precision="float32"):
+    """Metadata attached to the ClearML features artifact and stored inside the npz."""
+    return {"feature_head": feature_head, "feature_shape": list(feature_shape),
+            "feature_precision": feature_precision}
+
+
+def save_features(path, X_train_feat, X_test_feat, y_train, y_test, feature_head,
+                  precision="float32", compress=True):
+    encoded = encode_features({"X_train_feat": X_train_feat, "X_test_feat": X_test_feat}, precision)
+    savez = np.savez_compressed if compress else np.savez
+    savez(path, y_train=y_train, y_test=y_test, feature_head=np.array(feature_head), **encoded)
+    return feature_metadata(feature_head, X_train_feat.shape[1:], precision)
+
+
+# int8 scale and zero point of a sharded features artifact, stored next to index.json
+FEATURE_SCALE_FILE = "feature_scale.npy"
+FEATURE_ZERO_POINT_FILE = "feature_zero_point.npy"
+
+
+def _load_sharded_features(path, keys):
+    index, splits = open_sharded_dataset(path)
+    metadata = index.get("metadata", {})
+    precision = metadata.get("feature_precision", "float32")
+    scale = zero_point = None
+    if precision == "int8":
+        scale = np.load(os.path.join(path, FEATURE_SCALE_FILE))
+        zero_point = np.load(os.path.join(path, FEATURE_ZERO_POINT_FILE))
+    result = {"feature_head": metadata.get("feature_head", DEFAULT_FEATURE_HEAD), "feature_precision": precision}
+    for key in keys:
+        split = splits[key.split("_")[1]]
+        if not key.endswith("_feat"):
+            result[key] = split.labels
+            continue
+        features = np.empty(split.shape, dtype=np.float32)
+        for shard, start in zip(split.shards, split.offsets):
+            features[start:start + len(shard)] = decode_features(shard, precision, scale, zero_point)
+        result[key] = features
+    return result
+
+
+def _extracted_npz_members(path):
+    """
+    {member: read-only memory map} when every member of the npz at path was already
+    decompressed by extract_npz_members (as the artifact cache does), else None.
+    """
+    out_dir = f"{path}.mmap"
+    if not os.path.isdir(out_dir):
+        return None
+    with zipfile.ZipFile(path) as archive:
+        members = [name[:-len(".npy")] for name in archive.namelist() if name.endswith(".npy")]
+    paths = {member: os.path.join(out_dir, f"{member}.npy") for member in members}
+    if not all(os.path.exists(member_path) for member_path in paths.values()):
+        return None
+    return {member: np.load(member_path, mmap_mode="r") for member, member_path in paths.items()}
+
+
+def _decode_npz_members(data, keys):
+    result = {}
+    result["feature_head"] = str(data["feature_head"]) if "feature_head" in data else DEFAULT_FEATURE_HEAD
+    precision = str(data["feature_precision"]) if "feature_precision" in data else "float32"
+    result["feature_precision"] = precision
+    scale = data["feature_scale"] if precision == "int8" else None
+    zero_point = data["feature_zero_point"] if precision == "int8" else None
+    for key in keys:
+        result[key] = data[key]
+        if key.endswith("_feat"):
+            result[key] = decode_features(result[key], precision, scale, zero_point)
+    return result
+
+
+def _load_npz_features(path, keys):
+    extracted = _extracted_npz_members(path)
+    if extracted is not None:
+        # float32 features stay memory-mapped instead of being inflated from the archive
+        return _decode_npz_members(extracted, keys)
+    with np.load(path) as data:
+        return _decode_npz_members(data, keys)
+
+
+def load_features(path, keys=("X_train_feat", "X_test_feat", "y_train", "y_test"), flatten=True):
+    """
+    Load the requested arrays from a features artifact. Feature arrays are flattened to
+    (N, D) when flatten is set, whatever head produced them. The returned dict also holds
+    "feature_head", "feature_precision" and "feature_shape" (per-sample shape before
+    flattening). Reduced-precision features are dequantized to float32.
+    """
+    path = find_sharded_dataset(path)
+    if is_sharded_dataset(path):
+        result = _load_sharded_features(path, keys)
+    else:
+        result = _load_npz_features(path, keys)
+    feature_keys = [key for key in keys if key.endswith("_feat")]
+    if feature_keys:
+        result["feature_shape"] = tuple(result[feature_keys[0]].shape[1:])
+    if flatten:
+        for key in feature_keys:
+            if result[key].ndim > 2:
+                result[key] = result[key].reshape(result[key].shape[0], -1)
+    return result
+
+
+class FeatureView:
+    """
+    Lazy, read-only (N, D) view over stored features: rows are only read from the
+    memory-mapped source and dequantized to float32 when requested. Contiguous slices
+    return another view, so training code can split a view without loading it; indexing
+    with an array of row positions returns those rows decoded, like take().
+    """
+
+    def __init__(self, source, precision="float32", scale=None, zero_point=None, start=0, stop=None):
+        self.source = source
+        self.precision = precision
+        self.scale = scale
+        self.zero_point = zero_point
+        self.start = start
+        self.stop = len(source) if stop is None else stop
+        self.shape = (self.stop - self.start, int(np.prod(source.shape[1:])))
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decode(self, rows):
+        rows = decode_features(np.asarray(rows), self.precision, self.scale, self.zero_point)
+        return rows.reshape(len(rows), -1)
+
+    def read(self, start, stop):
+        """Decoded float32 rows [start, stop) of this view."""
+        return self._decode(self.source[self.start + start:self.start + min(stop, len(self))])
+
+    def take(self, indices):
+        """Decoded float32 rows at the given positions of this view."""
+        if len(indices) == 0:
+            return np.empty((0, self.shape[1]), dtype=np.float32)
+        return self._decode(np.stack([self.source[self.start + int(i)] for i in indices]))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("FeatureView only supports contiguous slices")
+            return FeatureView(self.source, self.precision, self.scale, self.zero_point,
+                               self.start + start, self.start + max(start, stop))
+        if isinstance(key, (list, np.ndarray)):
+            # Row subsets (e.g. the stratified train_fraction rows) are read and decoded
+            return self.take(key)
+        if key < 0:
+            key += len(self)
+        return self.read(key, key + 1)[0]
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.read(0, len(self))
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+
+def extract_npz_members(path, members):
+    """
+    Decompress npz members to .npy files next to the archive (once) so they can be
+    memory-mapped; zip members are streamed to disk, never fully held in memory.
+    """
+    out_dir = f"{path}.mmap"
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    with zipfile.ZipFile(path) as archive:
+        for member in members:
+            out_path = os.path.join(out_dir, f"{member}.npy")
+            if not os.path.exists(out_path):
+                tmp_path = f"{out_path}.{os.getpid()}.tmp"
+                with archive.open(f"{member}.npy") as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, length=1024 * 1024)
+                os.replace(tmp_path, out_path)
+            paths[member] = out_path
+    return paths
+
+
+def open_features(path):
+    """
+    Open a features artifact for streaming: X_train_feat/X_test_feat are memory-mapped
+    FeatureViews, labels and metadata are loaded as with load_features.
+    """
+    path = find_sharded_dataset(path)
+    if is_sharded_dataset(path):
+        index, splits = open_sharded_dataset(path)
+        metadata = index.get("metadata", {})
+        precision = metadata.get("feature_precision", "float32")
+        scale = zero_point = None
+        if precision == "int8":
+            scale = np.load(os.path.join(path, FEATURE_SCALE_FILE))
+            zero_point = np.load(os.path.join(path, FEATURE_ZERO_POINT_FILE))
+        result = {"feature_head": metadata.get("feature_head", DEFAULT_FEATURE_HEAD), "feature_precision": precision}
+        sources = {split: splits[split] for split in ("train", "test")}
+        labels = {split: splits[split].labels for split in ("train", "test")}
+    else:
+        result = _load_npz_features(path, ("y_train", "y_test"))
+        precision = result["feature_precision"]
+        with np.load(path) as data:
+            scale = data["feature_scale"] if precision == "int8" else None
+            zero_point = data["feature_zero_point"] if precision == "int8" else None
+        member_paths = extract_npz_members(path, ("X_train_feat", "X_test_feat"))
+        sources = {split: np.load(member_paths[f"X_{split}_feat"], mmap_mode="r") for split in ("train", "test")}
+        labels = {split: result[f"y_{split}"] for split in ("train", "test")}
+    for split in ("train", "test"):
+        result[f"X_{split}_feat"] = FeatureView(sources[split], precision, scale, zero_point)
+        result[f"y_{split}"] = labels[split]
+    result["feature_shape"] = tuple(sources["train"].shape[1:])
+    return result
+
+
+def check_model_input(model, X, model_name):
+    """Fail with a clear message when a trained head does not match the feature layout."""
+    expected = model.input_shape[-1]
+    if expected is not None and expected != X.shape[1]:
+        raise ValueError(f"{model_name} expects {expected}-d features but the features artifact has "
+                         f"{X.shape[1]}-d features; retrain Step 3 with the current feature_head")
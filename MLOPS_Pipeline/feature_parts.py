@@ -0,0 +1,71 @@
+"""
+Fan-out of Step 2 over several extraction tasks.
+Worker i of N extracts a contiguous index range of every split and uploads it as a
+float32 features artifact whose index metadata carries a "part" entry (part index, part
+count and the [start, stop) range per split). The merge task downloads all parts, checks
+that their ranges tile each split in order, and adopts their shards into one feature run,
+which is then finalized (precision, parity report) like a single-task extraction.
+"""
+import os
+
+import numpy as np
+
+from dataset_io import find_sharded_dataset, open_sharded_dataset
+
+
+def part_range(total, num_parts, part_index):
+    """[start, stop) of part_index when total items are split into num_parts near-equal ranges."""
+    if not 0 <= part_index < num_parts:
+        raise ValueError(f"part_index must be in [0, {num_parts}), got {part_index}")
+    base, remainder = divmod(total, num_parts)
+    start = part_index * base + min(part_index, remainder)
+    return start, start + base + (1 if part_index < remainder else 0)
+
+
+def part_metadata(part_index, num_parts, ranges):
+    return {"part": {"index": int(part_index), "num_parts": int(num_parts),
+                     "ranges": {split: [int(start), int(stop)] for split, (start, stop) in ranges.items()}}}
+
+
+def open_feature_parts(paths):
+    """
+    Open the part artifacts at paths and return them ordered by part index as
+    (root, index, splits) tuples, after checking that they form one complete fan-out.
+    """
+    parts = []
+    for path in paths:
+        root = find_sharded_dataset(path)
+        index, splits = open_sharded_dataset(root)
+        if "part" not in index["metadata"]:
+            raise ValueError(f"{path} is not a feature extraction part")
+        parts.append((root, index, splits))
+    parts.sort(key=lambda part: part[1]["metadata"]["part"]["index"])
+
+    num_parts = parts[0][1]["metadata"]["part"]["num_parts"]
+    if [part[1]["metadata"]["part"]["index"] for part in parts] != list(range(num_parts)):
+        raise ValueError(f"Expected parts 0..{num_parts - 1}, got "
+                         f"{[part[1]['metadata']['part']['index'] for part in parts]}")
+    for split in parts[0][1]["metadata"]["part"]["ranges"]:
+        expected_start = 0
+        for _, index, _ in parts:
+            start, stop = index["metadata"]["part"]["ranges"][split]
+            if start != expected_start:
+                raise ValueError(f"Part {index['metadata']['part']['index']} of split '{split}' starts at "
+                                 f"{start}, expected {expected_start}")
+            expected_start = stop
+    return parts
+
+
+def merge_parts(writer, parts):
+    """Adopt the shards of every part into writer, in order. Returns {split: labels}."""
+    labels = {}
+    for split in parts[0][1]["metadata"]["part"]["ranges"]:
+        sources = []
+        split_labels = []
+        for root, index, splits in parts:
+            sources.extend((os.path.join(root, shard["file"]), shard["count"])
+                           for shard in index["splits"][split]["shards"])
+            split_labels.extend(splits[split].labels.tolist())
+        writer.import_shards(split, sources, len(split_labels))
+        labels[split] = np.array(split_labels, dtype=np.int64)
+    return labels
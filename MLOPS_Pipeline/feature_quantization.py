@@ -0,0 +1,115 @@
+"""
+Reduced-precision storage for the Step 2 features artifact.
+  float32  full precision (legacy)
+  float16  half precision, 2x smaller
+  int8     affine per-channel quantization, 4x smaller: q = round(x / scale) + zero_point,
+           with scale and zero_point per feature channel (last axis), calibrated on the
+           training features and reused for the test features
+Loaders dequantize transparently back to float32. parity_report() trains the same small
+head on full-precision and dequantized features so the accuracy cost can be checked.
+"""
+import numpy as np
+
+from head_evaluation import head_accuracy
+
+FEATURE_PRECISIONS = ("float32", "float16", "int8")
+
+# Rows processed at a time, so quantization never holds a second full-size float copy
+_CHUNK = 1024
+
+
+def calibrate_int8(X):
+    """Per-channel (scale, zero_point) covering [min, max] of X, with 0.0 exactly representable."""
+    channels = X.shape[-1]
+    lo = np.zeros(channels, dtype=np.float32)
+    hi = np.zeros(channels, dtype=np.float32)
+    for start in range(0, len(X), _CHUNK):
+        chunk = X[start:start + _CHUNK].reshape(-1, channels)
+        lo = np.minimum(lo, chunk.min(axis=0))
+        hi = np.maximum(hi, chunk.max(axis=0))
+    scale = (hi - lo) / 255.0
+    scale[scale == 0] = 1.0
+    zero_point = np.round(-128.0 - lo / scale).astype(np.int32)
+    return scale.astype(np.float32), zero_point
+
+
+def quantize_int8(X, scale, zero_point):
+    q = np.empty(X.shape, dtype=np.int8)
+    for start in range(0, len(X), _CHUNK):
+        chunk = np.round(X[start:start + _CHUNK] / scale) + zero_point
+        q[start:start + _CHUNK] = np.clip(chunk, -128, 127)
+    return q
+
+
+def dequantize_int8(q, scale, zero_point):
+    X = np.empty(q.shape, dtype=np.float32)
+    for start in range(0, len(q), _CHUNK):
+        X[start:start + _CHUNK] = (q[start:start + _CHUNK].astype(np.float32) - zero_point) * scale
+    return X
+
+
+def encode_features(arrays, precision):
+    """
+    Encode {name: float32 features} for storage. The first array calibrates int8 scales
+    (pass the training features first). Returns {key: array} ready for np.savez.
+    """
+    if precision not in FEATURE_PRECISIONS:
+        raise ValueError(f"Unknown feature_precision '{precision}', expected one of {FEATURE_PRECISIONS}")
+    encoded = {}
+    if precision == "float32":
+        encoded.update({name: X.astype(np.float32, copy=False) for name, X in arrays.items()})
+    elif precision == "float16":
+        encoded.update({name: X.astype(np.float16) for name, X in arrays.items()})
+    else:
+        scale, zero_point = calibrate_int8(next(iter(arrays.values())))
+        encoded["feature_scale"] = scale
+        encoded["feature_zero_point"] = zero_point
+        encoded.update({name: quantize_int8(X, scale, zero_point) for name, X in arrays.items()})
+    encoded["feature_precision"] = np.array(precision)
+    return encoded
+
+
+def decode_features(X, precision, scale=None, zero_point=None):
+    """Inverse of encode_features for one stored array; always returns float32."""
+    if precision == "int8":
+        return dequantize_int8(X, scale, zero_point)
+    return X.astype(np.float32, copy=False)
+
+
+def _sample_rows(X, y, max_samples, seed=0):
+    """Up to max_samples rows of X (and y) spread over the whole split, in their stored order."""
+    if not max_samples or len(X) <= max_samples:
+        return np.asarray(X[:]), np.asarray(y)
+    rows = np.sort(np.random.default_rng(seed).choice(len(X), int(max_samples), replace=False))
+    return np.stack([X[int(row)] for row in rows]), np.asarray(y)[rows]
+
+
+def parity_report(X_train, y_train, X_test, y_test, precisions=FEATURE_PRECISIONS, epochs=5, seed=0,
+                  max_samples=None):
+    """
+    Train an identical small dense head on each precision's (dequantized) features and
+    return {precision: {"accuracy", "max_abs_error", "bytes_per_sample"}}. Features are
+    encoded as the artifact stores them: unflattened, with int8 calibrated per channel on
+    the whole X_train. The heads then train on at most max_samples rows per split, sampled
+    across the split (any indexable of rows, e.g. a memory-mapped split, is accepted).
+    """
+    scale = zero_point = None
+    if "int8" in precisions:
+        scale, zero_point = calibrate_int8(X_train)
+    X_train, y_train = _sample_rows(X_train, y_train, max_samples, seed)
+    X_test, y_test = _sample_rows(X_test, y_test, max_samples, seed)
+    report = {}
+    for precision in precisions:
+        if precision == "int8":
+            encoded = {"train": quantize_int8(X_train, scale, zero_point),
+                       "test": quantize_int8(X_test, scale, zero_point)}
+        else:
+            encoded = encode_features({"train": X_train, "test": X_test}, precision)
+        train = decode_features(encoded["train"], precision, scale, zero_point)
+        test = decode_features(encoded["test"], precision, scale, zero_point)
+        report[precision] = {
+            "accuracy": head_accuracy(train, y_train, test, y_test, epochs=epochs, seed=seed),
+            "max_abs_error": float(np.abs(test - X_test).max()) if len(test) else 0.0,
+            "bytes_per_sample": int(encoded["train"].itemsize * np.prod(X_train.shape[1:])),
+        }
+    return report
@@ -0,0 +1,114 @@
+"""
+Persistent, content-addressed store of extracted backbone features, shared by every
+pipeline run and HPO job on an agent (and usable from the Colab baseline notebook).
+A store is opened for one namespace: backbone name, a digest of its weights, the
+preprocessing parameters and the feature head. Within it, entries are keyed by the
+content hash of the image, so only images never seen with that exact extractor need a
+forward pass. The store is bounded by a size budget with least-recently-used eviction.
+Only numpy is required, so this module can be imported without TensorFlow.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def array_digest(array):
+    """Content hash of an image tensor (shape and dtype included)."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def model_weights_digest(model):
+    """Digest of a Keras model's weights, so retrained or swapped backbones never share entries."""
+    digest = hashlib.sha256()
+    for weights in model.get_weights():
+        digest.update(np.ascontiguousarray(weights).data)
+    return digest.hexdigest()[:16]
+
+
+def default_store_dir():
+    return os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "features")
+
+
+class FeatureStore:
+    """Feature entries for one extractor namespace, with hit/miss stats and LRU eviction."""
+
+    def __init__(self, root, namespace, max_size_gb=20.0):
+        self.root = root or default_store_dir()
+        self.namespace = dict(namespace)
+        namespace_digest = hashlib.sha256(json.dumps(self.namespace, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.root, namespace_digest)
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "namespace.json"), "w") as f:
+            json.dump(self.namespace, f, indent=2, sort_keys=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def get(self, key):
+        """Return the stored features for key (refreshing its LRU timestamp), or None."""
+        entry_path = self._entry_path(key)
+        try:
+            features = np.load(entry_path)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return features
+
+    def put(self, key, features):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(tmp_path, entry_path)
+
+    def _entries(self):
+        """(mtime, size, path) of every entry in the whole store, across namespaces."""
+        entries = []
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".npy"):
+                    entry_path = os.path.join(root, name)
+                    stat = os.stat(entry_path)
+                    entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def enforce_budget(self):
+        """Evict least-recently-used entries until the whole store fits in max_size_gb."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+            self.evicted += 1
+        return total
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "entries": len(entries),
+            "size_gb": sum(size for _, size, _ in entries) / 1024 ** 3,
+            "max_size_gb": self.max_bytes / 1024 ** 3,
+        }
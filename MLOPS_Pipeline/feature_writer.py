@@ -0,0 +1,185 @@
+"""
+Crash-safe, resumable streaming of Step 2 features to disk.
+Each split is extracted shard by shard into a work directory. A shard is written through
+a memory-mapped .partial file (so at most one batch of features is held in memory),
+renamed into place once complete, and only then recorded in manifest.json. A restarted
+task that finds a manifest with the same signature (extractor, input data, shard size)
+skips the completed shards and resumes with the first missing one; a manifest with a
+different signature is discarded.
+finalize() turns the completed float32 shards into the features artifact: a sharded
+directory in the dataset_io layout, encoded to the requested precision shard by shard.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from dataset_io import ShardedSplit, write_shard_index
+from feature_io import FEATURE_SCALE_FILE, FEATURE_ZERO_POINT_FILE, feature_metadata
+from feature_quantization import FEATURE_PRECISIONS, calibrate_int8, quantize_int8
+
+MANIFEST = "manifest.json"
+
+# Rows encoded at a time when converting finished shards to the artifact precision
+_CHUNK = 1024
+
+
+def default_work_dir(run_id):
+    return os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "feature_runs", str(run_id))
+
+
+def run_signature(**fields):
+    """Digest identifying one extraction run; a manifest is only resumed when it matches."""
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ResumableFeatureWriter:
+    """Extracts features split by split into float32 shards, recording progress in a manifest."""
+
+    def __init__(self, work_dir, signature, feature_shape, shard_size):
+        self.work_dir = work_dir
+        self.feature_shape = tuple(int(dim) for dim in feature_shape)
+        self.shard_size = int(shard_size)
+        self.manifest_path = os.path.join(work_dir, MANIFEST)
+        manifest = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("signature") != signature:
+                print(f"Discarding stale feature run in {work_dir} (signature changed)")
+                shutil.rmtree(work_dir)
+                manifest = None
+        self.manifest = manifest or {"signature": signature, "feature_shape": list(self.feature_shape),
+                                     "shard_size": self.shard_size, "splits": {}}
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def completed_shards(self, split):
+        return self.manifest["splits"].get(split, {}).get("shards", [])
+
+    def extract_split(self, split, X, fill, start=0, stop=None):
+        """
+        Extract features for X[start:stop] shard by shard. fill(out, start, stop) must write
+        the features of X[start:stop] into out. Returns (images extracted now, images
+        resumed, images_per_sec for the shards extracted now).
+        """
+        stop = len(X) if stop is None else min(stop, len(X))
+        total = stop - start
+        entry = self.manifest["splits"].setdefault(split, {"count": total, "shards": []})
+        done = {shard["file"] for shard in entry["shards"]}
+        resumed = sum(shard["count"] for shard in entry["shards"])
+        if resumed:
+            print(f"Resuming {split}: {len(done)} shards ({resumed}/{total} images) already extracted")
+
+        extracted = 0
+        start_time = time.time()
+        for shard_idx, shard_start in enumerate(range(start, stop, self.shard_size)):
+            name = f"{split}_{shard_idx:05d}.npy"
+            if name in done:
+                continue
+            shard_stop = min(shard_start + self.shard_size, stop)
+            shard_path = os.path.join(self.work_dir, name)
+            partial_path = shard_path + ".partial"
+            out = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.float32,
+                                            shape=(shard_stop - shard_start,) + self.feature_shape)
+            fill(out, shard_start, shard_stop)
+            out.flush()
+            del out
+            os.replace(partial_path, shard_path)
+            self._record_shard(split, name, shard_stop - shard_start)
+            extracted += shard_stop - shard_start
+            print(f"{split}: shard {shard_idx} done ({shard_stop - start}/{total} images)")
+        elapsed = time.time() - start_time
+        return extracted, resumed, extracted / elapsed if extracted and elapsed > 0 else 0.0
+
+    def _record_shard(self, split, name, count):
+        entry = self.manifest["splits"][split]
+        entry["shards"].append({"file": name, "count": count})
+        entry["shards"].sort(key=lambda shard: shard["file"])
+        self._save_manifest()
+
+    def import_shards(self, split, sources, total):
+        """
+        Adopt already extracted float32 shards, given as (path, count) in order, as the
+        shards of split (hard-linked when possible). Used to merge fan-out parts.
+        """
+        entry = self.manifest["splits"].setdefault(split, {"count": int(total), "shards": []})
+        done = {shard["file"] for shard in entry["shards"]}
+        for shard_idx, (src_path, count) in enumerate(sources):
+            name = f"{split}_{shard_idx:05d}.npy"
+            if name in done:
+                continue
+            shard_path = os.path.join(self.work_dir, name)
+            partial_path = shard_path + ".partial"
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            try:
+                os.link(src_path, partial_path)
+            except OSError:
+                shutil.copyfile(src_path, partial_path)
+            os.replace(partial_path, shard_path)
+            self._record_shard(split, name, int(count))
+
+    def open_split(self, split):
+        """Memory-mapped float32 view over the completed shards of split."""
+        entry = self.manifest["splits"][split]
+        return ShardedSplit(self.work_dir, {"shards": entry["shards"], "labels": []},
+                            self.feature_shape, np.float32)
+
+    def finalize(self, out_dir, labels, feature_head, precision="float32", extra_metadata=None):
+        """
+        Write the features artifact directory from the completed shards. labels maps each
+        split to its labels; the first split calibrates int8 scales (pass "train" first).
+        extra_metadata is merged into the index metadata. Returns the artifact metadata.
+        """
+        if precision not in FEATURE_PRECISIONS:
+            raise ValueError(f"Unknown feature_precision '{precision}', expected one of {FEATURE_PRECISIONS}")
+        for split in labels:
+            entry = self.manifest["splits"].get(split)
+            if entry is None or sum(shard["count"] for shard in entry["shards"]) != entry["count"]:
+                raise RuntimeError(f"Feature extraction for split '{split}' is incomplete")
+        os.makedirs(out_dir, exist_ok=True)
+
+        encode = None
+        if precision == "float16":
+            encode = lambda chunk: chunk.astype(np.float16)
+        elif precision == "int8":
+            scale, zero_point = calibrate_int8(self.open_split(next(iter(labels))))
+            np.save(os.path.join(out_dir, FEATURE_SCALE_FILE), scale)
+            np.save(os.path.join(out_dir, FEATURE_ZERO_POINT_FILE), zero_point)
+            encode = lambda chunk: quantize_int8(chunk, scale, zero_point)
+        stored_dtype = np.dtype(precision)
+
+        splits = {}
+        for split, split_labels in labels.items():
+            shards = self.manifest["splits"][split]["shards"]
+            for shard in shards:
+                src_path = os.path.join(self.work_dir, shard["file"])
+                dst_path = os.path.join(out_dir, shard["file"])
+                if encode is None:
+                    shutil.copyfile(src_path, dst_path)
+                    continue
+                src = np.load(src_path, mmap_mode="r")
+                dst = np.lib.format.open_memmap(dst_path, mode="w+", dtype=stored_dtype, shape=src.shape)
+                for start in range(0, len(src), _CHUNK):
+                    dst[start:start + _CHUNK] = encode(src[start:start + _CHUNK])
+                dst.flush()
+                del dst, src
+            splits[split] = {"count": len(split_labels), "shards": shards,
+                             "labels": [int(label) for label in split_labels], "arrays": {}}
+
+        metadata = feature_metadata(feature_head, self.feature_shape, precision)
+        metadata.update(extra_metadata or {})
+        write_shard_index(out_dir, splits, self.feature_shape, stored_dtype, self.shard_size, metadata=metadata)
+        return metadata
+
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -0,0 +1,23 @@
+"""
+Downstream evaluation of extracted features: the accuracy of a small seeded dense head
+trained on them, used to compare backbones (backbones.sweep_backbones) and storage
+precisions (feature_quantization.parity_report) on equal terms.
+TensorFlow is imported on first use, so importing this module stays cheap.
+"""
+
+
+def head_accuracy(X_train, y_train, X_test, y_test, epochs=5, seed=0):
+    """Test accuracy of a small seeded dense head trained on flattened features."""
+    import tensorflow as tf
+
+    X_train = X_train.reshape(len(X_train), -1)
+    X_test = X_test.reshape(len(X_test), -1)
+    tf.keras.utils.set_random_seed(seed)
+    head = tf.keras.Sequential([
+        tf.keras.layers.Dense(64, activation="relu", input_shape=(X_train.shape[1],)),
+        tf.keras.layers.Dense(1, activation="sigmoid"),
+    ])
+    head.compile(optimizer="adam", loss="binary_crossentropy", metrics=["accuracy"])
+    head.fit(X_train, y_train, epochs=epochs, batch_size=64, shuffle=False, verbose=0)
+    _, accuracy = head.evaluate(X_test, y_test, verbose=0)
+    return float(accuracy)
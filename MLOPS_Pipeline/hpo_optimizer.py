@@ -6,9 +6,156 @@ using ClearML's HyperParameterOptimizer to find the best set of hyperparameters
 from clearml import Task
 from clearml.automation import HyperParameterOptimizer, UniformParameterRange, DiscreteParameterRange, UniformIntegerParameterRange
 from clearml.automation.optuna import OptimizerOptuna
-import time
+import optuna
+import os
+import tempfile
 import json
 
+from hpo_study import PersistentOptimizerOptuna, default_storage_path, feature_version, open_study, study_name
+from step_cache import upstream_task
+from trial_scheduler import queue_worker_count
+
+# Artifacts of the best training trial, re-uploaded by the HPO task under these names
+BEST_ARTIFACTS = {
+    "eye_model": "best_eye_model",
+    "yawn_model": "best_yawn_model",
+    "eye_history": "best_eye_history",
+    "yawn_history": "best_yawn_history",
+    "multitask_model": "best_multitask_model"
+}
+
+def make_pruner(name, min_epochs):
+    """Optuna pruner acting on the per-epoch objective reported by the training trials."""
+    if name == "median":
+        return optuna.pruners.MedianPruner(n_startup_trials=2, n_warmup_steps=min_epochs)
+    if name == "asha":
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=max(1, min_epochs), reduction_factor=3)
+    if name == "none":
+        return optuna.pruners.NopPruner()
+    raise ValueError(f"Unknown pruner '{name}', expected median, asha or none")
+
+
+def upload_best(hpo_task, best_params, artifact_paths, best_trial):
+    """Upload the best trial's parameters and its artifacts (local paths by source name)."""
+    print(f"Best parameters: {best_params}")
+    best_params_file = "best_parameters.json"
+    with open(best_params_file, "w") as f:
+        json.dump(best_params, f, indent=4)
+    hpo_task.upload_artifact("best_parameters", artifact_object=best_params_file)
+
+    for source_artifact_name, target_artifact_name in BEST_ARTIFACTS.items():
+        local_path = artifact_paths.get(source_artifact_name)
+        if local_path:
+            hpo_task.upload_artifact(name=target_artifact_name, artifact_object=local_path)
+            print(f"Uploaded {target_artifact_name} from {best_trial} to HPO task {hpo_task.id}")
+        elif source_artifact_name != "multitask_model":  # only multi-task trials have one
+            print(f"Could not find '{source_artifact_name}' artifact in {best_trial}")
+
+
+def task_outputs(task_id):
+    """(parameters, {artifact name: local path}, description) of the training task task_id."""
+    best_task = Task.get_task(task_id=task_id)
+    artifact_paths = {name: best_task.artifacts[name].get_local_copy()
+                      for name in BEST_ARTIFACTS if best_task.artifacts.get(name)}
+    return best_task.get_parameters(), artifact_paths, f"task {task_id}"
+
+
+def best_trial_outputs(trial):
+    """
+    task_outputs() of a persistent study's best trial, from the ClearML task that trained
+    it or from the parameters and local artifact paths a local trial recorded (whichever
+    hpo_mode ran it). Returns None when neither is available.
+    """
+    task_id = trial.user_attrs.get("task_id")
+    if task_id:
+        try:
+            return task_outputs(task_id)
+        except Exception as e:
+            print(f"Could not read task {task_id} of trial {trial.number}: {e}")
+    if "params" not in trial.user_attrs:
+        return None
+    # Local trial outputs only exist on the machine that trained them
+    artifact_paths = {name: path for name, path in trial.user_attrs.get("artifacts", {}).items()
+                      if os.path.exists(path)}
+    params = {f"General/{name}": value for name, value in trial.user_attrs["params"].items()}
+    return params, artifact_paths, f"trial {trial.number}"
+
+
+def report_completed_trial(job_id, objective_value, objective_iteration, job_parameters, top_performance_job_id):
+    """job_complete_callback of the optimizer: called as each ClearML trial finishes."""
+    print(f"Trial task {job_id} completed: average_accuracy={objective_value} at epoch {objective_iteration}"
+          + (" (new best)" if job_id == top_performance_job_id else ""))
+
+
+def open_persistent_study(args, features_task, base_task_object, hyper_params):
+    """
+    Open the persistent study for the current features version and the base task's
+    non-searched hyperparameters. Returns None when persist_study is off.
+    """
+    if not args['persist_study']:
+        return None
+    version = feature_version(features_task.artifacts["features"], features_task.id)
+    searched = {p.name for p in hyper_params}
+    base_task_params = base_task_object.get_parameters_as_dict().get("General", {})
+    fixed_params = {name: value for name, value in base_task_params.items() if name not in searched}
+    fixed_params["max_epochs"] = int(args['max_epochs'])
+    storage_path = args['study_storage'] or default_storage_path()
+    print(f"Persistent HPO study storage: {storage_path} (features version {version})")
+    return open_study(storage_path, study_name(version, fixed_params), version, fixed_params,
+                      pruner=make_pruner(args['pruner'], int(args['min_epochs_before_pruning'])),
+                      warm_start_trials=int(args['warm_start_trials']), hyper_params=hyper_params)
+
+
+def run_local(hpo_task, args, base_task_object, features_task, hyper_params, study=None):
+    """hpo_mode=local: run the trials in a process pool on this machine over features loaded once."""
+    from artifact_cache import cached_local_copy
+    from feature_io import load_features
+    from local_hpo import run_local_hpo
+    from model_training_hpo import DEFAULT_HYPERPARAMETERS
+    from multi_fidelity import SuccessiveHalving
+
+    # Hyperparameters outside the search space come from the base task, as in cloned trials
+    base_params = dict(DEFAULT_HYPERPARAMETERS)
+    base_task_params = base_task_object.get_parameters_as_dict().get("General", {})
+    base_params.update({name: value for name, value in base_task_params.items() if name in base_params})
+
+    features_path = cached_local_copy(features_task.artifacts["features"], logger=hpo_task.get_logger())
+    print(f"Loading features once from: {features_path}")
+    data = load_features(features_path)
+
+    # Trial outputs of a persistent study outlive this run, so cached best trials keep their models
+    if study is not None:
+        work_dir = os.path.join(os.path.dirname(os.path.abspath(args['study_storage'] or default_storage_path())),
+                                "trials", study.study_name)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="local_hpo_")
+    study, records = run_local_hpo(
+        hyper_params, base_params, data,
+        num_trials=int(args['num_trials']),
+        time_limit_minutes=float(args['time_limit_minutes']),
+        logger=hpo_task.get_logger(),
+        work_dir=work_dir,
+        num_workers=int(args['local_workers']),
+        threads_per_worker=int(args['threads_per_worker']),
+        max_epochs=int(args['max_epochs']),
+        population_size=int(args['population_size']),
+        study=study,
+        halving=SuccessiveHalving(float(args['min_train_fraction']), int(args['halving_eta']))
+        if str(args['multi_fidelity']).lower() in ("true", "1", "yes") else None
+    )
+    completed = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+    if not completed:
+        print("No local HPO trial completed successfully.")
+        return
+    best_trial = study.best_trial
+    print(f"Best trial: {best_trial.number} (average_accuracy={study.best_value:.4f})")
+    outputs = best_trial_outputs(best_trial)
+    if outputs is None:
+        print(f"Best trial {best_trial.number} recorded neither a task nor its parameters.")
+        return
+    upload_best(hpo_task, *outputs)
+
+
 def main():
     # Initialize the HPO task
     hpo_task = Task.init(
@@ -28,7 +175,38 @@ def main():
         'num_trials': 10,  # Number of HPO trials to run
         'time_limit_minutes': 60,  # Time limit for HPO
         'execution_queue': 'bnm04',  # Queue for execution
+        # Trials running at once in clearml mode; 0 runs one per agent serving execution_queue
+        'max_concurrent_tasks': 0,
         'max_epochs': 20,  # Maximum epochs for any trial
+        # Trials report validation/average_accuracy every epoch; the pruner aborts trials whose
+        # intermediate objective trails the others: median, asha (successive halving) or none
+        'pruner': 'median',
+        'min_epochs_before_pruning': 3,
+        'pool_period_minutes': 0.5,  # How often running trials are checked (and pruned)
+        # "clearml" clones the Step 3 task per trial on execution_queue; "local" loads the
+        # features once into shared memory and runs the trials in a process pool on this
+        # machine (local_workers=0 sizes the pool from the CPUs at threads_per_worker
+        # threads each and from the peak memory of a first, calibration trial)
+        'hpo_mode': 'clearml',
+        'local_workers': 0,
+        'threads_per_worker': 2,
+        # Local mode only: trials each worker trains at once as one population of heads
+        # (shared batch_size and epochs, separate eye/yawn heads)
+        'population_size': 1,
+        # Local mode only: multi-fidelity HPO (asynchronous successive halving). Trials start
+        # on a stratified min_train_fraction of the training data with as large a share of
+        # their epochs, and the top 1/halving_eta of every rung get eta times the budget, up
+        # to the full data and epochs
+        'multi_fidelity': False,
+        'min_train_fraction': 0.1,
+        'halving_eta': 3,
+        # Keep the Optuna study in a local SQLite file (study_storage, empty for
+        # ~/.clearml/bnm_cache/hpo/studies.db), one study per features version: reruns resume
+        # it and reuse every evaluated configuration, and a new features version starts from
+        # the warm_start_trials best configurations of the previous study
+        'persist_study': True,
+        'study_storage': '',
+        'warm_start_trials': 5,
     }
     args = hpo_task.connect(args)
     print(f"HPO parameters: {args}")
@@ -38,7 +216,7 @@ def main():
     base_task_name = "Step 3 - Model Training HPO"
 
     try:
-        base_task_object = Task.get_task(project_name=base_task_project, task_name=base_task_name)
+        base_task_object = upstream_task("model_training_base", base_task_name, project_name=base_task_project)
         if not base_task_object:
             print(f"Error: Base task '{base_task_name}' in project '{base_task_project}' not found. Please ensure it is registered.")
             return
@@ -59,11 +237,25 @@ def main():
         DiscreteParameterRange("epochs", values=[10, 15, 20])
     ]
 
+    features_task = upstream_task("feature_extraction", "Step 2 - Feature Extraction", project_name="BNM Pipeline HPO")
+    study = open_persistent_study(args, features_task, base_task_object, hyper_params)
+
+    if args['hpo_mode'] == 'local':
+        run_local(hpo_task, args, base_task_object, features_task, hyper_params, study)
+        print(f"HPO task {hpo_task.id} finished. Best models and parameters (if any) are uploaded as artifacts.")
+        return
+
     # Define objective metric
     objective_metric_title = "validation"
     objective_metric_series = "average_accuracy" 
     objective_metric_sign = "max"  
 
+    # Each agent runs one trial at a time, so more concurrent trials than agents only queue up
+    max_concurrent_tasks = int(args['max_concurrent_tasks'])
+    if max_concurrent_tasks <= 0:
+        max_concurrent_tasks = queue_worker_count(args['execution_queue']) or 2
+        print(f"Running up to {max_concurrent_tasks} trials at once, one per agent on '{args['execution_queue']}'")
+
     # Initialize the optimizer
     print("Initializing HyperParameterOptimizer...")
     optimizer = HyperParameterOptimizer(
@@ -72,64 +264,45 @@ def main():
         objective_metric_title=objective_metric_title,
         objective_metric_series=objective_metric_series,
         objective_metric_sign=objective_metric_sign,
-        optimizer_class=OptimizerOptuna,
-        max_iteration_per_job=args['max_epochs'], 
-        max_number_of_concurrent_tasks=2,  # Run 2 trials concurrently
+        optimizer_class=PersistentOptimizerOptuna if study is not None else OptimizerOptuna,
+        # Trials report every epoch at iteration epoch + 1 and their final objective at iteration
+        # epochs; a job reaching max_iteration_per_job is aborted, so one past max_epochs lets a
+        # full-length trial finish uploading its models instead of racing the abort
+        max_iteration_per_job=int(args['max_epochs']) + 1,
+        max_number_of_concurrent_tasks=max_concurrent_tasks,
         total_max_jobs=args['num_trials'], 
         execution_queue=args['execution_queue'],
         time_limit_per_job=args['time_limit_minutes'] * 60,  # Convert to seconds
+        optimization_time_limit=args['time_limit_minutes'],
+        pool_period_min=float(args['pool_period_minutes']),
+        min_iteration_per_job=int(args['min_epochs_before_pruning']),
+        optuna_pruner=make_pruner(args['pruner'], int(args['min_epochs_before_pruning'])),
+        **({'optuna_study': study} if study is not None else {})
     )
 
     # Start the optimization process
     print(f"Starting HPO process with {args['num_trials']} trials...")
-    optimizer.start()
+    optimizer.start(job_complete_callback=report_completed_trial)
     print(f"HPO started with task ID: {hpo_task.id}. Monitor progress in the ClearML UI.")
 
-    # Wait for optimization to complete
+    # Wait for optimization to complete: this returns as soon as the last trial is done
     print(f"Waiting for optimization to complete (time limit: {args['time_limit_minutes']} minutes)...")
-    start_time = time.time()
-    while time.time() - start_time < args['time_limit_minutes'] * 60:
-        if not optimizer.is_running():
-            print("Optimization process completed.")
-            break
-        time.sleep(30)  # Check every 30 seconds
+    if optimizer.wait():
+        print("Optimization process completed.")
+    optimizer.stop()
     
-    # Get the top experiments
-    top_experiments = optimizer.get_top_experiments(top_k=1)
-    if top_experiments:
-        best_experiment = top_experiments[0]
-        best_task_id = best_experiment.id
-        print(f"Best training task ID: {best_task_id}")
-
-        # Get the best task
-        best_task = Task.get_task(task_id=best_task_id)
-        
-        # Get the best parameters
-        best_params = best_experiment.get_parameters()
-        print(f"Best parameters: {best_params}")
-        
-        # Save best parameters as artifact
-        best_params_file = "best_parameters.json"
-        with open(best_params_file, "w") as f:
-            json.dump(best_params, f, indent=4)
-        hpo_task.upload_artifact("best_parameters", artifact_object=best_params_file)
-        
-        # Upload best model artifacts
-        artifacts_to_upload = {
-            "eye_model": "best_eye_model",
-            "yawn_model": "best_yawn_model",
-            "eye_history": "best_eye_history",
-            "yawn_history": "best_yawn_history"
-        }
-
-        for source_artifact_name, target_artifact_name in artifacts_to_upload.items():
-            artifact_info = best_task.artifacts.get(source_artifact_name)
-            if artifact_info:
-                local_path = artifact_info.get_local_copy()
-                hpo_task.upload_artifact(name=target_artifact_name, artifact_object=local_path)
-                print(f"Uploaded {target_artifact_name} from task {best_task_id} to HPO task {hpo_task.id}")
-            else:
-                print(f"Could not find '{source_artifact_name}' artifact in task {best_task_id}")
+    # A persistent study's best trial may come from an earlier run, in either hpo_mode
+    outputs = None
+    completed = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)) if study else []
+    if completed:
+        outputs = best_trial_outputs(study.best_trial)
+    if outputs is None:
+        top_experiments = optimizer.get_top_experiments(top_k=1)
+        if top_experiments:
+            outputs = task_outputs(top_experiments[0].id)
+    if outputs is not None:
+        print(f"Best training trial: {outputs[2]}")
+        upload_best(hpo_task, *outputs)
     else:
         print("No experiments were completed successfully by HPO, or no top experiments found.")
 
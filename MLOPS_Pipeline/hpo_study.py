@@ -0,0 +1,176 @@
+"""
+Persistent Optuna studies for Step 4.
+Studies live in a local SQLite file and are named after the features version (the hash of
+the Step 2 features artifact) and the fixed, non-searched Step 3 hyperparameters, so a
+rerun on the same features resumes the same study and its sampler starts from every trial
+evaluated so far. A new features version starts a new study that is warm-started with the
+best configurations of the most recent earlier study with the same fixed hyperparameters,
+re-evaluated on the new data (configurations outside the current search space are skipped).
+Completed trials double as a result cache: a configuration already evaluated in the study
+(which the discrete batch_size/epochs grids and coarse step sizes make frequent) is
+answered from it instead of being trained again. Each trial keeps its full
+hyperparameters and the ClearML task id or local artifact paths it produced, so a cached
+best trial still has its models, whichever hpo_mode trained it.
+"""
+import hashlib
+import json
+import os
+
+import optuna
+from clearml import Task
+from clearml.automation import DiscreteParameterRange, UniformIntegerParameterRange, UniformParameterRange
+from clearml.automation.optuna import OptimizerOptuna
+from clearml.automation.optuna.optuna import OptunaObjective
+
+WARM_START_TRIALS = 5
+
+
+def default_storage_path():
+    return os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "hpo", "studies.db")
+
+
+def feature_version(features_artifact, source_task_id=None):
+    """Version of the Step 2 features: the artifact's content hash, or its URL when it has none."""
+    return features_artifact.hash or f"{source_task_id}:{features_artifact.url}"
+
+
+def study_name(version, fixed_params):
+    """Study name for a features version and the hyperparameters outside the search space."""
+    digest = hashlib.sha256(json.dumps({"features": version, "fixed": fixed_params},
+                                       sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return f"bnm_hpo_{digest}"
+
+
+def search_space(hyper_params):
+    """Optuna distributions of the ClearML parameter ranges, as the optimizers suggest them."""
+    space = {}
+    for p in hyper_params:
+        if isinstance(p, UniformIntegerParameterRange):
+            high = p.max_value if p.include_max else p.max_value - p.step_size
+            space[p.name] = optuna.distributions.IntDistribution(p.min_value, high, step=p.step_size or 1)
+        elif isinstance(p, UniformParameterRange):
+            space[p.name] = optuna.distributions.FloatDistribution(p.min_value, p.max_value, step=p.step_size)
+        elif isinstance(p, DiscreteParameterRange):
+            space[p.name] = optuna.distributions.CategoricalDistribution(p.values)
+    return space
+
+
+def in_search_space(params, space):
+    """Whether params has exactly the parameters of space, each within its distribution."""
+    if set(params) != set(space):
+        return False
+    try:
+        return all(space[name]._contains(space[name].to_internal_repr(value)) for name, value in params.items())
+    except ValueError:
+        return False
+
+
+def open_study(storage_path, name, version, fixed_params, pruner=None, sampler=None, warm_start_trials=WARM_START_TRIALS,
+               hyper_params=None):
+    """
+    Load or create the study name in the SQLite file at storage_path. A newly created study
+    gets the best warm_start_trials configurations of the latest other study with the same
+    fixed_params enqueued, leaving out those outside the hyper_params ranges (when given).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(storage_path)), exist_ok=True)
+    storage = f"sqlite:///{os.path.abspath(storage_path)}"
+    fixed_attr = json.dumps(fixed_params, sort_keys=True, default=str)
+    # Only studies of the same Step 3 setup, on other features versions, are comparable
+    previous = [summary for summary in optuna.study.get_all_study_summaries(storage)
+                if summary.study_name != name and summary.datetime_start is not None
+                and summary.user_attrs.get("fixed_params") == fixed_attr]
+    study = optuna.create_study(storage=storage, study_name=name, direction="maximize",
+                                pruner=pruner, sampler=sampler, load_if_exists=True)
+    if study.trials:
+        completed = [trial for trial in study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+        print(f"Resuming study {name} with {len(completed)} completed trials")
+        return study
+
+    study.set_user_attr("feature_version", version)
+    study.set_user_attr("fixed_params", fixed_attr)
+    if previous and warm_start_trials > 0:
+        latest = max(previous, key=lambda summary: summary.datetime_start)
+        prior = optuna.load_study(study_name=latest.study_name, storage=storage)
+        space = search_space(hyper_params) if hyper_params is not None else None
+        best, seen = [], []
+        for trial in sorted((trial for trial in prior.trials if trial.state == optuna.trial.TrialState.COMPLETE),
+                            key=lambda trial: trial.value, reverse=True):
+            if space is not None and not in_search_space(trial.params, space):
+                continue
+            if trial.params not in seen and len(best) < warm_start_trials:
+                best.append(trial)
+                seen.append(trial.params)
+        for trial in best:
+            study.enqueue_trial(trial.params, user_attrs={"warm_start_from": f"{latest.study_name}/{trial.number}"})
+        print(f"Created study {name}, warm-started with {len(best)} configurations from {latest.study_name}")
+    else:
+        print(f"Created study {name}")
+    return study
+
+
+def cached_trial(study, params, exclude_number=None):
+    """A completed trial of study with exactly these parameters, or None."""
+    for trial in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)):
+        if trial.number != exclude_number and trial.params == params:
+            return trial
+    return None
+
+
+def copy_cached_result(trial, cached):
+    """Mark trial as answered from cached and carry over where its models are."""
+    trial.set_user_attr("cached_from", cached.number)
+    for key in ("task_id", "params", "artifacts"):
+        if key in cached.user_attrs:
+            trial.set_user_attr(key, cached.user_attrs[key])
+
+
+class CachedOptunaObjective(OptunaObjective):
+    """OptunaObjective that answers configurations already in the study and records each trial's task id."""
+
+    def objective(self, trial):
+        # Suggesting first is safe: the parent objective gets the same values back
+        params = {name: getattr(trial, func_name)(name=name, **kwargs)
+                  for name, (func_name, kwargs) in self._config_space.items()}
+        cached = cached_trial(trial.study, params, exclude_number=trial.number)
+        if cached is not None:
+            copy_cached_result(trial, cached)
+            print(f"Trial {trial.number}: {params} already evaluated in trial {cached.number}, reusing {cached.value}")
+            return cached.value
+        value = super().objective(trial)
+        # noinspection PyProtectedMember
+        for task_id, (_, parameter_override) in list(self.optimizer._created_jobs_ids.items()):
+            if parameter_override == params:
+                trial.set_user_attr("task_id", task_id)
+        # The full hyperparameters too, as local trials record them, so either mode can use the trial
+        trial.set_user_attr("params", {**self._base_params(), **params})
+        return value
+
+    def _base_params(self):
+        if not hasattr(self, "_base_general_params"):
+            base_task = Task.get_task(task_id=self.base_task_id)
+            self._base_general_params = base_task.get_parameters_as_dict().get("General", {})
+        return self._base_general_params
+
+
+class PersistentOptimizerOptuna(OptimizerOptuna):
+    """OptimizerOptuna running on a given (persistent) study, with CachedOptunaObjective."""
+
+    def __init__(self, *args, optuna_study=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._persistent_study = optuna_study
+
+    def start(self):
+        if self._persistent_study is None:
+            return super().start()
+        self._study = self._persistent_study
+        self._objective = CachedOptunaObjective(
+            base_task_id=self._base_task_id,
+            queue_name=self._execution_queue,
+            optimizer=self,
+            max_iteration_per_job=self.max_iteration_per_job,
+            min_iteration_per_job=self.min_iteration_per_job,
+            sleep_interval=int(self.pool_period_minutes * 60),
+            config_space=self._convert_hyper_parameters_to_optuna(),
+        )
+        self._study.optimize(self._objective.objective, n_trials=self.total_max_jobs,
+                             n_jobs=self._num_concurrent_workers)
@@ -0,0 +1,158 @@
+"""
+Pluggable CPU inference backends for the Step 2 feature extractor.
+  keras        the Keras model behind a compiled tf.function (reference)
+  tflite       float32 TFLite conversion, run by the LiteRT/TFLite interpreter with the XNNPACK
+               delegate (applied by default for float models) on num_threads threads
+  tflite_int8  post-training int8 quantized TFLite model (weights and activations),
+               calibrated on a sample of the dataset; float32 in and out, so it is a
+               drop-in replacement with some loss of precision
+  onnx         ONNX Runtime CPU execution provider; needs the optional tf2onnx and
+               onnxruntime packages
+Every backend is a callable taking a model-ready float32 batch and returning a numpy
+array, so it can be passed as `forward` to batched_inference.extract_into.
+check_parity() and benchmark_backends() compare the backends against Keras.
+"""
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:  # tf.lite.Interpreter is deprecated but still shipped with TensorFlow
+    Interpreter = tf.lite.Interpreter
+
+from batched_inference import compile_forward, make_image_dataset
+
+INFERENCE_BACKENDS = ("keras", "tflite", "tflite_int8", "onnx")
+DEFAULT_INFERENCE_BACKEND = "keras"
+
+
+def resolve_num_threads(num_threads):
+    return int(num_threads) if int(num_threads) > 0 else (os.cpu_count() or 1)
+
+
+class KerasBackend:
+    def __init__(self, model):
+        self.forward = compile_forward(model)
+
+    def __call__(self, batch):
+        return self.forward(batch).numpy()
+
+
+class TFLiteBackend:
+    """TFLite interpreter over a converted model; the input is resized when the batch size changes."""
+
+    def __init__(self, model, num_threads=0, representative_batches=None):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        if representative_batches is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([batch[i:i + 1]] for batch in representative_batches
+                                                        for i in range(len(batch)))
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        self.model_content = converter.convert()
+        self.interpreter = Interpreter(model_content=self.model_content,
+                                       num_threads=resolve_num_threads(num_threads))
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def __call__(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        if len(batch) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(batch)
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+class OnnxBackend:
+    def __init__(self, model, num_threads=0):
+        try:
+            import onnxruntime as ort
+            import tf2onnx
+        except ImportError as e:
+            raise ImportError("The onnx inference backend needs the tf2onnx and onnxruntime packages") from e
+        input_spec = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input"),)
+        model_proto, _ = tf2onnx.convert.from_keras(model, input_signature=input_spec, opset=13)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = resolve_num_threads(num_threads)
+        self.session = ort.InferenceSession(model_proto.SerializeToString(), sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+def representative_batches(X, batch_size=32, num_samples=128):
+    """Model-ready calibration batches from the first num_samples images of X."""
+    dataset = make_image_dataset(X, batch_size, stop=min(num_samples, len(X)))
+    return [batch.numpy() for batch in dataset]
+
+
+def create_backend(name, model, num_threads=0, calibration_data=None):
+    """Build the named backend for model. tflite_int8 calibrates on calibration_data (images)."""
+    if name == "keras":
+        return KerasBackend(model)
+    if name == "tflite":
+        return TFLiteBackend(model, num_threads)
+    if name == "tflite_int8":
+        if calibration_data is None:
+            raise ValueError("The tflite_int8 backend needs calibration_data")
+        return TFLiteBackend(model, num_threads, representative_batches=representative_batches(calibration_data))
+    if name == "onnx":
+        return OnnxBackend(model, num_threads)
+    raise ValueError(f"Unknown inference_backend '{name}', expected one of {INFERENCE_BACKENDS}")
+
+
+def _run(backend, X, batch_size):
+    outputs = []
+    start_time = time.time()
+    for batch in make_image_dataset(X, batch_size):
+        outputs.append(backend(batch))
+    elapsed = time.time() - start_time
+    return np.concatenate(outputs), (len(X) / elapsed if elapsed > 0 else 0.0)
+
+
+def check_parity(reference, features):
+    """Numerical agreement of features with the Keras reference features."""
+    reference = reference.reshape(len(reference), -1)
+    features = features.reshape(len(features), -1)
+    error = np.abs(features - reference)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(features, axis=1)
+    cosine = np.sum(reference * features, axis=1) / np.maximum(norms, np.finfo(np.float32).tiny)
+    return {
+        "max_abs_error": float(error.max()),
+        "mean_abs_error": float(error.mean()),
+        "relative_error": float(error.max() / max(np.abs(reference).max(), 1e-12)),
+        "min_cosine": float(cosine.min()),
+    }
+
+
+def benchmark_backends(model, X, backends=INFERENCE_BACKENDS, batch_size=64, num_threads=0):
+    """
+    Run each backend over X (a small sample) and return {backend: result}. Each result
+    holds images_per_sec plus the check_parity() metrics against Keras, or "error" when
+    the backend could not be built (e.g. onnx without its optional packages).
+    """
+    keras_backend = KerasBackend(model)
+    _run(keras_backend, X[:batch_size], batch_size)  # warm up the traced function
+    reference, keras_ips = _run(keras_backend, X, batch_size)
+    report = {}
+    for name in backends:
+        if name == "keras":
+            report[name] = {"images_per_sec": keras_ips, **check_parity(reference, reference)}
+            continue
+        try:
+            backend = create_backend(name, model, num_threads, calibration_data=X)
+        except Exception as e:
+            report[name] = {"error": str(e)}
+            continue
+        _run(backend, X[:batch_size], batch_size)
+        features, images_per_sec = _run(backend, X, batch_size)
+        report[name] = {"images_per_sec": images_per_sec, **check_parity(reference, features)}
+    return report
@@ -0,0 +1,174 @@
+"""
+Landmark-based eye/mouth ROI stage for Step 1 (Smart Data Preprocessing).
+Runs the MediaPipe face landmarker on CPU with the same face_landmarker.task asset the
+DrowzeeApp ships, and emits small left-eye, right-eye and mouth crops together with the
+EAR/MAR values the app's FacialLandmarkDetector computes. Images are processed in a pool
+of worker processes, each holding its own landmarker instance.
+"""
+import atexit
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+# Same landmark indices as DrowzeeApp FacialLandmarkDetector.kt
+LEFT_EYE_INDICES = [33, 160, 158, 133, 153, 144]
+RIGHT_EYE_INDICES = [362, 385, 387, 263, 373, 380]
+MOUTH_INDICES = [61, 291, 81, 178, 13, 14, 17, 402, 311, 308]
+
+# Crop order along axis 1 of every ROI sample
+ROI_NAMES = ("left_eye", "right_eye", "mouth")
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DrowzeeApp", "app",
+                                  "src", "main", "assets", "face_landmarker.task")
+
+# Per-process state of a pool worker, filled in by _init_worker
+_worker_state = {}
+
+
+def _distance(p1, p2):
+    return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2 + (p2[2] - p1[2]) ** 2)
+
+
+def eye_aspect_ratio(points):
+    """EAR over the six eye landmarks, as in FacialLandmarkDetector.calculateEAR."""
+    a = _distance(points[1], points[5])
+    b = _distance(points[2], points[4])
+    c = _distance(points[0], points[3])
+    return (a + b) / (2.0 * c)
+
+
+def mouth_aspect_ratio(points):
+    """MAR over the ten mouth landmarks, as in FacialLandmarkDetector.calculateMAR."""
+    a = _distance(points[2], points[6])
+    b = _distance(points[3], points[5])
+    c = _distance(points[0], points[4])
+    return (a + b) / (2.0 * c)
+
+
+def crop_roi(img, points, roi_size, margin=0.35):
+    """Square crop around the (x, y) pixel points, padded by `margin` and resized to roi_size."""
+    height, width = img.shape[:2]
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    center_x, center_y = (min(xs) + max(xs)) / 2.0, (min(ys) + max(ys)) / 2.0
+    half = max(max(xs) - min(xs), max(ys) - min(ys), 1.0) * (1.0 + margin) / 2.0
+    x0, x1 = int(max(center_x - half, 0)), int(min(center_x + half, width))
+    y0, y1 = int(max(center_y - half, 0)), int(min(center_y + half, height))
+    if x1 <= x0 or y1 <= y0:
+        return cv2.resize(img, roi_size)
+    return cv2.resize(img[y0:y1, x0:x1], roi_size)
+
+
+def create_landmarker(model_path=DEFAULT_MODEL_PATH):
+    # Imported lazily: mediapipe is only required when the ROI stage is enabled
+    import mediapipe as mp
+    from mediapipe.tasks import python as mp_tasks
+    from mediapipe.tasks.python import vision
+
+    options = vision.FaceLandmarkerOptions(
+        base_options=mp_tasks.BaseOptions(model_asset_path=model_path,
+                                          delegate=mp_tasks.BaseOptions.Delegate.CPU),
+        running_mode=vision.RunningMode.IMAGE,
+        num_faces=1,
+        min_face_detection_confidence=0.5,
+        min_face_presence_confidence=0.5,
+        min_tracking_confidence=0.5,
+    )
+    return mp, vision.FaceLandmarker.create_from_options(options)
+
+
+def extract_image_rois(mp, landmarker, img, roi_size):
+    """
+    Return (crops, ear, mar, face_found) for one BGR image. crops has shape
+    (3, roi_h, roi_w, 3) in ROI_NAMES order. Without a detected face (e.g. the eye-only
+    close-ups in the Closed/Open folders) every crop is the whole frame and EAR/MAR are NaN.
+    """
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    result = landmarker.detect(mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(rgb)))
+    if not result.face_landmarks:
+        full_frame = cv2.resize(img, roi_size)
+        return np.stack([full_frame] * len(ROI_NAMES)), float("nan"), float("nan"), False
+
+    landmarks = result.face_landmarks[0]
+    height, width = img.shape[:2]
+
+    def normalized(indices):
+        return [(landmarks[i].x, landmarks[i].y, landmarks[i].z) for i in indices]
+
+    def pixels(indices):
+        return [(landmarks[i].x * width, landmarks[i].y * height) for i in indices]
+
+    ear = (eye_aspect_ratio(normalized(LEFT_EYE_INDICES)) + eye_aspect_ratio(normalized(RIGHT_EYE_INDICES))) / 2.0
+    mar = mouth_aspect_ratio(normalized(MOUTH_INDICES))
+    crops = np.stack([crop_roi(img, pixels(indices), roi_size)
+                      for indices in (LEFT_EYE_INDICES, RIGHT_EYE_INDICES, MOUTH_INDICES)])
+    return crops, ear, mar, True
+
+
+def _init_worker(model_path):
+    cv2.setNumThreads(1)
+    _worker_state["mp"], _worker_state["landmarker"] = create_landmarker(model_path)
+    # Close explicitly: MediaPipe's own finalizer fails once the interpreter is shutting down
+    atexit.register(_worker_state["landmarker"].close)
+
+
+def _process_chunk(start, paths, roi_size):
+    """Return (start, crops, measurements, ok) for a chunk; measurements rows are (ear, mar, face_found)."""
+    mp, landmarker = _worker_state["mp"], _worker_state["landmarker"]
+    crops = np.zeros((len(paths), len(ROI_NAMES), roi_size[1], roi_size[0], 3), dtype=np.uint8)
+    measurements = np.full((len(paths), 3), np.nan, dtype=np.float32)
+    ok = np.zeros(len(paths), dtype=bool)
+    for offset, img_path in enumerate(paths):
+        img = cv2.imread(img_path)
+        if img is None:
+            continue
+        crops[offset], ear, mar, found = extract_image_rois(mp, landmarker, img, roi_size)
+        measurements[offset] = (ear, mar, float(found))
+        ok[offset] = True
+    return start, crops, measurements, ok
+
+
+class RoiExtractor:
+    """
+    Worker pool running the ROI stage. Use as a context manager and call run() once per
+    block of paths (e.g. one shard at a time), so landmarker start-up is paid once.
+    """
+
+    def __init__(self, roi_size=(64, 64), num_workers=1, chunk_size=64, model_path=DEFAULT_MODEL_PATH):
+        self.roi_size = tuple(roi_size)
+        self.num_workers = num_workers
+        self.chunk_size = max(1, int(chunk_size))
+        self.model_path = model_path
+        self.faces_found = 0
+        self._executor = None
+
+    def __enter__(self):
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"Face landmarker model not found: {self.model_path}")
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker,
+                                             initargs=(self.model_path,))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._executor.shutdown()
+        self._executor = None
+
+    def run(self, paths):
+        """
+        Returns (crops, measurements, ok) aligned with paths: crops is
+        (N, 3, roi_h, roi_w, 3) uint8, measurements is (N, 3) float32 of (ear, mar, face_found).
+        """
+        crops = np.zeros((len(paths), len(ROI_NAMES), self.roi_size[1], self.roi_size[0], 3), dtype=np.uint8)
+        measurements = np.full((len(paths), 3), np.nan, dtype=np.float32)
+        ok = np.zeros(len(paths), dtype=bool)
+        futures = [self._executor.submit(_process_chunk, start, paths[start:start + self.chunk_size], self.roi_size)
+                   for start in range(0, len(paths), self.chunk_size)]
+        for future in futures:
+            start, chunk_crops, chunk_measurements, chunk_ok = future.result()
+            end = start + len(chunk_ok)
+            crops[start:end], measurements[start:end], ok[start:end] = chunk_crops, chunk_measurements, chunk_ok
+        self.faces_found += int(np.nansum(measurements[:, 2]))
+        return crops, measurements, ok
@@ -0,0 +1,374 @@
+"""
+File-backed stand-in for the parts of the ClearML Task, Logger and Dataset API the step
+scripts use, so the pipeline runs without a ClearML server (see local_executor.py).
+A store directory holds one folder per task with its record (name, parameters, status,
+artifacts) in task.json, its scalars in scalars.jsonl and its artifacts. Uploading an
+artifact hard-links the file or folder into the task folder (a copy only across file
+systems), and get_local_copy() returns that path, so a step hands its output to the
+next one without serializing, uploading, downloading or unpacking anything; array
+artifacts are saved once as .npy and read back memory-mapped. install() puts these
+classes in place of clearml.Task, clearml.Logger and clearml.Dataset; it must run before
+the step modules are imported.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+STORE_ENV = "BNM_LOCAL_STORE"
+TASK_ID_ENV = "BNM_LOCAL_TASK_ID"
+
+
+def _read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _write_json(path, value):
+    # Written whole and renamed, so a concurrent reader never sees half a record
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def link_tree(source, target):
+    """Hard-link the file or folder source to target, copying only what cannot be linked."""
+    if os.path.isdir(source):
+        for directory, _, files in os.walk(source):
+            target_directory = os.path.join(target, os.path.relpath(directory, source))
+            os.makedirs(target_directory, exist_ok=True)
+            for name in files:
+                link_tree(os.path.join(directory, name), os.path.join(target_directory, name))
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def content_hash(path):
+    """sha256 of a file, or of the relative paths and contents of the files in a folder."""
+    digest = hashlib.sha256()
+    files = [path] if os.path.isfile(path) else sorted(
+        os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names)
+    for file_path in files:
+        if file_path != path:
+            digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _cast(value, default):
+    """An override value (stored as a string by ClearML) cast to the type of the connected default."""
+    if isinstance(default, bool):
+        return str(value).lower() in ("true", "1", "yes")
+    if isinstance(default, int):
+        return int(float(value))
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+class LocalStore:
+    """The store folder: task records, their artifacts and the registered datasets."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(os.path.join(self.root, "tasks"), exist_ok=True)
+
+    def task_dir(self, task_id):
+        return os.path.join(self.root, "tasks", task_id)
+
+    def load(self, task_id):
+        record = _read_json(os.path.join(self.task_dir(task_id), "task.json"))
+        if record is None:
+            raise ValueError(f"Local task {task_id} not found in {self.root}")
+        return record
+
+    def save(self, record):
+        os.makedirs(self.task_dir(record["id"]), exist_ok=True)
+        _write_json(os.path.join(self.task_dir(record["id"]), "task.json"), record)
+
+    def create(self, name, project, parameters=None, **fields):
+        record = {"id": uuid.uuid4().hex, "name": name, "project": project, "status": "created",
+                  "created": time.time(), "parameters": dict(parameters or {}), "artifacts": {}, **fields}
+        self.save(record)
+        return record
+
+    def records(self):
+        tasks_dir = os.path.join(self.root, "tasks")
+        for task_id in os.listdir(tasks_dir):
+            record = _read_json(os.path.join(tasks_dir, task_id, "task.json"))
+            if record is not None:
+                yield record
+
+    def latest(self, task_name=None, project_name=None, **fields):
+        """
+        Most recently created completed task named task_name (any name when None, and in
+        project_name when it has one there) whose record has the given field values.
+        """
+        matches = [record for record in self.records()
+                   if task_name in (None, record["name"]) and record["status"] == "completed"
+                   and all(record.get(key) == value for key, value in fields.items())]
+        in_project = [record for record in matches if record["project"] == project_name]
+        matches = in_project or matches
+        return max(matches, key=lambda record: record["created"]) if matches else None
+
+    def register_dataset(self, dataset_name, dataset_project, path):
+        datasets = _read_json(os.path.join(self.root, "datasets.json"), {})
+        datasets[f"{dataset_project}/{dataset_name}"] = os.path.abspath(path)
+        _write_json(os.path.join(self.root, "datasets.json"), datasets)
+
+    def dataset_path(self, dataset_name, dataset_project):
+        return _read_json(os.path.join(self.root, "datasets.json"), {}).get(f"{dataset_project}/{dataset_name}")
+
+
+def _store():
+    root = os.environ.get(STORE_ENV)
+    if not root:
+        raise RuntimeError(f"{STORE_ENV} is not set: run the steps through local_executor.py")
+    return LocalStore(root)
+
+
+class LocalArtifact:
+    """An artifact of a local task; its files live in the task folder."""
+
+    def __init__(self, store, task_id, name, entry):
+        self._store = store
+        self._task_id = task_id
+        self.name = name
+        self._entry = entry
+
+    @property
+    def url(self):
+        return "file://" + self._entry["path"]
+
+    @property
+    def metadata(self):
+        return self._entry.get("metadata") or {}
+
+    @property
+    def hash(self):
+        # Hashed on first use and kept in the task record
+        if not self._entry.get("hash"):
+            self._entry["hash"] = content_hash(self._entry["path"])
+            record = self._store.load(self._task_id)
+            record["artifacts"][self.name]["hash"] = self._entry["hash"]
+            self._store.save(record)
+        return self._entry["hash"]
+
+    def get_local_copy(self, *args, **kwargs):
+        return self._entry["path"]
+
+    def get(self, *args, **kwargs):
+        path = self._entry["path"]
+        if path.endswith(".npy"):
+            return np.load(path, mmap_mode="r")
+        if path.endswith(".json") and self._entry.get("object"):
+            with open(path) as f:
+                return json.load(f)
+        return path
+
+
+class LocalLogger:
+    """Logger of a local task: scalars go to scalars.jsonl, text to the console and log.txt."""
+
+    def __init__(self, store, task_id):
+        self._dir = store.task_dir(task_id)
+
+    def _append(self, file_name, line):
+        with open(os.path.join(self._dir, file_name), "a") as f:
+            f.write(line + "\n")
+
+    def report_scalar(self, title, series, value, iteration):
+        self._append("scalars.jsonl", json.dumps({"title": title, "series": series, "value": float(value),
+                                                  "iteration": int(iteration)}))
+
+    def report_text(self, msg, *args, **kwargs):
+        print(msg)
+        self._append("log.txt", str(msg))
+
+    def report_image(self, title, series, iteration=0, local_path=None, **kwargs):
+        if local_path:
+            images_dir = os.path.join(self._dir, "images")
+            os.makedirs(images_dir, exist_ok=True)
+            target = os.path.join(images_dir, f"{title}_{series}_{iteration}{os.path.splitext(local_path)[1]}")
+            shutil.copy2(local_path, target)
+
+    @classmethod
+    def current_logger(cls):
+        task = LocalTask.current_task()
+        return task.get_logger() if task else None
+
+
+class LocalTask:
+    """Task of the local store, as far as the step scripts use the ClearML Task."""
+
+    _current = None
+
+    def __init__(self, store, record):
+        self._store = store
+        self._record = record
+
+    # --- creation and lookup ---
+
+    @classmethod
+    def init(cls, project_name=None, task_name=None, task_type=None, **kwargs):
+        """Start the task the executor created for this step, or a new one when run on its own."""
+        store = _store()
+        task_id = os.environ.get(TASK_ID_ENV)
+        if task_id:
+            record = store.load(task_id)
+        else:
+            record = store.create(task_name, project_name)
+        record.update(status="in_progress", started=time.time(), script_project=project_name)
+        store.save(record)
+        cls._current = cls(store, record)
+        return cls._current
+
+    @classmethod
+    def current_task(cls):
+        return cls._current
+
+    @classmethod
+    def get_task(cls, task_id=None, project_name=None, task_name=None, **kwargs):
+        store = _store()
+        if task_id:
+            return cls(store, store.load(task_id))
+        record = store.latest(task_name, project_name)
+        if record is None:
+            raise ValueError(f"No completed local task named '{task_name}' in {store.root}")
+        return cls(store, record)
+
+    @classmethod
+    def add_requirements(cls, *args, **kwargs):
+        pass
+
+    # --- properties ---
+
+    @property
+    def id(self):
+        return self._record["id"]
+
+    @property
+    def name(self):
+        return self._record["name"]
+
+    @property
+    def status(self):
+        return self._record["status"]
+
+    @property
+    def artifacts(self):
+        return {name: LocalArtifact(self._store, self.id, name, entry)
+                for name, entry in self._record["artifacts"].items()}
+
+    def set_name(self, name):
+        self._record["name"] = name
+        self._store.save(self._record)
+
+    def set_user_properties(self, *args, **kwargs):
+        self._record.setdefault("user_properties", {}).update(kwargs)
+        self._store.save(self._record)
+
+    def get_logger(self):
+        return LocalLogger(self._store, self.id)
+
+    # --- parameters ---
+
+    def connect(self, mutable, name=None):
+        """Apply the parameter overrides of section name (General) to the dict, and record it."""
+        section = name or "General"
+        parameters = self._record["parameters"]
+        for key, default in list(mutable.items()):
+            full_name = f"{section}/{key}"
+            if full_name in parameters:
+                mutable[key] = _cast(parameters[full_name], default)
+            parameters[full_name] = mutable[key]
+        self._store.save(self._record)
+        return mutable
+
+    def get_parameters(self, *args, **kwargs):
+        return {name: str(value) for name, value in self._record["parameters"].items()}
+
+    def get_parameters_as_dict(self, *args, **kwargs):
+        sections = {}
+        for name, value in self.get_parameters().items():
+            section, _, key = name.partition("/")
+            sections.setdefault(section, {})[key] = value
+        return sections
+
+    def get_parameter(self, name, default=None):
+        return self._record["parameters"].get(name, default)
+
+    # --- artifacts ---
+
+    def upload_artifact(self, name, artifact_object=None, metadata=None, **kwargs):
+        """Keep artifact_object (a file or folder path, an array or a JSON-able object) under name."""
+        artifacts_dir = os.path.join(self._store.task_dir(self.id), "artifacts", name)
+        shutil.rmtree(artifacts_dir, ignore_errors=True)
+        os.makedirs(artifacts_dir)
+        entry = {"metadata": metadata or {}}
+        if isinstance(artifact_object, np.ndarray):
+            entry["path"] = os.path.join(artifacts_dir, f"{name}.npy")
+            np.save(entry["path"], artifact_object)
+        elif isinstance(artifact_object, (str, os.PathLike)) and os.path.exists(artifact_object):
+            entry["path"] = os.path.join(artifacts_dir, os.path.basename(os.path.normpath(artifact_object)))
+            link_tree(os.path.abspath(artifact_object), entry["path"])
+        else:
+            entry["path"] = os.path.join(artifacts_dir, f"{name}.json")
+            entry["object"] = True
+            with open(entry["path"], "w") as f:
+                json.dump(artifact_object, f, default=str)
+        self._record["artifacts"][name] = entry
+        self._store.save(self._record)
+        return True
+
+    # --- status ---
+
+    def mark_status(self, status):
+        self._record.update(status=status, ended=time.time())
+        self._store.save(self._record)
+
+
+class LocalDataset:
+    """A dataset folder registered in the local store; its id changes with its file listing."""
+
+    def __init__(self, path):
+        self._path = path
+        listing = sorted((os.path.relpath(os.path.join(directory, name), path),
+                          os.path.getsize(os.path.join(directory, name)),
+                          int(os.path.getmtime(os.path.join(directory, name))))
+                         for directory, _, names in os.walk(path) for name in names)
+        self.id = hashlib.sha256(json.dumps(listing).encode()).hexdigest()[:32]
+
+    @classmethod
+    def get(cls, dataset_id=None, dataset_project=None, dataset_name=None, **kwargs):
+        path = _store().dataset_path(dataset_name, dataset_project)
+        if not path:
+            raise ValueError(f"Dataset '{dataset_project}/{dataset_name}' is not registered in the local store")
+        return cls(path)
+
+    def get_local_copy(self, *args, **kwargs):
+        return self._path
+
+
+def install(store_root):
+    """Use the local store for this process: point clearml.Task/Logger/Dataset at the stand-ins."""
+    import clearml
+
+    os.environ[STORE_ENV] = os.path.abspath(store_root)
+    LocalTask.TaskTypes = clearml.Task.TaskTypes
+    clearml.Task = LocalTask
+    clearml.Logger = LocalLogger
+    clearml.Dataset = LocalDataset
@@ -0,0 +1,173 @@
+"""
+Serverless local executor for the Drowsiness Detection pipeline with HPO.
+Runs the DAG pipeline_controller.py defines, with the same step scripts and parameter
+overrides, on this machine and without a ClearML server: the steps use the file-backed
+Task/Logger/Dataset stand-ins of local_clearml.py, artifacts are handed to the next step
+as hard-linked files that it memory-maps (no upload/download round trips), and each step
+prints how long it took. Steps run in this process one after another (RUN_MODE
+"inprocess", which also shares the TensorFlow import between steps), or in local
+subprocesses (RUN_MODE "subprocess"), where independent steps such as fanned-out feature
+extraction parts run in parallel. Steps are cached as in the pipeline (step_cache.py): a
+step whose code, parameters and input artifacts match a completed task in the store is
+not run again.
+"""
+import json
+import os
+import re
+import runpy
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import local_clearml
+
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Store of the local tasks, artifacts and datasets
+LOCAL_STORE = os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "local_pipeline")
+
+# Folder with the raw "Drowsiness Dataset" (what step0_upload_dataset.py uploads); once
+# registered in the store it can be left empty
+DATASET_DIR = ""
+
+# "inprocess" or "subprocess"; PARALLEL_STEPS caps concurrent steps in subprocess mode
+RUN_MODE = "inprocess"
+PARALLEL_STEPS = 2
+
+# Parameter overrides on top of the pipeline's, per step: HPO trains its trials in local mode
+LOCAL_OVERRIDES = {
+    "hpo": {"General/hpo_mode": "local"}
+}
+
+_STEP_REF = re.compile(r"\$\{([^}.]+)\.id\}")
+
+# Run in a subprocess step: install the stand-ins before the step script imports clearml
+_BOOTSTRAP = ("import runpy, sys; import local_clearml; local_clearml.install(sys.argv[1]); "
+              "runpy.run_path(sys.argv[2], run_name='__main__')")
+
+
+class StepRecorder:
+    """Stands in for the PipelineController in add_pipeline_steps() and keeps the steps it is given."""
+
+    def __init__(self):
+        self.steps = []
+
+    def add_step(self, name, base_task_project, base_task_name, parameter_override=None, parents=None, **kwargs):
+        self.steps.append({"name": name, "project": base_task_project, "task_name": base_task_name,
+                           "parameters": dict(parameter_override or {}), "parents": list(parents or [])})
+
+
+def resolve_parameters(parameters, task_ids):
+    """parameters with the ${step.id} references of the pipeline replaced by the steps' local task ids."""
+    return {name: _STEP_REF.sub(lambda match: task_ids[match.group(1)], value) if isinstance(value, str) else value
+            for name, value in parameters.items()}
+
+
+def run_step(store, step, script, task_ids, mode, cache):
+    """Run (or reuse) one step. Returns (task id, "ran" or "cached", seconds)."""
+    from step_cache import cache_key
+
+    started = time.time()
+    parameters = resolve_parameters(step["parameters"], task_ids)
+    parameters.update(LOCAL_OVERRIDES.get(step["name"], {}))
+    key = cache_key(parameters)
+    if cache:
+        cached = store.latest(step=step["name"], cache_key=key)
+        if cached is not None:
+            return cached["id"], "cached", time.time() - started
+
+    record = store.create(step["task_name"], step["project"], parameters, step=step["name"], cache_key=key)
+    work_dir = os.path.join(store.task_dir(record["id"]), "work")
+    os.makedirs(work_dir)
+    print(f"\n=== Step [{step['name']}] ({script}) as local task {record['id']} ===")
+    try:
+        if mode == "subprocess":
+            env = dict(os.environ, **{local_clearml.TASK_ID_ENV: record["id"]})
+            env["PYTHONPATH"] = os.pathsep.join(filter(None, [PIPELINE_DIR, env.get("PYTHONPATH")]))
+            subprocess.run([sys.executable, "-c", _BOOTSTRAP, store.root, os.path.join(PIPELINE_DIR, script)],
+                           cwd=work_dir, env=env, check=True)
+        else:
+            os.environ[local_clearml.TASK_ID_ENV] = record["id"]
+            previous_dir = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                runpy.run_path(os.path.join(PIPELINE_DIR, script), run_name="__main__")
+            finally:
+                os.chdir(previous_dir)
+                os.environ.pop(local_clearml.TASK_ID_ENV, None)
+                local_clearml.LocalTask._current = None
+    except BaseException:
+        record = store.load(record["id"])
+        record.update(status="failed", ended=time.time())
+        store.save(record)
+        raise
+    record = store.load(record["id"])
+    record.update(status="completed", ended=time.time())
+    store.save(record)
+    return record["id"], "ran", time.time() - started
+
+
+def print_timings(timings):
+    print(f"\n{'Step':<32}{'Status':<10}{'Seconds':>10}  Task")
+    for name, (task_id, status, seconds) in timings.items():
+        print(f"{name:<32}{status:<10}{seconds:>10.1f}  {task_id}")
+    print(f"{'Total':<32}{'':<10}{sum(seconds for _, _, seconds in timings.values()):>10.1f}")
+
+
+def main(dataset_dir=DATASET_DIR, store_root=LOCAL_STORE, mode=RUN_MODE, feature_extraction_workers=None,
+         cache=True, parallel_steps=PARALLEL_STEPS):
+    if mode not in ("inprocess", "subprocess"):
+        raise ValueError(f"Unknown run mode '{mode}', expected inprocess or subprocess")
+    # The stand-ins must replace the clearml classes before any step module imports them
+    local_clearml.install(store_root)
+    store = local_clearml.LocalStore(store_root)
+    if dataset_dir:
+        store.register_dataset("Drowsiness Dataset", "BNM Pipeline", dataset_dir)
+    sys.path.insert(0, PIPELINE_DIR)
+    from pipeline_controller import FEATURE_EXTRACTION_WORKERS, STEP_SCRIPTS, add_pipeline_steps
+
+    recorder = StepRecorder()
+    add_pipeline_steps(recorder, feature_extraction_workers or FEATURE_EXTRACTION_WORKERS, cache=cache)
+    # Fanned-out feature extraction parts run the feature extraction script
+    scripts = {step["name"]: STEP_SCRIPTS.get(step["name"]) or STEP_SCRIPTS["feature_extraction"]
+               for step in recorder.steps}
+    print(f"Local pipeline: {len(recorder.steps)} steps in {mode} mode, store {store.root}")
+
+    task_ids, timings = {}, {}
+    pending = list(recorder.steps)
+    max_running = parallel_steps if mode == "subprocess" else 1
+    with ThreadPoolExecutor(max_workers=max_running) as pool:
+        running = {}
+        while pending or running:
+            for step in [step for step in pending if all(parent in task_ids for parent in step["parents"])]:
+                if len(running) >= max_running:
+                    break
+                pending.remove(step)
+                running[pool.submit(run_step, store, step, scripts[step["name"]], dict(task_ids), mode, cache)] = step
+            if not running:
+                raise ValueError(f"Steps with unknown parents: {[step['name'] for step in pending]}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    task_ids[step["name"]], status, seconds = future.result()
+                except BaseException as e:
+                    print(f"Step [{step['name']}] failed: {e}")
+                    timings[step["name"]] = ("", "failed", 0.0)
+                    pending.clear()
+                    continue
+                timings[step["name"]] = (task_ids[step["name"]], status, seconds)
+                print(f"Step [{step['name']}] {status} in {seconds:.1f}s")
+
+    print_timings(timings)
+    os.makedirs(os.path.join(store.root, "runs"), exist_ok=True)
+    with open(os.path.join(store.root, "runs", f"timings_{time.strftime('%Y%m%d_%H%M%S')}.json"), "w") as f:
+        json.dump(timings, f, indent=2)
+    if any(status == "failed" for _, status, _ in timings.values()):
+        raise RuntimeError("Local pipeline failed")
+    print(f"Local pipeline finished. Outputs of the final step: {store.task_dir(task_ids['model_evaluation'])}")
+
+
+if __name__ == "__main__":
+    main()
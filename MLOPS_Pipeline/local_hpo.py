@@ -0,0 +1,313 @@
+"""
+In-process parallel HPO for Step 4 (hpo_mode=local).
+Instead of cloning a ClearML task per trial, which cold-starts Python and TensorFlow and
+re-downloads and re-decodes the features artifact every time, the features are loaded
+once into shared memory and trials run in a pool of worker processes that attach to it
+without copying. Each worker caps TensorFlow's thread pools so parallel trials do not
+oversubscribe the CPU. Optuna (ask/tell) proposes the trials from the same search space
+as the ClearML optimizer; the per-epoch scalars every trial reports are replayed to the
+HPO task's logger when it finishes. With population_size > 1 each worker trains a group
+of trials at once with the population trainer (population_trainer.py); the members of a
+group share batch_size and epochs, which Optuna is made to propose for the whole group.
+Given a persistent study (hpo_study.py), configurations it has already evaluated are
+answered from it without training. Unless num_workers is given, the first trial runs alone
+and its peak private memory sizes how many trials run at once (trial_scheduler.py). With a
+successive halving schedule (multi_fidelity.py) trials start on a small stratified share
+of the training data and epochs, and only promoted ones are trained on more.
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import optuna
+from clearml.automation import DiscreteParameterRange, UniformIntegerParameterRange, UniformParameterRange
+
+from hpo_study import cached_trial, copy_cached_result
+from trial_scheduler import PrivateMemoryMonitor, available_memory_bytes, format_bytes, plan_workers
+
+FEATURE_KEYS = ("X_train_feat", "X_test_feat", "y_train", "y_test")
+
+# Worker-process state set by _init_worker: the attached shared blocks and array views
+_worker = {}
+
+
+class ScalarRecorder:
+    """Logger stand-in for worker processes: keeps report_scalar calls for the parent to replay."""
+
+    def __init__(self):
+        self.scalars = []
+
+    def report_scalar(self, title, series, value, iteration):
+        self.scalars.append((title, series, float(value), int(iteration)))
+
+
+def share_features(data):
+    """
+    Copy the feature arrays of data into shared memory. Returns the blocks (to close and
+    unlink when done) and picklable {key: (block name, shape, dtype)} specs for workers.
+    """
+    blocks, specs = [], {}
+    for key in FEATURE_KEYS:
+        array = np.ascontiguousarray(data[key])
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[key] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def attach_features(specs):
+    """Attach to shared feature arrays described by specs. Returns (blocks, {key: array})."""
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+
+def _init_worker(specs, num_threads):
+    # Thread limits must be in place before TensorFlow creates its thread pools
+    for variable in ("OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[variable] = str(num_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    blocks, arrays = attach_features(specs)
+    _worker.update(blocks=blocks, data=arrays, shared_bytes=sum(block.size for block in blocks))
+
+
+def _run_trials(numbers, params_list, output_dirs):
+    """Train one trial with train_models, or several at once as a population. Returns a record per trial."""
+    from model_training_hpo import train_models
+    from population_trainer import train_population
+
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+    recorders = [ScalarRecorder() for _ in numbers]
+    artifacts = [{} for _ in numbers]
+    started = time.time()
+    # Private memory only: the shared features are not this trial's to pay for
+    with PrivateMemoryMonitor(_worker["shared_bytes"]) as memory:
+        if len(numbers) == 1:
+            results = [train_models(params_list[0], _worker["data"], recorders[0], upload=artifacts[0].__setitem__,
+                                    output_dir=output_dirs[0], verbose=0)]
+        else:
+            results = train_population(params_list, _worker["data"], recorders,
+                                       [trial_artifacts.__setitem__ for trial_artifacts in artifacts], output_dirs)
+    seconds = time.time() - started
+    peak_memory = memory.peak
+    return [{"number": number, "results": trial_results, "scalars": recorder.scalars,
+             "artifacts": trial_artifacts, "seconds": seconds, "peak_memory": peak_memory}
+            for number, trial_results, recorder, trial_artifacts in zip(numbers, results, recorders, artifacts)]
+
+
+def suggest_parameters(trial, hyper_params):
+    """Suggest a value for every ClearML parameter range, mapped as OptimizerOptuna maps them."""
+    params = {}
+    for p in hyper_params:
+        if isinstance(p, UniformParameterRange):
+            params[p.name] = trial.suggest_float(p.name, p.min_value, p.max_value, step=p.step_size)
+        elif isinstance(p, UniformIntegerParameterRange):
+            high = p.max_value if p.include_max else p.max_value - p.step_size
+            params[p.name] = trial.suggest_int(p.name, p.min_value, high, step=p.step_size or 1)
+        elif isinstance(p, DiscreteParameterRange):
+            params[p.name] = trial.suggest_categorical(p.name, p.values)
+        else:
+            raise ValueError(f"Parameter type {type(p).__name__} is not supported in local HPO")
+    return params
+
+
+def run_local_hpo(hyper_params, base_params, data, num_trials, time_limit_minutes, logger, work_dir,
+                  num_workers=0, threads_per_worker=2, max_epochs=None, population_size=1, study=None,
+                  halving=None, seed=None):
+    """
+    Run num_trials Optuna trials of train_models over data, at most num_workers at a time
+    (0 sizes it from the CPUs and a calibration trial's memory), starting no new trial
+    after time_limit_minutes. base_params holds the non-searched hyperparameters; epochs
+    are capped at max_epochs. Each finished trial's scalars are reported to logger under
+    "trial <n> <title>" and its objective under objective/average_accuracy. With
+    population_size > 1, trials are proposed and trained in groups of that size. With a
+    SuccessiveHalving schedule (multi_fidelity.py) trials start at its lowest fidelity and
+    only promoted ones are trained further; the rest end as pruned trials. Trials run in
+    study when given (a new in-memory study otherwise); each trial's typed params and
+    artifact paths are kept as its user attrs. Returns the study and {trial number: record}
+    of the trials fully trained in this run.
+    """
+    from model_training_hpo import typed_parameters
+    from population_trainer import SHARED_PARAMETERS
+
+    searched = {p.name for p in hyper_params}
+
+    def ask(shared=None):
+        # A partially fixed sampler gives group members the leader's shared parameters
+        sampler = study.sampler
+        if shared:
+            study.sampler = optuna.samplers.PartialFixedSampler(shared, sampler)
+        try:
+            trial = study.ask()
+            suggested = suggest_parameters(trial, hyper_params)
+        finally:
+            study.sampler = sampler
+        params = dict(base_params)
+        params.update(suggested)
+        params = typed_parameters(params)
+        if max_epochs:
+            params["epochs"] = min(params["epochs"], int(max_epochs))
+        return trial, suggested, params
+
+    def submit(group, rung=0):
+        # group holds (trial, full-fidelity params); lower rungs train on a cut-down budget
+        partial = halving is not None and rung < halving.top_rung
+        future = pool.submit(_run_trials, [trial.number for trial, _ in group],
+                             [halving.budget_params(params, rung) if halving else params for _, params in group],
+                             [os.path.join(work_dir, f"trial_{trial.number:03d}" + (f"_rung{rung}" if partial else ""))
+                              for trial, _ in group])
+        running[future] = (group, rung)
+
+    def conclude(trial, state, value=None):
+        # Tell the study, then answer the trials that waited on the same parameters
+        in_flight.pop(repr(sorted(trial.params.items())), None)
+        study.tell(trial, value, state=state)
+        for follower in followers.pop(trial.number, []):
+            if state == optuna.trial.TrialState.COMPLETE:
+                copy_cached_result(follower, study.trials[trial.number])
+                logger.report_scalar(title="objective", series="average_accuracy", value=value,
+                                     iteration=follower.number)
+            study.tell(follower, value, state=state)
+
+    if study is None:
+        study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(seed=seed))
+    if halving is not None and population_size > 1:
+        print("Multi-fidelity HPO promotes trials one at a time; training without populations.")
+        population_size = 1
+    blocks, specs = share_features(data)
+    # Measured with the features already in shared memory, which workers map instead of copying,
+    # so trials are only charged their private memory against it
+    memory_available = available_memory_bytes()
+    max_workers = num_workers or plan_workers(threads_per_worker)
+    calibrating = not num_workers
+    slots = num_workers or 1
+    records = {}
+    evaluations = 0
+    deadline = time.time() + time_limit_minutes * 60
+    print(f"Local HPO: {num_trials} trials on "
+          + (f"{num_workers} workers" if num_workers else f"up to {max_workers} workers (CPU bound)")
+          + f" x {threads_per_worker} threads"
+          + (f", in populations of {population_size}" if population_size > 1 else "")
+          + (f", successive halving over budgets {halving.describe()} (eta={halving.eta})" if halving else ""))
+    try:
+        # Workers are spawned on demand, so a pool sized for the CPUs costs nothing while calibrating
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn"),
+                                 initializer=_init_worker, initargs=(specs, threads_per_worker)) as pool:
+            running = {}
+            # Trials proposed with the parameters of a trial still training wait for its result
+            in_flight, followers = {}, {}
+            asked = 0
+            while True:
+                while len(running) < slots and time.time() < deadline:
+                    # Promoting a configuration that earned it comes before trying a new one
+                    promotion = halving.next_promotion(finishing=asked >= num_trials and not running) \
+                        if halving else None
+                    if promotion is not None:
+                        trial, params, rung, value = promotion
+                        message = (f"Promoting trial {trial.number} to rung {rung} ({halving.budgets[rung]:.1%} budget, "
+                                   f"{halving.budget_params(params, rung)['epochs']} epochs) after "
+                                   f"average_accuracy={value:.4f} on rung {rung - 1}")
+                        print(message)
+                        logger.report_text(message)
+                        submit([(trial, params)], rung)
+                        continue
+                    if asked >= num_trials:
+                        break
+                    group, shared = [], None
+                    # Enqueued (warm-start) trials fix all their parameters, so they are only
+                    # taken as the first trial of a group
+                    while asked < num_trials and len(group) < population_size and not (
+                            shared and study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.WAITING,))):
+                        trial, suggested, params = ask(shared)
+                        asked += 1
+                        cached = cached_trial(study, trial.params, exclude_number=trial.number)
+                        if cached is not None:
+                            copy_cached_result(trial, cached)
+                            study.tell(trial, cached.value)
+                            logger.report_scalar(title="objective", series="average_accuracy", value=cached.value,
+                                                 iteration=trial.number)
+                            print(f"Trial {trial.number}: already evaluated in trial {cached.number}, "
+                                  f"reusing average_accuracy={cached.value:.4f}")
+                            continue
+                        trial.set_user_attr("params", params)
+                        key = repr(sorted(trial.params.items()))
+                        if key in in_flight:
+                            followers.setdefault(in_flight[key], []).append(trial)
+                            continue
+                        in_flight[key] = trial.number
+                        if shared is None:
+                            shared = {name: suggested[name] for name in SHARED_PARAMETERS if name in searched}
+                        group.append((trial, params))
+                    if group:
+                        submit(group)
+                if not running:
+                    break
+                # Every free slot was filled above, so there is nothing to do until a trial ends
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    group, rung = running.pop(future)
+                    try:
+                        group_records = future.result()
+                    except Exception as e:
+                        print(f"Trial(s) {[trial.number for trial, _ in group]} failed: {e}")
+                        for trial, _ in group:
+                            if halving:
+                                halving.forget(trial)
+                            conclude(trial, optuna.trial.TrialState.FAIL)
+                        continue
+                    if calibrating:
+                        calibrating = False
+                        memory_per_trial = max(record["peak_memory"] for record in group_records)
+                        slots = min(max_workers, plan_workers(threads_per_worker, memory_per_trial, memory_available))
+                        print(f"Calibration trial peaked at {format_bytes(memory_per_trial)} private memory with "
+                              f"{format_bytes(memory_available)} available: running {slots} trials at a time")
+                    for (trial, params), record in zip(group, group_records):
+                        objective = record["results"]["average_accuracy"]
+                        partial = halving is not None and rung < halving.top_rung
+                        prefix = f"trial {trial.number}" + (f" rung {rung}" if partial else "")
+                        for title, series, value, iteration in record["scalars"]:
+                            logger.report_scalar(title=f"{prefix} {title}", series=series, value=value,
+                                                 iteration=iteration)
+                        if halving:
+                            trial.report(objective, halving.step(rung))
+                            halving.record(trial, params, rung, objective, params["epochs"])
+                            evaluations += 1
+                            logger.report_scalar(title="multi-fidelity", series=f"rung {rung} ({halving.budgets[rung]:.1%})",
+                                                 value=objective, iteration=trial.number)
+                            logger.report_scalar(title="multi-fidelity", series="budget spent (full trials)",
+                                                 value=halving.spent, iteration=evaluations)
+                        if partial:
+                            print(f"Trial {trial.number}: average_accuracy={objective:.4f} on rung {rung} "
+                                  f"({halving.budgets[rung]:.1%} budget) in {record['seconds']:.1f}s")
+                            continue
+                        trial.set_user_attr("artifacts", record["artifacts"])
+                        conclude(trial, optuna.trial.TrialState.COMPLETE, objective)
+                        record["params"] = params
+                        records[trial.number] = record
+                        logger.report_scalar(title="objective", series="average_accuracy", value=objective,
+                                             iteration=trial.number)
+                        print(f"Trial {trial.number}: average_accuracy={objective:.4f} in {record['seconds']:.1f}s "
+                              f"with {params}")
+            if halving:
+                # Configurations never promoted to the full budget end as pruned trials
+                for trial in list(halving.stopped.values()):
+                    conclude(trial, optuna.trial.TrialState.PRUNED)
+                message = (f"Successive halving: {len(records)} of {evaluations} evaluations at full budget, "
+                           f"{halving.spent:.2f} full-trial equivalents of compute")
+                print(message)
+                logger.report_text(message)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return study, records
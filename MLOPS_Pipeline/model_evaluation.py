@@ -5,6 +5,9 @@ import numpy as np
 import json
 from tensorflow.keras.models import load_model
 
+from dataset_io import open_processed_data
+from feature_io import check_model_input, load_features
+
 # Init ClearML Task
 task = Task.init(project_name="BNM Pipeline", task_name="Model Evaluation")
 logger = task.get_logger()
@@ -21,17 +24,18 @@ eye_history_path = training_task.artifacts["eye_history"].get_local_copy()
 yawn_model_path = training_task.artifacts["yawn_model"].get_local_copy()
 
 # Load test data
-features = np.load(features_path)
-labels = np.load(labels_path)
+features = load_features(features_path, keys=("X_test_feat",))  # Flattened whatever the feature head
+labels = open_processed_data(labels_path)
 X_test = features["X_test_feat"]
-if X_test.ndim == 5:
-    X_test = X_test.reshape((X_test.shape[0], -1))  # Flatten if not already
+print(f"Feature head: {features['feature_head']} (per-sample shape {features['feature_shape']})")
 
 y_test = labels["y_test"]
 
 # Load models
 eye_model = load_model(eye_model_path)
 yawn_model = load_model(yawn_model_path)
+check_model_input(eye_model, X_test, "Eye model")
+check_model_input(yawn_model, X_test, "Yawn model")
 
 # ------------------ Eye Model Evaluation ------------------
 eye_pred_probs = eye_model.predict(X_test).flatten()
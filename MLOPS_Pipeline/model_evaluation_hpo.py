@@ -15,6 +15,10 @@ import matplotlib
 matplotlib.use('Agg')
 import os
 
+from artifact_cache import cached_local_copy
+from feature_io import check_model_input, load_features
+from step_cache import upstream_task
+
 def main():
     # Initialize ClearML Task
     task = Task.init(project_name="BNM Pipeline HPO", task_name="Step 5 - Model Evaluation HPO")
@@ -25,8 +29,8 @@ def main():
     task.add_requirements("matplotlib")
 
     # Get the best models from the HPO task
-    hpo_task = Task.get_task(task_name="Step 4 - Hyperparameter Optimization", 
-                            project_name="BNM Pipeline HPO")
+    hpo_task = upstream_task("hpo", "Step 4 - Hyperparameter Optimization",
+                             project_name="BNM Pipeline HPO")
     
     # Get the best parameters
     best_params_path = hpo_task.artifacts["best_parameters"].get_local_copy()
@@ -51,20 +55,18 @@ def main():
         yawn_history = json.load(f)
     
     # Get test data from feature extraction task
-    features_path = Task.get_task(task_name="Step 2 - Feature Extraction",
-                                 project_name="BNM Pipeline HPO").artifacts["features"].get_local_copy()
+    features_path = cached_local_copy(upstream_task("feature_extraction", "Step 2 - Feature Extraction",
+                                                    project_name="BNM Pipeline HPO").artifacts["features"],
+                                      logger=task.get_logger())
     
-    with np.load(features_path) as data:
-        X_test_feat = data["X_test_feat"]
-        y_test = data["y_test"]
+    # Features are flattened to (N, D) whichever Step 2 feature head produced them
+    data = load_features(features_path, keys=("X_test_feat", "y_test"))
+    X_test_feat = data["X_test_feat"]
+    y_test = data["y_test"]
     
+    print(f"Feature head: {data['feature_head']} (per-sample shape {data['feature_shape']})")
     print(f"Test data shapes: X_test_feat: {X_test_feat.shape}, y_test: {y_test.shape}")
     
-    # Reshape if needed
-    if len(X_test_feat.shape) > 2:
-        X_test_feat = X_test_feat.reshape(X_test_feat.shape[0], -1)
-        print(f"Reshaped test features: {X_test_feat.shape}")
-    
     # Split test data for eye and yawn models
     test_half = len(X_test_feat) // 2
     X_test_eyes, y_test_eyes = X_test_feat[:test_half], y_test[:test_half]
@@ -73,10 +75,22 @@ def main():
     # Load the models
     eye_model = tf.keras.models.load_model(best_eye_model_path)
     yawn_model = tf.keras.models.load_model(best_yawn_model_path)
-    
-    # Evaluate the models
-    eye_loss, eye_accuracy = eye_model.evaluate(X_test_eyes, y_test_eyes)
-    yawn_loss, yawn_accuracy = yawn_model.evaluate(X_test_yawn, y_test_yawn)
+    check_model_input(eye_model, X_test_feat, "Eye model")
+    check_model_input(yawn_model, X_test_feat, "Yawn model")
+    
+    # Evaluate the models. A multi-task best trial gives both probabilities for every test
+    # sample from a single forward pass of the combined model
+    multitask_artifact = hpo_task.artifacts.get("best_multitask_model")
+    multitask_model = None
+    if multitask_artifact:
+        multitask_model = tf.keras.models.load_model(multitask_artifact.get_local_copy())
+        check_model_input(multitask_model, X_test_feat, "Multi-task model")
+        probs = multitask_model.predict(X_test_feat)
+        eye_accuracy = float(np.mean((probs["eye"][:test_half, 0] > 0.5) == y_test_eyes))
+        yawn_accuracy = float(np.mean((probs["yawn"][test_half:, 0] > 0.5) == y_test_yawn))
+    else:
+        eye_loss, eye_accuracy = eye_model.evaluate(X_test_eyes, y_test_eyes)
+        yawn_loss, yawn_accuracy = yawn_model.evaluate(X_test_yawn, y_test_yawn)
     
     # Calculate average accuracy
     average_accuracy = (eye_accuracy + yawn_accuracy) / 2.0
@@ -147,6 +161,9 @@ def main():
     # Upload final models
     task.upload_artifact("final_eye_model", artifact_object="final_eye_model.h5")
     task.upload_artifact("final_yawn_model", artifact_object="final_yawn_model.h5")
+    if multitask_model is not None:
+        multitask_model.save("final_multitask_model.h5")
+        task.upload_artifact("final_multitask_model", artifact_object="final_multitask_model.h5")
     
     print("Model evaluation completed successfully!")
 
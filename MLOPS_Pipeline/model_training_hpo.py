@@ -10,69 +10,85 @@ from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense, Dropout, BatchNormalization
 from tensorflow.keras.optimizers import Adam
 import json
+import os
 
-def main():
-    # Initialize ClearML Task
-    task = Task.init(project_name="BNM Pipeline HPO", task_name="Step 3 - Model Training HPO")
-
-    # Define hyperparameters as a flat dictionary (no 'Args/' prefix)
-    # This is critical for HPO to work correctly
-    hyperparameters = {
-        "learning_rate": 0.001,
-        "batch_size": 32,
-        "num_units_1": 512,
-        "num_units_2": 512,
-        "dropout_rate": 0.5,
-        "epochs": 1  # Default epochs
-    }
-    print(f"Initial default hyperparameters dictionary: {hyperparameters}")
+from artifact_cache import cached_local_copy
+from feature_dataset import make_feature_dataset
+from feature_io import load_features, open_features
+from multitask_model import (build_multitask_model, compile_multitask_model, task_history,
+                             task_sample_weights, task_submodel)
+from step_cache import upstream_task
+from training_callbacks import AVERAGE_LOG_KEY, ClearMLEpochReporter, early_stopping
 
-    # Connect the dictionary. HPO will override these values.
-    effective_params = task.connect(hyperparameters)
-    print(f"Effective parameters after task.connect(): {effective_params}")
-    
-    # Ensure types are correct after fetching
-    try:
-        actual_params = {
-            "learning_rate": float(effective_params["learning_rate"]),
-            "batch_size": int(effective_params["batch_size"]),
-            "num_units_1": int(effective_params["num_units_1"]),
-            "num_units_2": int(effective_params["num_units_2"]),
-            "dropout_rate": float(effective_params["dropout_rate"]),
-            "epochs": int(effective_params["epochs"])
-        }
-    except KeyError as e:
-        print(f"ERROR: A hyperparameter key was missing: {e}. Check HPO configuration.")
-        raise
-    except ValueError as e:
-        print(f"ERROR: Could not convert a hyperparameter to its correct type: {e}")
-        raise
+# Hyperparameters as a flat dictionary (no 'Args/' prefix), connected by main().
+# This is critical for HPO to work correctly
+DEFAULT_HYPERPARAMETERS = {
+    "learning_rate": 0.001,
+    "batch_size": 32,
+    "num_units_1": 512,
+    "num_units_2": 512,
+    "dropout_rate": 0.5,
+    "epochs": 1,  # Default epochs
+    # "memory" loads all features into RAM; "stream" memory-maps them and feeds a
+    # tf.data pipeline (shuffle buffer, batching, prefetch), optionally cached in RAM
+    "input_mode": "memory",
+    "shuffle_buffer": 10000,
+    "cache_features": False,
+    # One model with eye and yawn outputs, trained in a single pass over the features,
+    # instead of two separate models; optionally sharing the first dense block
+    "multitask": False,
+    "shared_first_block": False,
+    # Stop a head once its validation accuracy has not improved for this many epochs and
+    # keep its best epoch's weights (0 trains every epoch)
+    "early_stopping_patience": 3,
+    # Train on this stratified share of each task's training rows (multi-fidelity HPO trains
+    # cheap low-fidelity trials on small fractions); validation always uses every row
+    "train_fraction": 1.0
+}
 
-    print(f"Typed effective parameters for script use: {actual_params}")
 
-    # Add requirements directly to the task
-    task.add_requirements("numpy", ">=1.19.5,<2.0.0")
-    task.add_requirements("tensorflow")
-
-    # --- Load Data ---
-    features_path = Task.get_task(task_name="Step 2 - Feature Extraction",
-                                 project_name="BNM Pipeline HPO").artifacts["features"].get_local_copy()
+def typed_parameters(effective_params):
+    """The connected hyperparameters with their script types (ClearML may hand back strings)."""
+    return {
+        "learning_rate": float(effective_params["learning_rate"]),
+        "batch_size": int(effective_params["batch_size"]),
+        "num_units_1": int(effective_params["num_units_1"]),
+        "num_units_2": int(effective_params["num_units_2"]),
+        "dropout_rate": float(effective_params["dropout_rate"]),
+        "epochs": int(effective_params["epochs"]),
+        "input_mode": str(effective_params["input_mode"]),
+        "shuffle_buffer": int(effective_params["shuffle_buffer"]),
+        "cache_features": str(effective_params["cache_features"]).lower() in ("true", "1", "yes"),
+        "multitask": str(effective_params["multitask"]).lower() in ("true", "1", "yes"),
+        "shared_first_block": str(effective_params["shared_first_block"]).lower() in ("true", "1", "yes"),
+        "early_stopping_patience": int(effective_params["early_stopping_patience"]),
+        "train_fraction": float(effective_params["train_fraction"])
+    }
 
-    print(f"Loading features from: {features_path}")
 
-    with np.load(features_path) as data:
-        X_train_feat = data["X_train_feat"]
-        X_test_feat = data["X_test_feat"]
-        y_train = data["y_train"]
-        y_test = data["y_test"]
+def stratified_subset(y, fraction, seed=0):
+    """
+    Sorted indices of a stratified fraction of the rows labelled y: the same share of
+    every class, at least one row each. The fixed seed gives every trial the same subset.
+    """
+    if fraction >= 1.0:
+        return np.arange(len(y))
+    rng = np.random.default_rng(seed)
+    indices = [rng.choice(rows, size=max(1, int(np.ceil(len(rows) * fraction))), replace=False)
+               for rows in (np.flatnonzero(y == label) for label in np.unique(y))]
+    return np.sort(np.concatenate(indices)) if indices else np.arange(0)
 
-    print(f"Feature shapes: X_train_feat: {X_train_feat.shape}, X_test_feat: {X_test_feat.shape}")
-    print(f"Label shapes: y_train: {y_train.shape}, y_test: {y_test.shape}")
 
-    if len(X_train_feat.shape) > 2:
-        X_train_feat = X_train_feat.reshape(X_train_feat.shape[0], -1)
-        X_test_feat = X_test_feat.reshape(X_test_feat.shape[0], -1)
-        print(f"Reshaped features: X_train_feat: {X_train_feat.shape}, X_test_feat: {X_test_feat.shape}")
+def task_splits(data, train_fraction=1.0):
+    """
+    (X_train, y_train, X_val, y_val) per task. Eye samples are the first half and yawn
+    samples the second half of each split; a task without test samples validates on the
+    last 20% of its training samples. Training rows are cut to a stratified train_fraction.
+    """
+    X_train_feat = data["X_train_feat"]
+    X_test_feat = data["X_test_feat"]
+    y_train = data["y_train"]
+    y_test = data["y_test"]
 
     total_samples = len(X_train_feat)
     half_point = total_samples // 2
@@ -93,15 +109,126 @@ def main():
         split_point = int(len(X_train_yawn) * 0.8)
         X_test_yawn, y_test_yawn = X_train_yawn[split_point:], y_train_yawn[split_point:]
         X_train_yawn, y_train_yawn = X_train_yawn[:split_point], y_train_yawn[:split_point]
+
+    if train_fraction < 1.0:
+        eye_rows = stratified_subset(y_train_eyes, train_fraction)
+        yawn_rows = stratified_subset(y_train_yawn, train_fraction)
+        X_train_eyes, y_train_eyes = X_train_eyes[eye_rows], y_train_eyes[eye_rows]
+        X_train_yawn, y_train_yawn = X_train_yawn[yawn_rows], y_train_yawn[yawn_rows]
+
+    return {"eye": (X_train_eyes, y_train_eyes, X_test_eyes, y_test_eyes),
+            "yawn": (X_train_yawn, y_train_yawn, X_test_yawn, y_test_yawn)}
+
+
+def train_models(actual_params, data, logger, upload, output_dir=".", verbose=2):
+    """
+    Train the eye and yawn heads (or the multi-task model) on the features in data,
+    report per-epoch and final validation scalars to logger, save the models and histories
+    under output_dir and hand each file to upload(artifact_name, path). Returns the final
+    eye, yawn and average validation accuracies.
+    """
+    streaming = actual_params["input_mode"] == "stream"
+    X_train_feat = data["X_train_feat"]
+    X_test_feat = data["X_test_feat"]
+    y_train = data["y_train"]
+    y_test = data["y_test"]
+
+    total_samples = len(X_train_feat)
+    half_point = total_samples // 2
+    test_samples = len(X_test_feat)
+    test_half = test_samples // 2
+    splits = task_splits(data, actual_params['train_fraction'])
+    X_train_eyes, y_train_eyes, X_test_eyes, y_test_eyes = splits["eye"]
+    X_train_yawn, y_train_yawn, X_test_yawn, y_test_yawn = splits["yawn"]
+    if actual_params['train_fraction'] < 1.0:
+        print(f"Training on a stratified {actual_params['train_fraction']:.1%} of the training samples")
         
     print(f"Eye detection dataset: {len(X_train_eyes)} training samples, {len(X_test_eyes)} testing samples")
     print(f"Yawn detection dataset: {len(X_train_yawn)} training samples, {len(X_test_yawn)} testing samples")
 
+    def fit_inputs(X_train, y_train, X_val, y_val, train_weights=None, val_weights=None):
+        """model.fit arguments, as in-memory arrays or streaming datasets."""
+        if not streaming:
+            validation_data = (X_val, y_val) if val_weights is None else (X_val, y_val, val_weights)
+            return {"x": X_train, "y": y_train, "sample_weight": train_weights,
+                    "validation_data": validation_data, "batch_size": actual_params['batch_size']}
+        return {
+            "x": make_feature_dataset(X_train, y_train, actual_params['batch_size'], shuffle=True,
+                                      shuffle_buffer=actual_params['shuffle_buffer'],
+                                      cache=actual_params['cache_features'], sample_weight=train_weights),
+            "validation_data": make_feature_dataset(X_val, y_val, actual_params['batch_size'],
+                                                    cache=actual_params['cache_features'],
+                                                    sample_weight=val_weights),
+        }
+
+    def trial_callbacks(series, monitor, **reporter_kwargs):
+        """Per-epoch ClearML reporting (read by the HPO pruner) plus optional early stopping."""
+        callbacks = [ClearMLEpochReporter(logger, series, **reporter_kwargs)]
+        stopper = early_stopping(monitor, actual_params['early_stopping_patience'])
+        if stopper is not None:
+            callbacks.append(stopper)
+        return callbacks, stopper
+
+    def publish_head(name, model, history, stopper=None):
+        """Save and upload one head and its history; returns the validation accuracy of the kept weights."""
+        model.save(os.path.join(output_dir, f"{name}_feature_best.h5"))
+        upload(f"{name}_model", os.path.join(output_dir, f"{name}_feature_best.h5"))
+        with open(os.path.join(output_dir, f"{name}_history.json"), "w") as f:
+            json.dump(history, f)
+        upload(f"{name}_history", os.path.join(output_dir, f"{name}_history.json"))
+        # With early stopping the model holds the weights of its best epoch, not the last one
+        best_epoch = stopper.best_epoch if stopper is not None else -1
+        val_accuracy = history['val_accuracy'][best_epoch] if history.get('val_accuracy') else 0.0
+        logger.report_scalar(title="validation", series=f"{name}_accuracy", value=val_accuracy, iteration=actual_params['epochs'])
+        return val_accuracy
+
     eye_val_accuracy = 0.0
     yawn_val_accuracy = 0.0
 
+    # Multi-task mode trains on the whole feature matrices, so it needs the regular layout:
+    # eye rows in the first half and yawn rows in the second half of both splits
+    multitask = actual_params['multitask']
+    if multitask and not (0 < half_point < total_samples and 0 < test_half < test_samples):
+        print("Multi-task mode needs eye and yawn samples in both splits; training separate models instead.")
+        multitask = False
+    if multitask and actual_params['train_fraction'] < 1.0:
+        # The same stratified rows as the separate heads would get, in the same eye-then-yawn layout
+        eye_rows = stratified_subset(y_train[:half_point], actual_params['train_fraction'])
+        yawn_rows = half_point + stratified_subset(y_train[half_point:], actual_params['train_fraction'])
+        rows = np.concatenate([eye_rows, yawn_rows])
+        X_train_feat, y_train = X_train_feat[rows], y_train[rows]
+        half_point, total_samples = len(eye_rows), len(rows)
+
+    # --- Multi-task Model ---
+    if multitask:
+        print(f"\n--- TRAINING MULTI-TASK MODEL WITH {actual_params['epochs']} EPOCHS (Batch: {actual_params['batch_size']}, LR: {actual_params['learning_rate']}, shared first block: {actual_params['shared_first_block']}) ---")
+        multitask_model = build_multitask_model(X_train_feat.shape[1], actual_params['num_units_1'],
+                                                actual_params['num_units_2'], actual_params['dropout_rate'],
+                                                shared_first_block=actual_params['shared_first_block'])
+        compile_multitask_model(multitask_model, actual_params['learning_rate'])
+        train_weights = task_sample_weights(total_samples, {"eye": (0, half_point), "yawn": (half_point, total_samples)})
+        val_weights = task_sample_weights(test_samples, {"eye": (0, test_half), "yawn": (test_half, test_samples)})
+        callbacks, stopper = trial_callbacks({"eye_accuracy": "val_eye_accuracy", "yawn_accuracy": "val_yawn_accuracy"},
+                                             monitor=AVERAGE_LOG_KEY)
+        print("Training multi-task model...")
+        multitask_history = multitask_model.fit(
+            **fit_inputs(X_train_feat, {"eye": y_train, "yawn": y_train}, X_test_feat, {"eye": y_test, "yawn": y_test},
+                         train_weights=train_weights, val_weights=val_weights),
+            epochs=actual_params['epochs'],
+            callbacks=callbacks,
+            verbose=verbose
+        )
+        # The combined model returns both probabilities from one forward call; the per-task
+        # views keep the eye/yawn artifacts that HPO and evaluation already consume
+        multitask_model.save(os.path.join(output_dir, "multitask_feature_best.h5"))
+        upload("multitask_model", os.path.join(output_dir, "multitask_feature_best.h5"))
+        eye_val_accuracy = publish_head("eye", task_submodel(multitask_model, "eye"),
+                                        task_history(multitask_history.history, "eye"), stopper)
+        yawn_val_accuracy = publish_head("yawn", task_submodel(multitask_model, "yawn"),
+                                         task_history(multitask_history.history, "yawn"), stopper)
+
     # --- Eye Model --- 
-    if len(X_train_eyes) > 0 and len(X_test_eyes) > 0:
+    elif len(X_train_eyes) > 0 and len(X_test_eyes) > 0:
         print(f"\n--- TRAINING EYE MODEL WITH {actual_params['epochs']} EPOCHS (Batch: {actual_params['batch_size']}, LR: {actual_params['learning_rate']}) ---")
         eye_model = Sequential([
             Dense(actual_params['num_units_1'], activation='relu', input_shape=(X_train_eyes.shape[1],)),
@@ -114,27 +241,22 @@ def main():
         ])
         eye_model.compile(optimizer=Adam(learning_rate=actual_params['learning_rate']),
                           loss='binary_crossentropy', metrics=['accuracy'])
+        # The average is reported per epoch by the head trained last
+        callbacks, stopper = trial_callbacks({"eye_accuracy": "val_accuracy"}, monitor="val_accuracy",
+                                             report_average=not (len(X_train_yawn) > 0 and len(X_test_yawn) > 0))
         print("Training eye detection model...")
         eye_history = eye_model.fit(
-            X_train_eyes, y_train_eyes,
-            validation_data=(X_test_eyes, y_test_eyes),
+            **fit_inputs(X_train_eyes, y_train_eyes, X_test_eyes, y_test_eyes),
             epochs=actual_params['epochs'],
-            batch_size=actual_params['batch_size'],
-            verbose=2
+            callbacks=callbacks,
+            verbose=verbose
         )
-        eye_model.save("eye_feature_best.h5")
-        task.upload_artifact("eye_model", artifact_object="eye_feature_best.h5")
-        with open("eye_history.json", "w") as f:
-            json.dump(eye_history.history, f)
-        task.upload_artifact("eye_history", artifact_object="eye_history.json")
-        if 'val_accuracy' in eye_history.history and eye_history.history['val_accuracy']:
-            eye_val_accuracy = eye_history.history['val_accuracy'][-1]
-        task.get_logger().report_scalar(title="validation", series="eye_accuracy", value=eye_val_accuracy, iteration=actual_params['epochs'])
+        eye_val_accuracy = publish_head("eye", eye_model, eye_history.history, stopper)
     else:
         print("Skipping eye model training due to insufficient data.")
 
     # --- Yawn Model --- 
-    if len(X_train_yawn) > 0 and len(X_test_yawn) > 0:
+    if not multitask and len(X_train_yawn) > 0 and len(X_test_yawn) > 0:
         print(f"\n--- TRAINING YAWN MODEL WITH {actual_params['epochs']} EPOCHS (Batch: {actual_params['batch_size']}, LR: {actual_params['learning_rate']}) ---")
         yawn_model = Sequential([
             Dense(actual_params['num_units_1'], activation='relu', input_shape=(X_train_yawn.shape[1],)),
@@ -147,23 +269,17 @@ def main():
         ])
         yawn_model.compile(optimizer=Adam(learning_rate=actual_params['learning_rate']),
                            loss='binary_crossentropy', metrics=['accuracy'])
+        callbacks, stopper = trial_callbacks({"yawn_accuracy": "val_accuracy"}, monitor="val_accuracy",
+                                             fixed_accuracies={"eye_accuracy": eye_val_accuracy} if eye_val_accuracy > 0 else None)
         print("Training yawn detection model...")
         yawn_history = yawn_model.fit(
-            X_train_yawn, y_train_yawn,
-            validation_data=(X_test_yawn, y_test_yawn),
+            **fit_inputs(X_train_yawn, y_train_yawn, X_test_yawn, y_test_yawn),
             epochs=actual_params['epochs'],
-            batch_size=actual_params['batch_size'],
-            verbose=2
+            callbacks=callbacks,
+            verbose=verbose
         )
-        yawn_model.save("yawn_feature_best.h5")
-        task.upload_artifact("yawn_model", artifact_object="yawn_feature_best.h5")
-        with open("yawn_history.json", "w") as f:
-            json.dump(yawn_history.history, f)
-        task.upload_artifact("yawn_history", artifact_object="yawn_history.json")
-        if 'val_accuracy' in yawn_history.history and yawn_history.history['val_accuracy']:
-            yawn_val_accuracy = yawn_history.history['val_accuracy'][-1]
-        task.get_logger().report_scalar(title="validation", series="yawn_accuracy", value=yawn_val_accuracy, iteration=actual_params['epochs'])
-    else:
+        yawn_val_accuracy = publish_head("yawn", yawn_model, yawn_history.history, stopper)
+    elif not multitask:
         print("Skipping yawn model training due to insufficient data.")
 
     # --- Report Objective Metric for HPO ---
@@ -175,11 +291,62 @@ def main():
     elif yawn_val_accuracy > 0:
         average_val_accuracy = yawn_val_accuracy
         
-    task.get_logger().report_scalar(title="validation", series="average_accuracy", value=average_val_accuracy, iteration=actual_params['epochs'])
+    logger.report_scalar(title="validation", series="average_accuracy", value=average_val_accuracy, iteration=actual_params['epochs'])
+    return {"eye_accuracy": eye_val_accuracy, "yawn_accuracy": yawn_val_accuracy,
+            "average_accuracy": average_val_accuracy}
+
+
+def main():
+    # Initialize ClearML Task
+    task = Task.init(project_name="BNM Pipeline HPO", task_name="Step 3 - Model Training HPO")
+
+    hyperparameters = dict(DEFAULT_HYPERPARAMETERS)
+    print(f"Initial default hyperparameters dictionary: {hyperparameters}")
+
+    # Connect the dictionary. HPO will override these values.
+    effective_params = task.connect(hyperparameters)
+    print(f"Effective parameters after task.connect(): {effective_params}")
+    
+    # Ensure types are correct after fetching
+    try:
+        actual_params = typed_parameters(effective_params)
+    except KeyError as e:
+        print(f"ERROR: A hyperparameter key was missing: {e}. Check HPO configuration.")
+        raise
+    except ValueError as e:
+        print(f"ERROR: Could not convert a hyperparameter to its correct type: {e}")
+        raise
+
+    print(f"Typed effective parameters for script use: {actual_params}")
+
+    # Add requirements directly to the task
+    task.add_requirements("numpy", ">=1.19.5,<2.0.0")
+    task.add_requirements("tensorflow")
+
+    # --- Load Data ---
+    # Every trial on this agent reuses one downloaded, decompressed copy of the features
+    features_path = cached_local_copy(upstream_task("feature_extraction", "Step 2 - Feature Extraction",
+                                                    project_name="BNM Pipeline HPO").artifacts["features"],
+                                      logger=task.get_logger())
+
+    print(f"Loading features from: {features_path}")
+
+    # Features are flattened to (N, D) whichever Step 2 feature head produced them. In stream
+    # mode they stay memory-mapped views, so slicing below does not copy anything
+    streaming = actual_params["input_mode"] == "stream"
+    data = open_features(features_path) if streaming else load_features(features_path)
+
+    print(f"Feature head: {data['feature_head']} (per-sample shape {data['feature_shape']})")
+    print(f"Feature shapes: X_train_feat: {data['X_train_feat'].shape}, X_test_feat: {data['X_test_feat'].shape}")
+    print(f"Label shapes: y_train: {data['y_train'].shape}, y_test: {data['y_test'].shape}")
+    task.set_user_properties(feature_head=data["feature_head"], feature_dim=data["X_train_feat"].shape[1])
+
+    results = train_models(actual_params, data, task.get_logger(),
+                           upload=lambda name, path: task.upload_artifact(name, artifact_object=path))
 
-    print(f"Final Eye Validation Accuracy: {eye_val_accuracy:.4f}")
-    print(f"Final Yawn Validation Accuracy: {yawn_val_accuracy:.4f}")
-    print(f"Final Average Validation Accuracy for HPO: {average_val_accuracy:.4f}")
+    print(f"Final Eye Validation Accuracy: {results['eye_accuracy']:.4f}")
+    print(f"Final Yawn Validation Accuracy: {results['yawn_accuracy']:.4f}")
+    print(f"Final Average Validation Accuracy for HPO: {results['average_accuracy']:.4f}")
 
     print("Model training script completed.")
 
@@ -0,0 +1,82 @@
+"""
+Multi-fidelity schedule for local HPO: asynchronous successive halving (ASHA) over the
+share of training data and epochs a trial gets.
+Rung r trains on a stratified budget_r of the training rows for the same share of the
+trial's epochs; budgets grow by eta per rung up to the full data and epochs, starting
+from min_fraction rounded down to a power of 1/eta. Every new configuration starts on the
+lowest rung, and as soon as it ranks among the top 1/eta of the results reported on its
+rung it is promoted to the next one, so workers never wait for a rung to fill up.
+Configurations that are never promoted stop early; their low-fidelity scores still reach
+the Optuna sampler as intermediate values of pruned trials, as in BOHB.
+"""
+import math
+
+
+class SuccessiveHalving:
+    """Rung budgets and ASHA promotion bookkeeping for the trials of one local HPO run."""
+
+    def __init__(self, min_fraction, eta=3):
+        if not 0 < min_fraction <= 1:
+            raise ValueError(f"min_fraction must be in (0, 1], got {min_fraction}")
+        if eta < 2:
+            raise ValueError(f"eta must be at least 2, got {eta}")
+        self.eta = int(eta)
+        num_rungs = int(math.floor(math.log(1 / min_fraction, self.eta) + 1e-9)) + 1
+        self.budgets = [float(self.eta) ** (rung - num_rungs + 1) for rung in range(num_rungs)]
+        self.results = [[] for _ in self.budgets]
+        self.promoted = [set() for _ in self.budgets]
+        self.stopped = {}
+        self.spent = 0.0
+
+    @property
+    def top_rung(self):
+        return len(self.budgets) - 1
+
+    def budget_params(self, params, rung):
+        """params trained at the budget of rung: train_fraction and a matching share of the epochs."""
+        budget = self.budgets[rung]
+        params = dict(params)
+        params["train_fraction"] = budget if rung < self.top_rung else params.get("train_fraction", 1.0)
+        params["epochs"] = max(1, int(math.ceil(params["epochs"] * budget)))
+        return params
+
+    def step(self, rung):
+        """Optuna intermediate-value step of rung: its budget in percent of the full trial."""
+        return int(round(self.budgets[rung] * 100))
+
+    def record(self, trial, params, rung, value, full_epochs):
+        """Add a result at rung; params are the full-fidelity ones, kept for promotion."""
+        self.results[rung].append((value, trial, params))
+        self.spent += self.budgets[rung] * math.ceil(full_epochs * self.budgets[rung]) / full_epochs
+        if rung < self.top_rung:
+            self.stopped[trial.number] = trial
+        else:
+            self.stopped.pop(trial.number, None)
+
+    def forget(self, trial):
+        """Drop a trial that failed, so it is neither promoted nor pruned later."""
+        self.stopped.pop(trial.number, None)
+        for promoted in self.promoted:
+            promoted.add(trial.number)
+
+    def next_promotion(self, finishing=False):
+        """
+        (trial, params, next rung, value) of a configuration due for promotion, highest rung
+        first, or None. When finishing (no new configurations will come) and no trial has
+        reached the full budget yet, the best configuration of the highest rung is promoted
+        regardless of the 1/eta cut, so a run always ends with a fully trained trial.
+        """
+        for rung in reversed(range(self.top_rung)):
+            ranked = sorted(self.results[rung], key=lambda result: result[0], reverse=True)
+            cut = len(ranked) // self.eta
+            if finishing and not self.results[self.top_rung] and ranked:
+                cut = max(cut, 1)
+            for value, trial, params in ranked[:cut]:
+                if trial.number not in self.promoted[rung]:
+                    self.promoted[rung].add(trial.number)
+                    self.stopped.pop(trial.number, None)
+                    return trial, params, rung + 1, value
+        return None
+
+    def describe(self):
+        return " -> ".join(f"{budget:.1%}" for budget in self.budgets)
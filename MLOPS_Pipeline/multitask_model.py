@@ -0,0 +1,70 @@
+"""
+Multi-task head for Step 3: one model over the shared feature input with an eye and a
+yawn sigmoid output, optionally sharing the first dense block. Eye and yawn samples live
+in the same feature matrix (first and second half of each split), so the whole matrix is
+fed once per epoch and per-sample weights mask each output's loss and accuracy to the
+rows of its own task.
+"""
+import numpy as np
+from tensorflow.keras import Input, Model
+from tensorflow.keras.layers import BatchNormalization, Dense, Dropout
+from tensorflow.keras.optimizers import Adam
+
+TASK_OUTPUTS = ("eye", "yawn")
+
+
+def _dense_block(x, units, dropout_rate, name):
+    x = Dense(units, activation='relu', name=f"{name}_dense")(x)
+    x = BatchNormalization(name=f"{name}_bn")(x)
+    return Dropout(dropout_rate, name=f"{name}_dropout")(x)
+
+
+def build_multitask_model(input_dim, num_units_1, num_units_2, dropout_rate, shared_first_block=False):
+    """
+    Model with the same layers per output as the separate eye/yawn heads. With
+    shared_first_block, both outputs sit on one num_units_1 block instead of one each.
+    """
+    inputs = Input(shape=(input_dim,), name="features")
+    shared = _dense_block(inputs, num_units_1, dropout_rate, "shared_1") if shared_first_block else None
+    outputs = {}
+    for task in TASK_OUTPUTS:
+        x = shared if shared is not None else _dense_block(inputs, num_units_1, dropout_rate, f"{task}_1")
+        x = _dense_block(x, num_units_2, dropout_rate, f"{task}_2")
+        outputs[task] = Dense(1, activation='sigmoid', name=task)(x)
+    return Model(inputs, outputs, name="multitask_head")
+
+
+def compile_multitask_model(model, learning_rate):
+    # weighted_metrics, so the sample weights also mask accuracy to each output's own rows
+    model.compile(optimizer=Adam(learning_rate=learning_rate),
+                  loss={task: 'binary_crossentropy' for task in TASK_OUTPUTS},
+                  weighted_metrics={task: ['accuracy'] for task in TASK_OUTPUTS})
+    return model
+
+
+def task_sample_weights(num_rows, ranges):
+    """
+    Per-output sample weights for num_rows rows where task rows are ranges[task] =
+    (start, stop): 0 outside the range, and scaled inside it so that each output's loss
+    is the mean over its own rows, as in a separately trained head.
+    """
+    weights = {}
+    for task in TASK_OUTPUTS:
+        start, stop = ranges[task]
+        weight = np.zeros(num_rows, dtype=np.float32)
+        if stop > start:
+            weight[start:stop] = num_rows / (stop - start)
+        weights[task] = weight
+    return weights
+
+
+def task_submodel(model, task):
+    """Single-output model for one task, sharing the layers (and weights) of model."""
+    return Model(model.input, model.get_layer(task).output, name=f"{task}_head")
+
+
+def task_history(history, task):
+    """The Keras history of one output, with the keys of a separately trained head."""
+    return {f"{prefix}{metric}": history[f"{prefix}{task}_{metric}"]
+            for prefix in ("", "val_") for metric in ("loss", "accuracy")
+            if f"{prefix}{task}_{metric}" in history}
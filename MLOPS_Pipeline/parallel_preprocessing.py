@@ -0,0 +1,163 @@
+"""
+Parallel decode-and-resize engine for Step 1 (Smart Data Preprocessing).
+Image paths are split into chunks and handed to a pool of worker processes. Every worker
+decodes and resizes its chunk straight into a preallocated shared-memory output array,
+so only file paths and a per-image success flag cross the process boundary.
+Large datasets are processed in fixed-size blocks that reuse the same pool and buffer.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# Per-process state of a pool worker, filled in by _init_worker
+_worker_state = {}
+
+
+def collect_labelled_files(dataset_root, labels):
+    """Return (paths, labels) for every file in the label folders of dataset_root."""
+    paths = []
+    path_labels = []
+    for category, label in labels.items():
+        folder_path = os.path.join(dataset_root, category)
+        if not os.path.exists(folder_path):
+            print(f"Skipping missing folder: {folder_path}")
+            continue
+        for file in sorted(os.listdir(folder_path)):
+            paths.append(os.path.join(folder_path, file))
+            path_labels.append(label)
+    return paths, np.array(path_labels)
+
+
+def _decode_into(out, start, paths, image_size, cache=None):
+    """
+    Decode and resize paths into out[start:start + len(paths)]. With a PreprocessingCache,
+    cached tensors are copied in instead and fresh decodes are stored. Returns
+    (success flags, number of cache hits).
+    """
+    ok = np.zeros(len(paths), dtype=bool)
+    hits = 0
+    for offset, img_path in enumerate(paths):
+        key = None
+        if cache is not None:
+            key = cache.key_for(img_path)
+            cached = cache.load(key)
+            if cached is not None:
+                out[start + offset] = cached
+                ok[offset] = True
+                hits += 1
+                continue
+        img = cv2.imread(img_path)
+        if img is None:
+            continue
+        out[start + offset] = cv2.resize(img, image_size)
+        ok[offset] = True
+        if cache is not None:
+            cache.store(key, out[start + offset])
+    return ok, hits
+
+
+def _init_worker(shm_name, shape, image_size, cache):
+    # One decode per process: let the pool provide the parallelism, not OpenCV threads
+    cv2.setNumThreads(1)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state["shm"] = shm
+    _worker_state["out"] = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    _worker_state["image_size"] = image_size
+    _worker_state["cache"] = cache
+
+
+def _process_chunk(start, paths):
+    ok, hits = _decode_into(_worker_state["out"], start, paths, _worker_state["image_size"],
+                            _worker_state["cache"])
+    return start, ok, hits
+
+
+def resolve_num_workers(num_workers):
+    """num_workers <= 0 means one worker per available CPU core."""
+    num_workers = int(num_workers)
+    if num_workers > 0:
+        return num_workers
+    return os.cpu_count() or 1
+
+
+class ParallelPreprocessor:
+    """
+    Long-lived worker pool plus shared output buffer holding up to `capacity` images.
+    Use as a context manager and call run() once per block of paths, so a dataset can be
+    processed block by block (e.g. one shard at a time) without restarting the pool.
+    An optional PreprocessingCache is consulted per image; hits and misses are counted.
+    """
+
+    def __init__(self, image_size, capacity, num_workers=0, chunk_size=64, cache=None):
+        self.image_size = image_size
+        self.capacity = max(1, int(capacity))
+        self.num_workers = resolve_num_workers(num_workers)
+        self.chunk_size = max(1, int(chunk_size))
+        self.shape = (self.capacity, image_size[1], image_size[0], 3)
+        self.cache = cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._shm = None
+        self._out = None
+        self._executor = None
+
+    def __enter__(self):
+        if self.num_workers == 1:
+            self._out = np.empty(self.shape, dtype=np.uint8)
+            return self
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self._out = np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker,
+                                             initargs=(self._shm.name, self.shape, self.image_size, self.cache))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._out = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def run(self, paths):
+        """Decode a block of at most `capacity` paths; returns (images copy, valid flags)."""
+        if len(paths) > self.capacity:
+            raise ValueError(f"Block of {len(paths)} paths exceeds preprocessor capacity {self.capacity}")
+        valid = np.zeros(len(paths), dtype=bool)
+        hits = 0
+        if self._executor is None:
+            valid[:], hits = _decode_into(self._out, 0, paths, self.image_size, self.cache)
+        else:
+            futures = [self._executor.submit(_process_chunk, start, paths[start:start + self.chunk_size])
+                       for start in range(0, len(paths), self.chunk_size)]
+            for future in futures:
+                start, ok, chunk_hits = future.result()
+                valid[start:start + len(ok)] = ok
+                hits += chunk_hits
+        if self.cache is not None:
+            self.cache_hits += hits
+            self.cache_misses += len(paths) - hits
+        return self._out[:len(paths)][valid], valid
+
+
+def preprocess_images(paths, image_size, num_workers=0, chunk_size=64, cache=None):
+    """
+    Decode and resize every image in paths to image_size (width, height) as uint8 BGR.
+    Returns (images, valid, elapsed_seconds). Unreadable files are dropped from images
+    and marked False in valid, which is aligned with paths.
+    """
+    start_time = time.time()
+    if not paths:
+        shape = (0, image_size[1], image_size[0], 3)
+        return np.empty(shape, dtype=np.uint8), np.zeros(0, dtype=bool), 0.0
+
+    with ParallelPreprocessor(image_size, len(paths), num_workers=num_workers,
+                              chunk_size=chunk_size, cache=cache) as preprocessor:
+        images, valid = preprocessor.run(paths)
+    return images, valid, time.time() - start_time
@@ -2,45 +2,147 @@
 Pipeline controller script for Drowsiness Detection with HPO.
 This script orchestrates the entire pipeline, from preprocessing to HPO and evaluation.
 """
-from clearml import Task
+from clearml import Dataset, Task
 from clearml.automation import PipelineController
 
-def main():
+from step_cache import CACHE_SECTION, INPUTS_SECTION, StepCacheJob, code_hash
+
+EXECUTION_QUEUE = "bnm04"
+
+# Reuse a step's previous successful run instead of enqueuing it when its code, parameters
+# and input artifacts are unchanged (see step_cache.py)
+CACHE_STEPS = True
+
+# Script behind each step, hashed with the local modules it imports into the step's cache key
+STEP_SCRIPTS = {
+    "preprocessing": "smart_data_preprocessing_deep.py",
+    "feature_extraction": "feature_extraction.py",
+    "model_training_base": "model_training_hpo.py",
+    "hpo": "hpo_optimizer.py",
+    "model_evaluation": "model_evaluation_hpo.py"
+}
+
+# Number of parallel Step 2 extraction tasks. With more than one, each task extracts an
+# index range of the dataset on whichever agent is free, and a merge step concatenates the
+# parts into the features artifact. To try it on one machine, start several agents on
+# EXECUTION_QUEUE with start_agent.py (NUM_AGENTS; it serves EXECUTION_QUEUE by default).
+FEATURE_EXTRACTION_WORKERS = 1
+
+
+def step_inputs(script, inputs=()):
+    """Parameter overrides keying a step's cache on its code and passing it the ids of its input steps."""
+    parameters = {f"{CACHE_SECTION}/code_hash": code_hash(script)}
+    parameters.update({f"{INPUTS_SECTION}/{step}": f"${{{step}.id}}" for step in inputs})
+    return parameters
+
+
+def dataset_version():
+    """Id of the latest "Drowsiness Dataset" version, the input of Step 1 (empty if it cannot be read)."""
+    try:
+        return Dataset.get(dataset_name="Drowsiness Dataset", dataset_project="BNM Pipeline").id
+    except Exception as e:
+        print(f"Could not read the dataset version, Step 1 is cached on code and parameters only: {e}")
+        return ""
+
+
+def add_feature_extraction_steps(pipe, num_workers, parents, cache=CACHE_STEPS):
+    """Add Step 2, fanned out over num_workers tasks. Returns the name of the final step."""
+    if num_workers <= 1:
+        pipe.add_step(
+            name="feature_extraction",
+            base_task_project="BNM Pipeline HPO",
+            base_task_name="Step 2 - Feature Extraction",
+            parameter_override=step_inputs(STEP_SCRIPTS["feature_extraction"], inputs=["preprocessing"]),
+            parents=parents,
+            execution_queue=EXECUTION_QUEUE,
+            cache_executed_step=cache
+        )
+        return "feature_extraction"
+
+    part_steps = []
+    for part_index in range(num_workers):
+        part_steps.append(f"feature_extraction_part_{part_index}")
+        pipe.add_step(
+            name=part_steps[-1],
+            base_task_project="BNM Pipeline HPO",
+            base_task_name="Step 2 - Feature Extraction",
+            parameter_override={
+                "General/num_parts": num_workers,
+                "General/part_index": part_index,
+                **step_inputs(STEP_SCRIPTS["feature_extraction"], inputs=["preprocessing"])
+            },
+            parents=parents,
+            execution_queue=EXECUTION_QUEUE,
+            cache_executed_step=cache
+        )
+    # The merge step keeps the Step 2 task name, so later steps find the merged features
+    pipe.add_step(
+        name="feature_extraction",
+        base_task_project="BNM Pipeline HPO",
+        base_task_name="Step 2 - Feature Extraction",
+        parameter_override={
+            "General/mode": "merge",
+            "General/part_task_ids": ",".join(f"${{{step}.id}}" for step in part_steps),
+            **step_inputs(STEP_SCRIPTS["feature_extraction"])
+        },
+        parents=part_steps,
+        execution_queue=EXECUTION_QUEUE,
+        cache_executed_step=cache
+    )
+    return "feature_extraction"
+
+
+def main(feature_extraction_workers=FEATURE_EXTRACTION_WORKERS, cache=CACHE_STEPS):
     # Initialize the pipeline controller
     pipe = PipelineController(
         project="BNM Pipeline HPO",
         name="Drowsiness Detection Pipeline with HPO",
         version="1.0"
     )
-    
+    if cache:
+        # Cache keys come from step_cache.py. PipelineController has no public hook for its job
+        # class, so this sets the private attribute it creates step jobs with (when it has one)
+        if hasattr(pipe, "_clearml_job_class"):
+            pipe._clearml_job_class = StepCacheJob
+        else:
+            print("This ClearML version has no pipeline job class to replace; "
+                  "steps are cached on ClearML's own task hash")
+    add_pipeline_steps(pipe, feature_extraction_workers, cache)
+
+    pipe.start_locally(run_pipeline_steps_locally=False)
+
+    print("Pipeline started! Monitor progress in the ClearML UI.")
+
+
+def add_pipeline_steps(pipe, feature_extraction_workers=FEATURE_EXTRACTION_WORKERS, cache=CACHE_STEPS):
+    """Add Steps 1-5 to pipe: the PipelineController, or the recorder of local_executor.py."""
     # Add Step 1: Smart Data Preprocessing (already completed)
     pipe.add_step(
         name="preprocessing",
         base_task_project="BNM Pipeline HPO",
         base_task_name="Step 1 - Smart Data Preprocessing (Deep Scan)",
-        parameter_override={},
+        parameter_override={
+            f"{CACHE_SECTION}/dataset_version": dataset_version(),
+            **step_inputs(STEP_SCRIPTS["preprocessing"])
+        },
         parents=[],
-        execution_queue="bnm04"
+        execution_queue=EXECUTION_QUEUE,
+        cache_executed_step=cache
     )
     
-    # Add Step 2: Feature Extraction
-    pipe.add_step(
-        name="feature_extraction",
-        base_task_project="BNM Pipeline HPO",
-        base_task_name="Step 2 - Feature Extraction",
-        parameter_override={},
-        parents=["preprocessing"],
-        execution_queue="bnm04"
-    )
+    # Add Step 2: Feature Extraction (optionally fanned out over several agents)
+    feature_step = add_feature_extraction_steps(pipe, feature_extraction_workers, parents=["preprocessing"],
+                                                cache=cache)
     
     # Add Step 3: Model Training HPO (base task for HPO)
     pipe.add_step(
         name="model_training_base",
         base_task_project="BNM Pipeline HPO",
         base_task_name="Step 3 - Model Training HPO",
-        parameter_override={},
-        parents=["feature_extraction"],
-        execution_queue="bnm04"
+        parameter_override=step_inputs(STEP_SCRIPTS["model_training_base"], inputs=[feature_step]),
+        parents=[feature_step],
+        execution_queue=EXECUTION_QUEUE,
+        cache_executed_step=cache
     )
     
     # Add Step 4: Hyperparameter Optimization
@@ -51,10 +153,12 @@ def main():
         parameter_override={
             "Args/num_trials": 10,
             "Args/time_limit_minutes": 60,
-            "Args/max_epochs": 20
+            "Args/max_epochs": 20,
+            **step_inputs(STEP_SCRIPTS["hpo"], inputs=[feature_step, "model_training_base"])
         },
         parents=["model_training_base"],
-        execution_queue="bnm04"
+        execution_queue=EXECUTION_QUEUE,
+        cache_executed_step=cache
     )
     
     # Add Step 5: Model Evaluation
@@ -62,15 +166,12 @@ def main():
         name="model_evaluation",
         base_task_project="BNM Pipeline HPO",
         base_task_name="Step 5 - Model Evaluation HPO",
-        parameter_override={},
+        parameter_override=step_inputs(STEP_SCRIPTS["model_evaluation"], inputs=[feature_step, "hpo"]),
         parents=["hpo"],
-        execution_queue="bnm04"
+        execution_queue=EXECUTION_QUEUE,
+        cache_executed_step=cache
     )
 
 
-    pipe.start_locally(run_pipeline_steps_locally=False)
-
-    print("Pipeline started! Monitor progress in the ClearML UI.")
-
 if __name__ == "__main__":
     main()
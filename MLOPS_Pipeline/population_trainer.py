@@ -0,0 +1,291 @@
+"""
+Population training of Step 3 heads.
+K configurations of the eye/yawn dense head (num_units_1, num_units_2, dropout_rate,
+learning_rate) are trained together on the same batches: the member weights are stacked
+along a leading K axis and applied with einsum, so one forward/backward pass over a batch
+trains every member. Members narrower than the widest one are zero-padded and masked,
+dropout rates and Adam learning rates are per member, and each member keeps its own
+batch-norm statistics, validation curve and best epoch. Members share batch_size and
+epochs. A trained member exports to the same Sequential head model_training_hpo.py builds.
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import BatchNormalization, Dense, Dropout
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.optimizers import Adam
+
+from model_training_hpo import task_splits
+from training_callbacks import ClearMLEpochReporter
+
+# Keras defaults of the layers and optimizer used by the separately trained heads
+BN_MOMENTUM = 0.99
+BN_EPSILON = 1e-3
+ADAM_BETA_1 = 0.9
+ADAM_BETA_2 = 0.999
+ADAM_EPSILON = 1e-7
+
+# Parameters every member of one population must share
+SHARED_PARAMETERS = ("batch_size", "epochs", "early_stopping_patience", "train_fraction")
+
+
+def _glorot_uniform(rng, shape, fans):
+    """Stacked glorot_uniform kernels; member k uses its own (fan_in, fan_out) = fans[k]."""
+    limits = np.sqrt(6.0 / np.array([fan_in + fan_out for fan_in, fan_out in fans], dtype=np.float64))
+    return (rng.uniform(-1.0, 1.0, size=shape) * limits.reshape((-1,) + (1,) * (len(shape) - 1))).astype(np.float32)
+
+
+def _unit_mask(units, width):
+    return np.stack([np.arange(width) < count for count in units]).astype(np.float32)
+
+
+class HeadPopulation(tf.Module):
+    """K stacked Dense-BN-Dropout x2 -> Dense(1) heads with per-member widths, dropout and learning rate."""
+
+    def __init__(self, input_dim, configs, seed=None):
+        super().__init__()
+        self.configs = [dict(config) for config in configs]
+        units_1 = [int(config["num_units_1"]) for config in configs]
+        units_2 = [int(config["num_units_2"]) for config in configs]
+        size, width_1, width_2 = len(configs), max(units_1), max(units_2)
+        rng = np.random.default_rng(seed)
+        mask_1 = _unit_mask(units_1, width_1)
+        mask_2 = _unit_mask(units_2, width_2)
+
+        self.mask_1 = tf.constant(mask_1[:, None, :])
+        self.mask_2 = tf.constant(mask_2[:, None, :])
+        self.dropout_rate = tf.constant(np.array([config["dropout_rate"] for config in configs],
+                                                 dtype=np.float32).reshape(size, 1, 1))
+        self.learning_rate = tf.constant(np.array([config["learning_rate"] for config in configs], dtype=np.float32))
+
+        def variable(value):
+            return tf.Variable(np.asarray(value, dtype=np.float32))
+
+        # Padded kernel entries start (and, having zero gradient, stay) at zero
+        self.kernel_1 = variable(_glorot_uniform(rng, (size, input_dim, width_1),
+                                                 [(input_dim, u) for u in units_1]) * mask_1[:, None, :])
+        self.bias_1 = variable(np.zeros((size, 1, width_1)))
+        self.gamma_1 = variable(np.ones((size, 1, width_1)))
+        self.beta_1 = variable(np.zeros((size, 1, width_1)))
+        self.moving_mean_1 = variable(np.zeros((size, 1, width_1)))
+        self.moving_variance_1 = variable(np.ones((size, 1, width_1)))
+        self.kernel_2 = variable(_glorot_uniform(rng, (size, width_1, width_2), list(zip(units_1, units_2)))
+                                 * mask_1[:, :, None] * mask_2[:, None, :])
+        self.bias_2 = variable(np.zeros((size, 1, width_2)))
+        self.gamma_2 = variable(np.ones((size, 1, width_2)))
+        self.beta_2 = variable(np.zeros((size, 1, width_2)))
+        self.moving_mean_2 = variable(np.zeros((size, 1, width_2)))
+        self.moving_variance_2 = variable(np.ones((size, 1, width_2)))
+        self.kernel_3 = variable(_glorot_uniform(rng, (size, width_2), [(u, 1) for u in units_2]) * mask_2)
+        self.bias_3 = variable(np.zeros((size, 1)))
+
+        self.trainables = [self.kernel_1, self.bias_1, self.gamma_1, self.beta_1,
+                           self.kernel_2, self.bias_2, self.gamma_2, self.beta_2,
+                           self.kernel_3, self.bias_3]
+        self.state = self.trainables + [self.moving_mean_1, self.moving_variance_1,
+                                        self.moving_mean_2, self.moving_variance_2]
+        self.slots = [(tf.Variable(tf.zeros_like(v)), tf.Variable(tf.zeros_like(v))) for v in self.trainables]
+        self.iterations = tf.Variable(0.0)
+        self.dropout_rng = tf.random.Generator.from_seed(int(rng.integers(2 ** 31)))
+
+    def _block(self, projection, bias, gamma, beta, moving_mean, moving_variance, mask, training):
+        h = tf.nn.relu(projection + bias)
+        if training:
+            mean, variance = tf.nn.moments(h, axes=[1], keepdims=True)
+            moving_mean.assign(moving_mean * BN_MOMENTUM + mean * (1 - BN_MOMENTUM))
+            moving_variance.assign(moving_variance * BN_MOMENTUM + variance * (1 - BN_MOMENTUM))
+        else:
+            mean, variance = moving_mean, moving_variance
+        h = (h - mean) * tf.math.rsqrt(variance + BN_EPSILON) * gamma + beta
+        if training:
+            keep = self.dropout_rng.uniform(tf.shape(h)) >= self.dropout_rate
+            h = tf.where(keep, h / (1 - self.dropout_rate), tf.zeros_like(h))
+        return h * mask
+
+    def logits(self, x, training=False):
+        """(K, batch) logits of every member for a (batch, input_dim) feature batch."""
+        h = self._block(tf.einsum("bd,kdu->kbu", x, self.kernel_1), self.bias_1, self.gamma_1, self.beta_1,
+                        self.moving_mean_1, self.moving_variance_1, self.mask_1, training)
+        h = self._block(tf.einsum("kbu,kuv->kbv", h, self.kernel_2), self.bias_2, self.gamma_2, self.beta_2,
+                        self.moving_mean_2, self.moving_variance_2, self.mask_2, training)
+        return tf.einsum("kbv,kv->kb", h, self.kernel_3) + self.bias_3
+
+    @tf.function(reduce_retracing=True)
+    def train_step(self, x, y):
+        """One Adam step for all members on a shared batch. Returns per-member loss and correct count."""
+        labels = tf.broadcast_to(y[None, :], [len(self.configs), tf.shape(y)[0]])
+        with tf.GradientTape() as tape:
+            logits = self.logits(x, training=True)
+            losses = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=logits), axis=1)
+            # Members have disjoint weights, so the gradient of the sum is each member's own gradient
+            total_loss = tf.reduce_sum(losses)
+        gradients = tape.gradient(total_loss, self.trainables)
+        self.iterations.assign_add(1.0)
+        step_size = self.learning_rate * tf.sqrt(1 - ADAM_BETA_2 ** self.iterations) / (1 - ADAM_BETA_1 ** self.iterations)
+        for var, gradient, (m, v) in zip(self.trainables, gradients, self.slots):
+            m.assign(ADAM_BETA_1 * m + (1 - ADAM_BETA_1) * gradient)
+            v.assign(ADAM_BETA_2 * v + (1 - ADAM_BETA_2) * tf.square(gradient))
+            member_step = tf.reshape(step_size, [-1] + [1] * (len(var.shape) - 1))
+            var.assign_sub(member_step * m / (tf.sqrt(v) + ADAM_EPSILON))
+        correct = tf.reduce_sum(tf.cast(tf.equal(logits > 0, labels > 0.5), tf.float32), axis=1)
+        return losses, correct
+
+    @tf.function(reduce_retracing=True)
+    def eval_step(self, x, y):
+        labels = tf.broadcast_to(y[None, :], [len(self.configs), tf.shape(y)[0]])
+        logits = self.logits(x, training=False)
+        loss_sum = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(labels=labels, logits=logits), axis=1)
+        correct = tf.reduce_sum(tf.cast(tf.equal(logits > 0, labels > 0.5), tf.float32), axis=1)
+        return loss_sum, correct
+
+    def evaluate(self, X, y, batch_size):
+        """Per-member (loss, accuracy) arrays over X, y."""
+        y = np.asarray(y, dtype=np.float32)
+        loss_sum = np.zeros(len(self.configs))
+        correct = np.zeros(len(self.configs))
+        for start in range(0, len(X), batch_size):
+            batch_loss, batch_correct = self.eval_step(tf.constant(np.asarray(X[start:start + batch_size], dtype=np.float32)),
+                                                       tf.constant(y[start:start + batch_size]))
+            loss_sum += batch_loss.numpy()
+            correct += batch_correct.numpy()
+        return loss_sum / len(X), correct / len(X)
+
+    def fit(self, X_train, y_train, X_val, y_val, batch_size, epochs, patience=0, on_epoch_end=None, seed=None):
+        """
+        Train every member for up to epochs passes over X_train. Returns each member's Keras
+        style history and the epoch whose weights it keeps. With patience > 0 this mirrors
+        EarlyStopping(restore_best_weights=True) per member on val_accuracy: each member
+        ends with the weights of its best epoch, and training stops once no member has
+        improved for patience epochs. on_epoch_end(epoch, histories) runs after every epoch.
+        """
+        size = len(self.configs)
+        rng = np.random.default_rng(seed)
+        y_train = np.asarray(y_train, dtype=np.float32)
+        histories = [{"loss": [], "accuracy": [], "val_loss": [], "val_accuracy": []} for _ in range(size)]
+        best_accuracy = np.full(size, -np.inf)
+        best_epoch = np.zeros(size, dtype=int)
+        best_state = None
+        for epoch in range(epochs):
+            order = rng.permutation(len(X_train))
+            loss_sum = np.zeros(size)
+            correct = np.zeros(size)
+            for start in range(0, len(order), batch_size):
+                # Sorted indices keep the reads sequential for memory-mapped features
+                indices = np.sort(order[start:start + batch_size])
+                losses, batch_correct = self.train_step(tf.constant(np.asarray(X_train[indices], dtype=np.float32)),
+                                                        tf.constant(y_train[indices]))
+                loss_sum += losses.numpy() * len(indices)
+                correct += batch_correct.numpy()
+            val_loss, val_accuracy = self.evaluate(X_val, y_val, batch_size)
+            for k, history in enumerate(histories):
+                history["loss"].append(float(loss_sum[k] / len(order)))
+                history["accuracy"].append(float(correct[k] / len(order)))
+                history["val_loss"].append(float(val_loss[k]))
+                history["val_accuracy"].append(float(val_accuracy[k]))
+
+            improved = val_accuracy > best_accuracy
+            if patience > 0:
+                state = [var.numpy() for var in self.state]
+                best_state = state if best_state is None else [
+                    np.where(improved.reshape((-1,) + (1,) * (new.ndim - 1)), new, old)
+                    for new, old in zip(state, best_state)]
+            best_accuracy[improved] = val_accuracy[improved]
+            best_epoch[improved] = epoch
+            if on_epoch_end is not None:
+                on_epoch_end(epoch, histories)
+            if patience > 0 and np.all(epoch - best_epoch >= patience):
+                print(f"Epoch {epoch + 1}: early stopping (no member improved for {patience} epochs)")
+                break
+
+        if patience <= 0:
+            return histories, [-1] * size
+        for var, value in zip(self.state, best_state):
+            var.assign(value)
+        return histories, best_epoch.tolist()
+
+    def export_member(self, k):
+        """Member k as the compiled Sequential head of model_training_hpo.py."""
+        config = self.configs[k]
+        units_1, units_2 = int(config["num_units_1"]), int(config["num_units_2"])
+        model = Sequential([
+            Dense(units_1, activation='relu', input_shape=(self.kernel_1.shape[1],)),
+            BatchNormalization(momentum=BN_MOMENTUM, epsilon=BN_EPSILON),
+            Dropout(config["dropout_rate"]),
+            Dense(units_2, activation='relu'),
+            BatchNormalization(momentum=BN_MOMENTUM, epsilon=BN_EPSILON),
+            Dropout(config["dropout_rate"]),
+            Dense(1, activation='sigmoid')
+        ])
+        model.set_weights([
+            self.kernel_1[k, :, :units_1], self.bias_1[k, 0, :units_1],
+            self.gamma_1[k, 0, :units_1], self.beta_1[k, 0, :units_1],
+            self.moving_mean_1[k, 0, :units_1], self.moving_variance_1[k, 0, :units_1],
+            self.kernel_2[k, :units_1, :units_2], self.bias_2[k, 0, :units_2],
+            self.gamma_2[k, 0, :units_2], self.beta_2[k, 0, :units_2],
+            self.moving_mean_2[k, 0, :units_2], self.moving_variance_2[k, 0, :units_2],
+            self.kernel_3[k, :units_2, None], self.bias_3[k],
+        ])
+        model.compile(optimizer=Adam(learning_rate=config["learning_rate"]),
+                      loss='binary_crossentropy', metrics=['accuracy'])
+        return model
+
+
+def train_population(params_list, data, loggers, uploads, output_dirs, seed=None):
+    """
+    train_models for a population: trains the eye and yawn heads of every configuration in
+    params_list together. Member k reports to loggers[k], saves under output_dirs[k] and
+    hands its files to uploads[k], exactly as a separately trained trial would. Returns
+    the train_models results of every member.
+    """
+    for name in SHARED_PARAMETERS:
+        if len({params[name] for params in params_list}) > 1:
+            raise ValueError(f"Population members must share {name}, got {[params[name] for params in params_list]}")
+    batch_size = params_list[0]["batch_size"]
+    epochs = params_list[0]["epochs"]
+    patience = params_list[0]["early_stopping_patience"]
+    splits = task_splits(data, params_list[0]["train_fraction"])
+    trainable = {task: len(split[0]) > 0 and len(split[2]) > 0 for task, split in splits.items()}
+    accuracies = {task: [0.0] * len(params_list) for task in splits}
+
+    for task in ("eye", "yawn"):
+        if not trainable[task]:
+            print(f"Skipping {task} population training due to insufficient data.")
+            continue
+        X_train, y_train, X_val, y_val = splits[task]
+        print(f"\n--- TRAINING {task.upper()} POPULATION OF {len(params_list)} HEADS WITH {epochs} EPOCHS (Batch: {batch_size}) ---")
+        # Same per-epoch scalars as train_models: the average comes from the head trained last
+        reporters = [
+            ClearMLEpochReporter(logger, {f"{task}_accuracy": "val_accuracy"},
+                                 report_average=task == "yawn" or not trainable["yawn"],
+                                 fixed_accuracies={"eye_accuracy": accuracies["eye"][k]}
+                                 if task == "yawn" and accuracies["eye"][k] > 0 else None)
+            for k, logger in enumerate(loggers)]
+
+        def on_epoch_end(epoch, histories):
+            for reporter, history in zip(reporters, histories):
+                reporter.on_epoch_end(epoch, {"val_accuracy": history["val_accuracy"][-1]})
+
+        population = HeadPopulation(X_train.shape[1], params_list, seed=seed)
+        histories, best_epochs = population.fit(X_train, y_train, X_val, y_val, batch_size, epochs,
+                                                patience=patience, on_epoch_end=on_epoch_end, seed=seed)
+        for k, (history, best_epoch) in enumerate(zip(histories, best_epochs)):
+            model_path = os.path.join(output_dirs[k], f"{task}_feature_best.h5")
+            history_path = os.path.join(output_dirs[k], f"{task}_history.json")
+            population.export_member(k).save(model_path)
+            uploads[k](f"{task}_model", model_path)
+            with open(history_path, "w") as f:
+                json.dump(history, f)
+            uploads[k](f"{task}_history", history_path)
+            accuracies[task][k] = history["val_accuracy"][best_epoch]
+            loggers[k].report_scalar(title="validation", series=f"{task}_accuracy", value=accuracies[task][k], iteration=epochs)
+
+    results = []
+    for k, logger in enumerate(loggers):
+        trained = [accuracies[task][k] for task in ("eye", "yawn") if accuracies[task][k] > 0]
+        average = sum(trained) / len(trained) if trained else 0.0
+        logger.report_scalar(title="validation", series="average_accuracy", value=average, iteration=epochs)
+        results.append({"eye_accuracy": accuracies["eye"][k], "yawn_accuracy": accuracies["yawn"][k],
+                        "average_accuracy": average})
+    return results
@@ -0,0 +1,70 @@
+"""
+Persistent per-image cache for Step 1 (Smart Data Preprocessing).
+Entries are keyed by the SHA-256 of the source file contents plus a digest of the
+preprocessing parameters (image size, color mode), so a new version of the
+"Drowsiness Dataset" only decodes the files that were added or changed. Every other
+image is served from the cached uint8 tensor, wherever the dataset copy lives on disk.
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+# Bump when the decode/resize logic changes so stale tensors are never reused
+CACHE_VERSION = 1
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".clearml", "bnm_cache", "preprocessing")
+
+
+class PreprocessingCache:
+    """
+    Content-addressed store of preprocessed images. Instances only hold paths and
+    parameters, so they can be shipped to pool workers, which read and write entries
+    concurrently (writes are atomic renames).
+    """
+
+    def __init__(self, cache_dir, image_size, color_mode="bgr"):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.params = {"version": CACHE_VERSION, "image_size": list(image_size), "color_mode": color_mode}
+        params_digest = hashlib.sha256(json.dumps(self.params, sort_keys=True).encode()).hexdigest()[:16]
+        self.root = os.path.join(self.cache_dir, params_digest)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    def key_for(self, img_path):
+        return file_sha256(img_path)
+
+    def load(self, key):
+        """Return the cached tensor for key, or None on a miss (or an unreadable entry)."""
+        try:
+            return np.load(self._entry_path(key))
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, img):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, img)
+        os.replace(tmp_path, entry_path)
+
+    def record_run(self, dataset_id, hits, misses):
+        """Append the hit/miss counts of one preprocessing run to the cache's run log."""
+        with open(os.path.join(self.root, "runs.jsonl"), "a") as f:
+            f.write(json.dumps({"dataset_id": dataset_id, "hits": hits, "misses": misses,
+                                "time": time.time()}) + "\n")
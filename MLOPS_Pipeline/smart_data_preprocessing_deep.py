@@ -1,26 +1,20 @@
 from clearml import Task, Dataset
 import os
+import shutil
 import sys
-import cv2
+import time
 import numpy as np
 from sklearn.model_selection import train_test_split
 
-#  Fix encoding issues for Windows terminals
-sys.stdout.reconfigure(encoding='utf-8')
-
-# Step 0: Initialize ClearML task
-task = Task.init(project_name="BNM Pipeline", task_name="Step 1 - Smart Data Preprocessing (Deep Scan)")
-
-# Fix numpy version conflict
-task.add_requirements("numpy", ">=1.19.5,<2.0.0")
-
-# Step 1: Get dataset from ClearML
-dataset = Dataset.get(dataset_name="Drowsiness Dataset", dataset_project="BNM Pipeline")
-dataset_path = dataset.get_local_copy()
+from dataset_io import ShardWriter, open_sharded_dataset, to_storage_dtype, write_shard_index
+from landmark_roi import ROI_NAMES, RoiExtractor
+from parallel_preprocessing import ParallelPreprocessor, collect_labelled_files, resolve_num_workers
+from preprocessing_cache import PreprocessingCache
 
 # Folder mappings
 LABELS = {"Closed": 1, "yawn": 1, "Open": 0, "no_yawn": 0}
 expected_folders = set(LABELS.keys())
+IMAGE_SIZE = (224, 224)
 
 # Step 2: Find the root directory that contains all label folders
 def find_best_dataset_root(root_path):
@@ -29,50 +23,203 @@ def find_best_dataset_root(root_path):
             return root
     return None
 
-resolved_dataset_path = find_best_dataset_root(dataset_path)
-if not resolved_dataset_path:
-    raise ValueError("Could not locate dataset folders: Closed, Yawn, Open, no_yawn")
-
-print(f"Using dataset path: {resolved_dataset_path}")
-
-# Step 3: Print structure
-print("Folder structure:")
-for root, dirs, _ in os.walk(resolved_dataset_path):
-    level = root.replace(resolved_dataset_path, "").count(os.sep)
-    indent = "    " * level
-    print(f"{indent}- {os.path.basename(root)}/")
-    for d in dirs:
-        print(f"{indent}    - {d}/")
-
-# Step 4: Preprocess and label images
-IMAGE_SIZE = (224, 224)
-data = []
-
-for category, label in LABELS.items():
-    folder_path = os.path.join(resolved_dataset_path, category)
-    if not os.path.exists(folder_path):
-        print(f"Skipping missing folder: {folder_path}")
-        continue
-    for file in os.listdir(folder_path):
-        img_path = os.path.join(folder_path, file)
-        img = cv2.imread(img_path)
-        if img is None:
-            continue
-        img = cv2.resize(img, IMAGE_SIZE)
-        data.append([img, label])
-
-if not data:
-    raise ValueError("No data found. Please check dataset folder structure.")
-
-# Prepare dataset arrays
-X, y = zip(*data)
-X = np.array(X) / 255.0
-y = np.array(y)
-
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
-
-# Save and upload
-np.savez("processed_data.npz", X_train=X_train, X_test=X_test, y_train=y_train, y_test=y_test)
-task.upload_artifact("processed_data", artifact_object="processed_data.npz")
-
-print("Preprocessing completed and uploaded to ClearML.")
+def main():
+    #  Fix encoding issues for Windows terminals
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    # Step 0: Initialize ClearML task
+    task = Task.init(project_name="BNM Pipeline", task_name="Step 1 - Smart Data Preprocessing (Deep Scan)")
+
+    # Fix numpy version conflict
+    task.add_requirements("numpy", ">=1.19.5,<2.0.0")
+
+    # Preprocessing engine settings (num_workers <= 0 uses every available core).
+    # storage_dtype "uint8" keeps raw pixels and lets consumers normalize lazily,
+    # "float64" reproduces the legacy pre-scaled artifact.
+    # output_format "shards" streams fixed-size .npy shards to disk, "npz" writes the
+    # legacy monolithic processed_data.npz.
+    args = {
+        "num_workers": 0,
+        "chunk_size": 64,
+        "storage_dtype": "uint8",
+        "output_format": "shards",
+        "shard_size": 1024,
+        "use_cache": True,
+        "cache_dir": "",
+        "roi_crops": False,
+        "roi_size": 64,
+    }
+    args = task.connect(args)
+    num_workers = resolve_num_workers(args["num_workers"])
+    chunk_size = int(args["chunk_size"])
+    use_cache = str(args["use_cache"]).lower() in ("true", "1", "yes")
+    roi_crops = str(args["roi_crops"]).lower() in ("true", "1", "yes")
+    if roi_crops and args["output_format"] != "shards":
+        raise ValueError("roi_crops requires output_format 'shards'")
+
+    # Step 1: Get dataset from ClearML
+    dataset = Dataset.get(dataset_name="Drowsiness Dataset", dataset_project="BNM Pipeline")
+    dataset_path = dataset.get_local_copy()
+
+    resolved_dataset_path = find_best_dataset_root(dataset_path)
+    if not resolved_dataset_path:
+        raise ValueError("Could not locate dataset folders: Closed, Yawn, Open, no_yawn")
+
+    print(f"Using dataset path: {resolved_dataset_path}")
+
+    # Step 3: Print structure
+    print("Folder structure:")
+    for root, dirs, _ in os.walk(resolved_dataset_path):
+        level = root.replace(resolved_dataset_path, "").count(os.sep)
+        indent = "    " * level
+        print(f"{indent}- {os.path.basename(root)}/")
+        for d in dirs:
+            print(f"{indent}    - {d}/")
+
+    # Step 4: Preprocess and label images with the parallel engine
+    paths, labels = collect_labelled_files(resolved_dataset_path, LABELS)
+    if not paths:
+        raise ValueError("No data found. Please check dataset folder structure.")
+
+    cache = PreprocessingCache(args["cache_dir"], IMAGE_SIZE, color_mode="bgr") if use_cache else None
+    if cache is not None:
+        print(f"Using preprocessing cache at {cache.root}")
+    print(f"Preprocessing {len(paths)} files with {num_workers} workers (chunk size {chunk_size})...")
+    # The legacy npz layout decodes everything in one block; shards are decoded one shard at a time
+    block_capacity = len(paths) if args["output_format"] == "npz" else int(args["shard_size"])
+    with ParallelPreprocessor(IMAGE_SIZE, block_capacity, num_workers=num_workers,
+                              chunk_size=chunk_size, cache=cache) as preprocessor:
+        if args["output_format"] == "shards":
+            num_images, elapsed, kept_paths = build_sharded_dataset(preprocessor, paths, labels,
+                                                                    "processed_data", args["storage_dtype"])
+            artifact_path = "processed_data"
+        elif args["output_format"] == "npz":
+            num_images, elapsed = build_npz_dataset(preprocessor, paths, labels, "processed_data.npz",
+                                                    args["storage_dtype"])
+            artifact_path = "processed_data.npz"
+        else:
+            raise ValueError(f"Unknown output_format '{args['output_format']}', expected 'shards' or 'npz'")
+
+    logger = task.get_logger()
+    images_per_sec = num_images / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {num_images} images ({len(paths) - num_images} unreadable) in {elapsed:.1f}s ({images_per_sec:.1f} images/sec)")
+    logger.report_scalar(title="preprocessing", series="images_per_sec", value=images_per_sec, iteration=0)
+
+    if cache is not None:
+        lookups = preprocessor.cache_hits + preprocessor.cache_misses
+        hit_ratio = preprocessor.cache_hits / lookups if lookups else 0.0
+        print(f"Preprocessing cache: {preprocessor.cache_hits} hits, {preprocessor.cache_misses} misses "
+              f"(hit ratio {hit_ratio:.1%}) for dataset version {dataset.id}")
+        logger.report_scalar(title="preprocessing", series="cache_hit_ratio", value=hit_ratio, iteration=0)
+        logger.report_scalar(title="preprocessing", series="cache_misses", value=preprocessor.cache_misses, iteration=0)
+        cache.record_run(dataset.id, preprocessor.cache_hits, preprocessor.cache_misses)
+
+    # Step 5 (optional): landmark-based eye/mouth ROI crops aligned with the image shards
+    if roi_crops:
+        roi_size = (int(args["roi_size"]), int(args["roi_size"]))
+        print(f"Extracting {roi_size[0]}x{roi_size[1]} eye/mouth ROI crops with {num_workers} workers...")
+        with RoiExtractor(roi_size, num_workers=num_workers, chunk_size=chunk_size) as roi_extractor:
+            roi_images, roi_elapsed = build_roi_dataset(roi_extractor, kept_paths, "processed_data", "roi_data")
+        roi_per_sec = roi_images / roi_elapsed if roi_elapsed > 0 else 0.0
+        print(f"ROI stage: {roi_images} images, {roi_extractor.faces_found} with a detected face, "
+              f"{roi_elapsed:.1f}s ({roi_per_sec:.1f} images/sec)")
+        logger.report_scalar(title="roi", series="images_per_sec", value=roi_per_sec, iteration=0)
+        logger.report_scalar(title="roi", series="face_found_ratio",
+                             value=roi_extractor.faces_found / roi_images if roi_images else 0.0, iteration=0)
+        task.upload_artifact("roi_data", artifact_object="roi_data")
+
+    # Upload (a shard directory is uploaded as a folder artifact under the same name)
+    task.upload_artifact("processed_data", artifact_object=artifact_path)
+
+    print("Preprocessing completed and uploaded to ClearML.")
+
+def build_npz_dataset(preprocessor, paths, labels, output_path, storage_dtype):
+    """Legacy layout: decode everything in memory, split, and write one monolithic .npz."""
+    start_time = time.time()
+    X, valid = preprocessor.run(paths)
+    elapsed = time.time() - start_time
+    y = labels[valid]
+
+    if len(X) == 0:
+        raise ValueError("No data found. Please check dataset folder structure.")
+
+    # Prepare dataset arrays
+    X = to_storage_dtype(X, storage_dtype)
+    print(f"Storing images as {X.dtype} ({X.nbytes / 1024 ** 2:.1f} MB)")
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
+
+    np.savez(output_path, X_train=X_train, X_test=X_test, y_train=y_train, y_test=y_test)
+    return len(X), elapsed
+
+def build_sharded_dataset(preprocessor, paths, labels, output_dir, storage_dtype):
+    """
+    Split the file list first, then decode one shard-sized block at a time and append it to
+    that split's ShardWriter. Peak memory is one block plus one shard buffer per split.
+    The shard size is the preprocessor's block capacity. Returns (num_images, elapsed,
+    kept_paths) where kept_paths lists the decoded source files of each split in shard order.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    train_idx, test_idx = train_test_split(np.arange(len(paths)), test_size=0.2)
+    image_shape = (IMAGE_SIZE[1], IMAGE_SIZE[0], 3)
+    dtype = np.uint8 if storage_dtype == "uint8" else np.float64
+    shard_size = preprocessor.capacity
+
+    splits = {}
+    kept_paths = {}
+    num_images = 0
+    start_time = time.time()
+    for split, split_idx in (("train", train_idx), ("test", test_idx)):
+        writer = ShardWriter(output_dir, split, shard_size, image_shape, dtype)
+        kept_paths[split] = []
+        for block_start in range(0, len(split_idx), shard_size):
+            block_idx = split_idx[block_start:block_start + shard_size]
+            images, valid = preprocessor.run([paths[i] for i in block_idx])
+            writer.add(to_storage_dtype(images, storage_dtype), labels[block_idx][valid])
+            kept_paths[split].extend(paths[i] for i in block_idx[valid])
+        splits[split] = writer.close()
+        num_images += splits[split]["count"]
+        print(f"  {split}: {splits[split]['count']} images in {len(splits[split]['shards'])} shards")
+    elapsed = time.time() - start_time
+
+    if num_images == 0:
+        raise ValueError("No data found. Please check dataset folder structure.")
+
+    write_shard_index(output_dir, splits, image_shape, dtype, shard_size,
+                      metadata={"image_size": list(IMAGE_SIZE), "color_mode": "bgr"})
+    print(f"Wrote sharded dataset to {output_dir} ({storage_dtype}, shard size {shard_size})")
+    return num_images, elapsed, kept_paths
+
+def build_roi_dataset(roi_extractor, kept_paths, images_dir, output_dir):
+    """
+    Run the landmark ROI stage over the kept files of every split and write the crops as
+    a sharded dataset aligned sample-for-sample with images_dir. Each sample holds the
+    left eye, right eye and mouth crops; (ear, mar, face_found) go to a per-split array.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    image_index, image_splits = open_sharded_dataset(images_dir)
+    shard_size = image_index["shard_size"]
+    roi_shape = (len(ROI_NAMES), roi_extractor.roi_size[1], roi_extractor.roi_size[0], 3)
+
+    splits = {}
+    num_images = 0
+    start_time = time.time()
+    for split, split_paths in kept_paths.items():
+        split_labels = image_splits[split].labels
+        writer = ShardWriter(output_dir, split, shard_size, roi_shape, np.uint8)
+        measurements = []
+        for block_start in range(0, len(split_paths), shard_size):
+            crops, block_measurements, _ = roi_extractor.run(split_paths[block_start:block_start + shard_size])
+            writer.add(crops, split_labels[block_start:block_start + shard_size])
+            measurements.append(block_measurements)
+        measurements = np.concatenate(measurements) if measurements else np.empty((0, 3), dtype=np.float32)
+        splits[split] = writer.close(arrays={"measurements": measurements})
+        num_images += splits[split]["count"]
+
+    write_shard_index(output_dir, splits, roi_shape, np.uint8, shard_size,
+                      metadata={"roi_names": list(ROI_NAMES), "roi_size": list(roi_extractor.roi_size),
+                                "measurements": ["ear", "mar", "face_found"], "color_mode": "bgr"})
+    return num_images, time.time() - start_time
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,63 @@
+import os
+import socket
 import subprocess
 import sys
+import threading
 import time
 
-def start_clearml_agent():
-    print("Starting ClearML Agent for queue BNM03...")
+from pipeline_controller import EXECUTION_QUEUE
+
+# Queue the agents serve (the pipeline's queue unless given as the first argument)
+QUEUE = EXECUTION_QUEUE
+
+# Agents to start on this machine. Several agents on one queue let fanned-out steps (e.g.
+# FEATURE_EXTRACTION_WORKERS in pipeline_controller.py) run in parallel locally; each gets
+# its own worker id so the ClearML server tells them apart.
+NUM_AGENTS = 1
+
+
+def _forward_output(agent_process, prefix):
+    for output in agent_process.stdout:
+        print(f"{prefix}{output.strip()}")
+
+
+def start_clearml_agent(queue=QUEUE, num_agents=NUM_AGENTS):
+    print(f"Starting {num_agents} ClearML Agent(s) for queue {queue.upper()}...")
+    agent_processes = []
     try:
-        # Start the ClearML agent in a separate process
-        agent_process = subprocess.Popen(
-            ["clearml-agent", "daemon", "--queue", "bnm03", "--foreground"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True
-        )
-        
-        # Monitor the agent output
-        while True:
-            output = agent_process.stdout.readline()
-            if output:
-                print(output.strip())
-            
-            # Check if the process is still running
-            if agent_process.poll() is not None:
-                print("ClearML Agent has stopped.")
-                break
-                
+        # Start the ClearML agents in separate processes
+        for agent_index in range(num_agents):
+            env = dict(os.environ)
+            prefix = ""
+            if num_agents > 1:
+                env["CLEARML_WORKER_ID"] = f"{socket.gethostname()}:agent_{agent_index}"
+                prefix = f"[agent {agent_index}] "
+            agent_process = subprocess.Popen(
+                ["clearml-agent", "daemon", "--queue", queue, "--foreground"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                env=env
+            )
+            agent_processes.append(agent_process)
+            # Monitor the agent output
+            threading.Thread(target=_forward_output, args=(agent_process, prefix), daemon=True).start()
+
+        # Check if the processes are still running
+        while any(agent_process.poll() is None for agent_process in agent_processes):
             time.sleep(0.1)
-            
+        print("ClearML Agent has stopped.")
+
     except KeyboardInterrupt:
         print("Stopping ClearML Agent...")
-        agent_process.terminate()
-        agent_process.wait()
+        for agent_process in agent_processes:
+            agent_process.terminate()
+        for agent_process in agent_processes:
+            agent_process.wait()
         print("ClearML Agent stopped.")
     except Exception as e:
         print(f"Error starting ClearML Agent: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
-    start_clearml_agent()
+    start_clearml_agent(sys.argv[1] if len(sys.argv) > 1 else QUEUE)
@@ -0,0 +1,125 @@
+"""
+Content-aware step caching for the pipeline controller.
+A step's cache key combines the hash of its code (its script and every local module it
+imports, read from the checkout the controller runs in), the script version the base task
+recorded and runs (repository, commit, uncommitted diff), its parameters and the hashes
+of the artifacts of the upstream tasks it reads. The upstream tasks are passed to each step
+as "Inputs/<step name>" task ids and the key replaces those ids by the hashes of their
+artifacts, so an upstream step that reran but produced identical artifacts still keeps
+its children cached. A step whose key matches a completed task is not enqueued; the
+pipeline reuses that task and its artifacts instead.
+Steps find their inputs with upstream_task(), which follows the "Inputs/" ids when the
+pipeline set them and falls back to the latest task of that name otherwise.
+"""
+import ast
+import hashlib
+import os
+
+from clearml import Task
+from clearml.automation.job import ClearmlJob
+from clearml.storage.hashing import hash_dict
+
+INPUTS_SECTION = "Inputs"
+CACHE_SECTION = "StepCache"
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _local_imports(path, root):
+    """Paths of the modules in root that the script at path imports (at any nesting level)."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    return sorted(os.path.join(root, f"{name}.py") for name in names
+                  if os.path.isfile(os.path.join(root, f"{name}.py")))
+
+
+def code_hash(script, root=_HERE):
+    """sha256 over script and, transitively, the local modules it imports."""
+    seen, pending = set(), [os.path.join(root, script)]
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        pending.extend(_local_imports(path, root))
+    digest = hashlib.sha256()
+    for path in sorted(seen):
+        digest.update(os.path.relpath(path, root).encode())
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def artifact_hashes(task):
+    """{artifact name: content hash (or URL when it has none)} of task."""
+    return {name: artifact.hash or artifact.url for name, artifact in sorted(task.artifacts.items())}
+
+
+def script_version(task, section_overrides=None):
+    """
+    The script section of task (as overridden) without its requirements, or None when it
+    names a repository but no commit or tag, so the code an agent would run is unknown.
+    """
+    script = (section_overrides or {}).get("script") or task.data.script
+    script = dict(script if isinstance(script, dict) else script.to_dict() if script else {})
+    if script.get("repository") and not script.get("version_num") and not script.get("tag"):
+        return None
+    script.pop("requirements", None)
+    return script
+
+
+def cache_key(parameters, configs=None, script=None):
+    """
+    Cache key of a step from its parameters (including its code hash), configuration
+    objects and, for a ClearML base task, the script version it runs.
+    """
+    parameters = dict(parameters)
+    for key, value in list(parameters.items()):
+        # Input task ids stand for the content of their artifacts
+        if key.startswith(f"{INPUTS_SECTION}/") and value:
+            parameters[key] = artifact_hashes(Task.get_task(task_id=value))
+    representation = {"hyper_params": parameters, "configs": configs or {}}
+    if script is not None:
+        representation["script"] = script
+    return hash_dict(representation, hash_func="md5")
+
+
+def upstream_task(step_name, task_name, project_name):
+    """
+    The task of an upstream step to read inputs from: the one the pipeline passed as
+    Inputs/<step_name> to the current task, or else the latest task named task_name.
+    """
+    current = Task.current_task()
+    task_id = current.get_parameter(f"{INPUTS_SECTION}/{step_name}") if current else None
+    if task_id:
+        return Task.get_task(task_id=task_id)
+    return Task.get_task(task_name=task_name, project_name=project_name)
+
+
+class StepCacheJob(ClearmlJob):
+    """
+    ClearmlJob keyed on code hash, parameters and input artifact hashes, next to the base
+    task's script version, for steps that carry a StepCache/code_hash parameter.
+    """
+
+    @classmethod
+    def _create_task_hash(cls, task, section_overrides=None, params_override=None, configurations_override=None,
+                          explicit_docker_image=None):
+        params = task.get_parameters() if params_override is None else params_override
+        if f"{CACHE_SECTION}/code_hash" not in params:
+            return super()._create_task_hash(task, section_overrides=section_overrides,
+                                             params_override=params_override,
+                                             configurations_override=configurations_override,
+                                             explicit_docker_image=explicit_docker_image)
+        script = script_version(task, section_overrides)
+        if script is None:
+            # As ClearML does: without a pinned commit the step cannot be cached safely
+            return None
+        configs = task.get_configuration_objects() if configurations_override is None else configurations_override
+        return cache_key(params, configs, script)
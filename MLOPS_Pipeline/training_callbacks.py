@@ -0,0 +1,46 @@
+"""
+Keras callbacks for Step 3 trials under HPO.
+ClearMLEpochReporter reports the per-epoch validation accuracies (eye, yawn and their
+average) to the ClearML logger, so the optimizer sees the objective while a trial is
+still training and its Optuna pruner can stop trials that trail the others. The average
+is also written into the epoch logs as val_average_accuracy, where early stopping can
+monitor it.
+"""
+from tensorflow.keras.callbacks import Callback, EarlyStopping
+
+AVERAGE_LOG_KEY = "val_average_accuracy"
+
+
+class ClearMLEpochReporter(Callback):
+    """
+    Report logs[key] as validation/<series> for every series -> key in series, at
+    iteration epoch + 1. With report_average, validation/average_accuracy is the mean of
+    those values and of fixed_accuracies (final accuracies of heads trained earlier in the
+    same trial).
+    """
+
+    def __init__(self, logger, series, report_average=True, fixed_accuracies=None):
+        super().__init__()
+        self.logger = logger
+        self.series = series
+        self.report_average = report_average
+        self.fixed_accuracies = fixed_accuracies or {}
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        accuracies = dict(self.fixed_accuracies)
+        for name, key in self.series.items():
+            if logs.get(key) is not None:
+                accuracies[name] = float(logs[key])
+                self.logger.report_scalar(title="validation", series=name, value=accuracies[name], iteration=epoch + 1)
+        if self.report_average and accuracies:
+            average = sum(accuracies.values()) / len(accuracies)
+            logs[AVERAGE_LOG_KEY] = average
+            self.logger.report_scalar(title="validation", series="average_accuracy", value=average, iteration=epoch + 1)
+
+
+def early_stopping(monitor, patience):
+    """EarlyStopping on a validation accuracy that restores the best epoch's weights, or None when patience is 0."""
+    if patience <= 0:
+        return None
+    return EarlyStopping(monitor=monitor, mode="max", patience=patience, restore_best_weights=True, verbose=1)
@@ -0,0 +1,124 @@
+"""
+Resource-aware concurrency for Step 4 trials.
+Local trials run side by side on this machine, so how many fit is bounded by the CPUs
+(each trial pins its TensorFlow thread pools to threads_per_worker threads) and by memory:
+the first trial runs alone as a calibration trial, and its peak private memory sizes how
+many trials the memory available before the run can hold. Private memory leaves out the
+shared-memory features every worker maps (they are already allocated when the available
+memory is measured) and what a spawned worker inherits from the parent's peak, both of
+which ru_maxrss counts. ClearML trials run one per agent, so their concurrency is the
+number of agents serving the execution queue.
+"""
+import os
+import resource
+import sys
+import threading
+
+# Share of the available memory left free for the OS, page cache and the HPO process itself
+MEMORY_RESERVE_FRACTION = 0.2
+
+
+def available_cpus():
+    """CPUs this process may run on (its affinity mask, where the OS has one)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_bytes():
+    """MemAvailable from /proc/meminfo, or None where it cannot be read."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def private_memory_bytes():
+    """Resident private memory of this process (RssAnon in /proc/self/status), or None where it cannot be read."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class PrivateMemoryMonitor:
+    """
+    Peak private memory of this process while the with-block runs, sampled every interval
+    seconds. Where RssAnon cannot be read it falls back to the peak resident memory less
+    shared_bytes, the shared memory the process maps.
+    """
+
+    def __init__(self, shared_bytes=0, interval=0.2):
+        self.shared_bytes = shared_bytes
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, private_memory_bytes() or 0)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        if private_memory_bytes() is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, private_memory_bytes() or 0)
+        else:
+            self.peak = max(0, peak_rss_bytes() - self.shared_bytes)
+        return False
+
+
+def plan_workers(threads_per_worker, memory_per_trial=None, memory_available=None):
+    """
+    Concurrent trials the CPUs allow at threads_per_worker threads each, further limited to
+    what memory_available holds at memory_per_trial bytes each when both are known.
+    """
+    workers = max(1, available_cpus() // max(1, threads_per_worker))
+    if memory_per_trial and memory_available:
+        budget = memory_available * (1 - MEMORY_RESERVE_FRACTION)
+        workers = min(workers, max(1, int(budget // memory_per_trial)))
+    return workers
+
+
+def queue_worker_count(queue_name):
+    """Number of ClearML agents serving queue_name, or None when the server cannot tell."""
+    try:
+        from clearml.backend_api.session.client import APIClient
+        client = APIClient()
+        queues = client.queues.get_all(name=f"^{queue_name}$")
+        if not queues:
+            return None
+        queue_id = queues[0].id
+        return sum(1 for worker in client.workers.get_all()
+                   if any(queue.id == queue_id for queue in (worker.queues or [])))
+    except Exception as e:
+        print(f"Could not count the agents serving queue '{queue_name}': {e}")
+        return None
+
+
+def format_bytes(num_bytes):
+    return f"{num_bytes / 2 ** 30:.2f} GiB" if num_bytes else "unknown"